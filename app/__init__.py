@@ -1,6 +1,9 @@
 from flask import Flask
 from app.docs import doc_bp, SWAGGER_URL
 from app.api import api
+from app.services.bulk import get_bulk_export_manager
+from app.services.adt import get_adt_job_queue
+from app.services.outbox import get_outbox
 
 
 def create_app():
@@ -12,4 +15,24 @@ def create_app():
     # Add documentation (swagger blueprint)
     app.register_blueprint(doc_bp, url_prefix=SWAGGER_URL)
 
+    # Resume polling of persisted bulk export jobs and queued messages right away,
+    # and again in every worker uWSGI forks off the master (threads do not survive a fork)
+    start_background_jobs()
+    try:
+        from uwsgidecorators import postfork  # only importable inside uWSGI
+    except ImportError:
+        pass
+    else:
+        postfork(start_background_jobs)
+
+    # fallback for other servers forking after the app was created
+    app.before_request(start_background_jobs)
+
     return app
+
+
+def start_background_jobs():
+    """Starts the background threads of this process, if not running yet"""
+    get_bulk_export_manager().ensure_running()
+    get_adt_job_queue().ensure_running()
+    get_outbox().ensure_running()
@@ -6,6 +6,7 @@ from app.api.organization import api as organization_api
 from app.api.location import api as location_api
 from app.api.careplan import api as careplan_api
 from app.api.adtmessage import api as adtmessage_api
+from app.api.metrics import api as metrics_api
 
 # Define API object with entry point
 api = Api(
@@ -22,3 +23,4 @@ api.add_namespace(organization_api)
 api.add_namespace(location_api)
 api.add_namespace(careplan_api)
 api.add_namespace(adtmessage_api)
+api.add_namespace(metrics_api)
@@ -1,16 +1,11 @@
 from flask import current_app as app, request
 from flask_restx import Namespace, Resource, fields
 from app.utils.hl7parser import hl7parser, hl7messageexception
-from app.services.cron import CronService
-from app.services.tnt import TnTService, TnTServiceException
-from datetime import datetime
+from app.services.adt import get_adt_job_queue
+from app.services.outbox import get_outbox
+from app.services.tnt import TnTServiceException
 import traceback
 import logging
-import time
-from config import Config
-import copy
-from app.utils.sanitizers import sanitize_adt_message
-from app.utils.fake_data import randomize_encounter
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -40,9 +35,10 @@ class AdtMessage(Resource):
         Receive an hl7 message and parse it, then use Patient ID to get encounters.
         The hl7 message is expected to be well formatted.
 
-        Returns: JSON formatted ADT message (from patient encounters, fetched using patient ID)
+        Returns: the queued job, poll /adtmessage/jobs/<id> for the result of every encounter
     """
     )
+    @api.response(202, "The message was queued")
     def post(self):
         try:
             # 1. Receive HL7 message
@@ -59,78 +55,16 @@ class AdtMessage(Resource):
 
             patient = hl7message.get_patient()
 
-            # 2. Fetch data from EPIC
-            encounters = CronService().parse_partient_encounters(patient["patient_id"])
-
-            logger.info(f"Fetched {len(encounters)} encounters for patient {patient['patient_id']}")
-
-            # 3. Loop over encounters and post each one
-            responses = []
-            json_request = None
-            for encounter in encounters:
-                try:
-                    if "hospital" in encounter and isinstance(encounter["hospital"], dict):
-                        encounter['hospital_stay']['hospital'] = copy.deepcopy(encounter['hospital'])
-                        encounter["hospital"]["abbreviation"] = Config.HOSPITAL_ABBREVIATION
-
-                    # sanitize the encounter before sending to TNT
-                    encounter = sanitize_adt_message(encounter)
-                    if Config.TNT_ENVIRONMENT == "development":
-                        encounter = randomize_encounter(encounter)
-
-                    json_request = {
-                        "type": "adt",
-                        "message_id": None,
-                        "payload": encounter,
-                        "message_created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "sending_system_id": "EPIC",
-                    }
-
-                    res = TnTService().post_adt_message(json_request=json_request)
-    
-                    responses.append(
-                        {
-                            "patient_id": encounter.get('patient').get('id'),
-                            "hospital_stay_id": encounter.get('hospital_stay').get('id'),
-                            "status": "success",
-                            "status_code": res.status_code,
-                        }
-                    )
-                except TnTServiceException as e:
-                    logger.error(
-                        f"TnTServiceException occurred while posting encounter {encounter.get('encounter_id')}: {e}"
-                    )
-                    traceback.print_exc()
-                    responses.append(
-                        {
-                            "patient_id": encounter.get('patient').get('id'),
-                            "hospital_stay_id": encounter.get('hospital_stay').get('id'),
-                            "status": "failed",
-                            "error": str(e),
-                            "status_code": e.status_code,
-                        }
-                    )
-                except Exception as e:
-                    logger.error(f"Error processing encounter {encounter.get('encounter_id')}: {str(e)}")
-                    traceback.print_exc()
-                    responses.append(
-                        {
-                            "patient_id": encounter.get('patient').get('id'),
-                            "hospital_stay_id": encounter.get('hospital_stay').get('id'),
-                            "status": "failed",
-                            "error": str(e),
-                            "status_code": 400,
-                        }
-                    )
-
-                time.sleep(2)
-
-            logger.info(f"Processed {len(responses)} encounters")
+            # 2. Fetching, extracting and posting the encounters runs in the background
+            job = get_adt_job_queue().enqueue(hl7_message, patient["patient_id"])
+            logger.info(
+                f"Queued ADT job {job['id']} for patient {patient['patient_id']}"
+            )
+
             return {
-                "success": f"Data for patient {patient['patient_id']} has been received and processed",
-                "responses": responses,
-                "adt_message": hl7_message
-            }, 200
+                "success": f"Data for patient {patient['patient_id']} has been received and queued",
+                "job": job,
+            }, 202
 
         except TnTServiceException as e:
             logger.error(f"TnTServiceException occurred: {e}")
@@ -141,3 +75,29 @@ class AdtMessage(Resource):
             traceback.print_exc()
             return {"error": str(e)}, 400
 
+
+@api.route("/jobs/<job_id>")
+@api.param("job_id", "The ADT job identifier")
+@api.response(404, "Job not Found")
+class AdtMessageJob(Resource):
+    def get(self, job_id):
+        """Status of an ADT job and the TnT result of every encounter posted so far"""
+        job = get_adt_job_queue().get(job_id)
+        if job is None:
+            return {"error": f"ADT job {job_id} not found"}, 404
+        return job
+
+
+@api.route("/outbox")
+class AdtOutbox(Resource):
+    def get(self):
+        """Entries of the TnT outbox per status, with the creation time of the oldest"""
+        return get_outbox().stats()
+
+
+@api.route("/outbox/replay")
+class AdtOutboxReplay(Resource):
+    @api.doc(params={"job_id": "Only replay the messages of this ADT job"})
+    def post(self):
+        """Queue the messages TnT rejected for delivery again"""
+        return {"replayed": get_outbox().replay(request.args.get("job_id"))}
@@ -1,11 +1,13 @@
 from flask import current_app as app
-from flask_restx import Namespace, Resource, fields, reqparse
+from flask_restx import Namespace, Resource, fields, reqparse, inputs
 from app.services.fhir import (
     FhirService,
     FhirServiceAuthenticationException,
     FhirServiceApiException,
 )
 from app.services.cron import CronService
+from app.services.bulk import get_bulk_export_manager, BulkExportPendingException
+from config import Config
 
 api = Namespace("encounter", description="Encounter related operations")
 
@@ -13,14 +15,55 @@ parser = reqparse.RequestParser()
 parser.add_argument("patient")
 parser.add_argument("type")
 
+export_parser = reqparse.RequestParser()
+export_parser.add_argument("_type", location="args")
+export_parser.add_argument("full", location="args", type=inputs.boolean, default=False)
+
 
 @api.route("/search")
 class EncounterSearch(Resource):
     # @api.marshal_list_with(patient_list_model)
+    @api.response(202, "The bulk export is running, poll the returned job")
     def get(self):
         """Get a list of encounters by using the BulkRequest Kick-off"""
-        cs = CronService()
-        return cs.start()
+        try:
+            cs = CronService()
+            return cs.start()
+        except BulkExportPendingException as pending:
+            # poll /encounter/export/<job_id>, then call this endpoint again
+            return pending.to_dict(), pending.status_code
+
+
+@api.route("/export")
+class EncounterExport(Resource):
+    @api.doc(
+        params={
+            "_type": "Comma separated resource types to export, defaults to BULK_EXPORT_TYPES",
+            "full": "Export everything instead of the changes since the last export",
+        }
+    )
+    @api.response(202, "The bulk export job was registered")
+    def post(self):
+        """Start a background bulk export of the configured Group"""
+        args = export_parser.parse_args()
+        manager = get_bulk_export_manager()
+        since = None
+        if Config.BULK_EXPORT_INCREMENTAL and not args["full"]:
+            since = manager.watermark()
+        job = manager.start(Config.EPIC_FHIR_GROUP_ID, args["_type"], since)
+        return job, 202
+
+
+@api.route("/export/<job_id>")
+@api.param("job_id", "The bulk export job identifier")
+@api.response(404, "Job not Found")
+class EncounterExportJob(Resource):
+    def get(self, job_id):
+        """Status, progress and manifest of a bulk export job"""
+        job = get_bulk_export_manager().get(job_id)
+        if job is None:
+            return {"message": f"Bulk export job {job_id} not found"}, 404
+        return job
 
 
 @api.route("/<id>")
@@ -0,0 +1,27 @@
+from flask_restx import Namespace, Resource
+from app.services.http import get_pool_stats
+from app.services.circuit import get_circuit_stats
+from app.utils.cache import cache_stats
+
+api = Namespace("metrics", description="Runtime metrics of this worker")
+
+
+@api.route("/pool")
+class PoolMetrics(Resource):
+    def get(self):
+        """Connection pool statistics (connections opened vs requests sent) per upstream"""
+        return get_pool_stats()
+
+
+@api.route("/cache")
+class CacheMetrics(Resource):
+    def get(self):
+        """Hit, miss and eviction counters of the in-process cache tier"""
+        return cache_stats()
+
+
+@api.route("/circuits")
+class CircuitMetrics(Resource):
+    def get(self):
+        """State, failure and slow-call rates of the circuit breakers of this worker"""
+        return get_circuit_stats()
@@ -5,6 +5,7 @@ from app.services.fhir import (
     FhirServiceAuthenticationException,
     FhirServiceApiException,
 )
+from app.repository.epic_organization import EpicOrganizationRepository
 
 api = Namespace("organization", description="Organization related operations")
 
@@ -33,8 +34,7 @@ class Organization(Resource):
         """Fetch an encouter given its identifier"""
 
         try:
-            fs = FhirService()
-            return fs.get_organization(id)
+            return EpicOrganizationRepository.fetch_raw(id)
         except FhirServiceAuthenticationException as auth_exp:
             print(auth_exp)
             return auth_exp.to_dict(), api_exp.status_code
@@ -102,9 +102,7 @@ class PatientEncounters(Resource):
         """Get JSON formatted ADT message, by searching a patient's Encounters, given the Patient ID"""
         try:
             cs = CronService()
-            encounters = cs.parse_partient_encounters(
-                id
-            )  # Assuming you have a method for this
+            encounters = cs.parse_partient_encounters(patient_id)
             return encounters
         except FhirServiceAuthenticationException as auth_exp:
             print(auth_exp)
@@ -1,7 +1,6 @@
 from .model import Model
 from app.utils.cache import cache_get, cache_set
 from app.services.fhir import FhirService
-import time
 from typing import Dict
 
 
@@ -35,9 +34,9 @@ class FhirLocation(Model):
             FhirServiceApiException: If there is an error fetching the location from the FHIR service.
         """
         key = f"location-{id}"
-        location = cache_get(key)
+        # Locations rarely change: past the soft TTL the cached one is served and refreshed in the background
+        location = cache_get(key, refresh=lambda: FhirService().get_location(id))
         if not location:
-            time.sleep(1)
             fs = FhirService()
             location = fs.get_location(id)
             cache_set(key, location)
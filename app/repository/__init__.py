@@ -1,3 +1,12 @@
+import logging
+from config import Config
+from app.services.fhir import FhirService, FhirServiceException
+from app.utils.cache import cache_get_many, cache_set_many, negative_cache_get
+from app.utils.iterators import batched
+
+logger = logging.getLogger(__name__)
+
+
 class Repository(object):
     def __init__(self) -> None:
         self.rawdata = {}
@@ -19,3 +28,50 @@ class Repository(object):
         if "id" in self.rawdata:
             model.id = self.rawdata["id"]
             self.model = model
+
+    @staticmethod
+    def prefetch_search(resource_type, ids, refresh=None):
+        """
+        Caches the resources among `ids` that are not cached yet, reading them with
+        batched `<resource_type>?_id=a,b,c` searches of FHIR_PREFETCH_BATCH_SIZE ids.
+
+        With `refresh` (a callable taking the ID), cached resources past their soft
+        TTL count as cached and are refreshed in the background, as `cache_get`
+        does.
+
+        IDs missing from the search results, or of a failed search, stay uncached,
+        the per-resource read of the extraction then fetches (and negatively
+        caches) them one by one.
+
+        Returns:
+            dict: The raw resources that were fetched, keyed by ID.
+        """
+        prefix = resource_type.lower()
+        keys = {f"{prefix}-{id}": id for id in ids if id}
+        cached = cache_get_many(
+            keys, refresh=refresh and (lambda key: refresh(keys[key]))
+        )
+        missing = [
+            id
+            for key, id in keys.items()
+            if key not in cached and negative_cache_get(key) is None
+        ]
+        if not missing or not Config.FHIR_PREFETCH_BATCH_SIZE:
+            return {}
+
+        fs = FhirService()
+        resources = {}
+        for chunk in batched(missing, Config.FHIR_PREFETCH_BATCH_SIZE):
+            try:
+                found = {
+                    resource["id"]: resource
+                    for resource in fs.iter_search_ids(resource_type, chunk)
+                    if resource.get("id") in chunk
+                }
+            except FhirServiceException as e:
+                logger.warning(f"Prefetching {len(chunk)} {resource_type}s failed: {e}")
+                continue
+
+            cache_set_many({f"{prefix}-{id}": r for id, r in found.items()})
+            resources.update(found)
+        return resources
@@ -1,11 +1,17 @@
 import logging
+import asyncio
+from itertools import chain
 
 from app.services.fhir import FhirService
-from app.utils.cache import cache_get
+from app.services.fhir_async import AsyncFhirService
+from app.services.bulk import exported_files
+from app.utils.cache import cache_get, cache_get_many
+from app.utils.ndjson import iter_ndjson_file
 from app.models.patient import PatientReference
 from app.repository import Repository
 from app.repository.epic_patient import EpicPatientRepository
 from app.repository.epic_location import EpicLocationRepository
+from app.repository.location_index import get_location_index
 from app.models.encounter import Encounter
 from app.models.hospital import HospitalStay, HospitalStayReference
 from app.models.bed import Bed
@@ -60,6 +66,100 @@ class EpicEncounterRepository(Repository):
             # return ADTMessage
             return repo._get_adt_message()
 
+    @staticmethod
+    async def extract_factory_async(rawdata, client: AsyncFhirService = None):
+        """
+        Same as `extract_factory`, but first resolves every Patient and Location
+        referenced by the Encounter concurrently, so the extraction itself runs
+        from cache.
+        """
+        repo = EpicEncounterRepository()
+        repo.set_rawdata(rawdata)
+
+        if repo._is_hospital_stay():
+            await repo._resolve_references(
+                client if client is not None else AsyncFhirService()
+            )
+            # the extraction itself is sync, what was not resolved above is read in
+            # a worker thread instead of blocking the other encounters of the loop
+            return await asyncio.to_thread(repo._extract_adt_message)
+
+    def _extract_adt_message(self):
+        self._extract_patient()
+        self._extract_hospital_and_departments()
+        return self._get_adt_message()
+
+    @staticmethod
+    def prefetch_references(encounters):
+        """
+        Caches every Patient and Location referenced by the hospital stays among
+        `encounters` with batched `_id` searches, so extracting them afterwards
+        runs from cache instead of reading each reference one by one.
+        """
+        location_ids = []
+        patient_ids = []
+        for encounter in encounters:
+            repo = EpicEncounterRepository()
+            repo.set_rawdata(encounter)
+            if repo._is_hospital_stay():
+                locations, patients = repo._reference_ids()
+                location_ids.extend(locations)
+                patient_ids.extend(patients)
+
+        EpicLocationRepository.prefetch_batch(location_ids)
+        EpicPatientRepository.prefetch_batch(patient_ids)
+
+        # hospitals referenced through partOf are only known once the locations are resolved
+        repo = EpicEncounterRepository()
+        parent_ids = []
+        for location in cache_get_many(
+            [f"location-{id}" for id in location_ids],
+            refresh=lambda key: FhirService().get_location(key.split("-", 1)[1]),
+        ).values():
+            partof_reference = repo.get_object_detail(location, ["partOf", "reference"])
+            if partof_reference:
+                parent_ids.append(partof_reference.split("/")[-1])
+
+        EpicLocationRepository.prefetch_batch(parent_ids)
+
+    def _reference_ids(self):
+        """IDs of the Locations and the Patient the Encounter references"""
+        location_ids = []
+        for location in self.get_object_detail(self.rawdata, ["location"], []):
+            location_reference = self.get_object_detail(
+                location, ["location", "reference"], ""
+            )
+            if location_reference:
+                location_ids.append(location_reference.split("/")[1])
+
+        patient_ids = []
+        patient_reference = self.get_object_detail(
+            self.rawdata, ["subject", "reference"]
+        )
+        if patient_reference:
+            patient_ids.append(patient_reference.split("/")[1])
+
+        return location_ids, patient_ids
+
+    async def _resolve_references(self, client: AsyncFhirService):
+        location_ids, patient_ids = self._reference_ids()
+
+        await asyncio.gather(
+            EpicLocationRepository.prefetch(location_ids, client),
+            EpicPatientRepository.prefetch(patient_ids, client),
+        )
+
+        # hospitals referenced through partOf are only known once the locations are resolved
+        parent_ids = []
+        for id in location_ids:
+            partof_reference = self.get_object_detail(
+                cache_get(f"location-{id}"), ["partOf", "reference"]
+            )
+            if partof_reference:
+                parent_ids.append(partof_reference.split("/")[-1])
+
+        await EpicLocationRepository.prefetch(parent_ids, client)
+
     def _extract_patient(self):
         patient = None
         patient_reference = self.get_object_detail(
@@ -101,6 +201,7 @@ class EpicEncounterRepository(Repository):
         hospital_stay = HospitalStay(id=self.rawdata["id"], data=stay_data)
 
         encounter_locations = self.get_object_detail(self.rawdata, ["location"], [])
+        index = get_location_index()
 
         for location in encounter_locations:
             location_reference = self.get_object_detail(
@@ -123,22 +224,19 @@ class EpicEncounterRepository(Repository):
             ):
                 self.departments[loc.id] = loc
 
-                # Check the partOf property of this location if it is a hospital
-                partof_reference = loc.get_partOf_reference()
-                if partof_reference:
-                    hospital_loc = EpicLocationRepository.fetch_by_id(partof_reference)
-                    if (
-                        hospital_loc.is_hospital
-                        and not hospital_loc.id in self.hospitals
-                    ):
-                        self.hospitals[hospital_loc.id] = loc
+                # the nearest hospital up the department's partOf chain, precomputed by the index
+                hospital_id = index.hospital(loc.id)
+                if hospital_id:
+                    if not hospital_id in self.hospitals:
+                        hospital = EpicLocationRepository.fetch_by_id(hospital_id)
+                        self.hospitals[hospital_id] = hospital
 
-                        # @TODO
-                        # Add check to iterate over all saved hospitals to see
-                        # if hospital reference from partOf is same as hospital from encounter
+                    # @TODO
+                    # Add check to iterate over all saved hospitals to see
+                    # if hospital reference from partOf is same as hospital from encounter
 
-                        # Arbitriary append of hospital_id to this department to later match hospital to department
-                        self.departments[loc.id].hospital_id = hospital_loc.id
+                    # Arbitriary append of hospital_id to this department to later match hospital to department
+                    self.departments[loc.id].hospital_id = hospital_id
 
             if loc.is_room:
                 self.rooms[loc.id] = loc
@@ -147,7 +245,8 @@ class EpicEncounterRepository(Repository):
                 self.beds[loc.id] = loc
 
         # match hospital and department stays and also rooms and beds in the department
-        # This match is done solely based on the partOf property of each Location from EPIC
+        # This match is done solely based on the partOf property of each Location from EPIC,
+        # as indexed by the Location index
         self._match_beds_to_rooms()
         self._match_rooms_to_departments()
         self._match_departments_to_hospitals(hospital_stay)
@@ -162,18 +261,16 @@ class EpicEncounterRepository(Repository):
                 bed = Bed(id=bed_id, data=self.beds[bed_id].to_dict())
                 self.room_beds[room_id] = bed
 
-
     def _match_rooms_to_departments(self):
         for room_id in self.rooms:
             department_id = self.rooms[room_id].get_partOf_reference()
             if department_id and department_id in self.departments:
                 room = Room(id=room_id, data=self.rooms[room_id].to_dict())
                 self.department_rooms[department_id] = room
-   
 
     def _match_departments_to_hospitals(self, hospital_stay: HospitalStay):
         for department_id in self.departments:
-            hospital_id = self.departments[department_id].hospital_id
+            hospital_id = getattr(self.departments[department_id], "hospital_id", None)
 
             if hospital_id in self.hospitals:
                 if not hospital_id in self.hospital_stays:
@@ -240,6 +337,18 @@ class EpicEncounterRepository(Repository):
         except:
             return None
 
+    @staticmethod
+    def read_exported_data():
+        """
+        Returns an iterator over the encounters of the last bulk export, parsed one
+        line at a time, or None when there is no export younger than BULK_EXPORT_TTL.
+        """
+        files = exported_files("Encounter")
+        if files is None:
+            return None
+
+        return chain.from_iterable(iter_ndjson_file(path) for path in files)
+
     @staticmethod
     def read_patient_test_data(patient_id):
         # Do not use test data in production
@@ -253,5 +362,6 @@ class EpicEncounterRepository(Repository):
     
     @staticmethod
     def read_patient_data(patient_id):
+        """Yields every Encounter of the patient, page by page"""
         fs = FhirService()
-        return fs.get_patient_encounters(patient_id)
+        return fs.iter_patient_encounters(patient_id, prefetch=True)
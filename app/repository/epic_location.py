@@ -1,9 +1,22 @@
 from app.repository import Repository
-from app.utils.cache import cache_get, cache_set
-from app.services.fhir import FhirService
+from app.utils.cache import (
+    cache_get,
+    cache_get_stale,
+    cache_set,
+    cache_delete,
+    negative_cache_get,
+    negative_cache_set,
+)
+from app.services.fhir import (
+    FhirService,
+    FhirServiceApiException,
+    CircuitOpenException,
+)
 from app.models.location import Location
-from app.models.bed import Bed
-import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class EpicLocationRepository(Repository):
@@ -15,10 +28,9 @@ class EpicLocationRepository(Repository):
         """
         Fetch a FHIR location by its ID and associate encounter location data with it.
 
-        This method retrieves a FHIR location object based on the provided `id`. If the
-        location is not found in the cache, it fetches the location from the FHIR service,
-        stores it in the cache, and then associates the provided `encounter_data` with
-        the location before returning it as a `Location` object.
+        This method looks the location up in the Location index, which reads it from
+        the cache or the FHIR service when not indexed yet, and then classifies it
+        with the provided `encounter_data` before returning it as a `Location` object.
 
         Args:
             id (str): A string referencing the FHIR location.
@@ -31,16 +43,110 @@ class EpicLocationRepository(Repository):
         Raises:
             FhirServiceApiException: If there is an error fetching the location from the FHIR service.
         """
+        from app.repository.location_index import get_location_index
+
+        # classification flags and parents come precomputed from the Location index
+        data = dict(get_location_index().get(id)["location"])
+
+        # the Encounter's location entry may itself say the location is a room or a bed
+        physical_type = Repository().get_object_detail(
+            encounter_data, ["physicalType", "coding", 0, "code"]
+        )
+        data["is_room"] = data["is_room"] or physical_type == "ro"
+        data["is_bed"] = data["is_bed"] or physical_type == "bd"
+
+        return Location(data=data)
+
+    @staticmethod
+    def fetch_raw(id: str):
+        """
+        Fetch the raw FHIR location by its ID, from the cache when possible.
+
+        Raises:
+            FhirServiceApiException: If there is an error fetching the location from the FHIR service,
+                or the service returned no usable location.
+        """
         key = f"location-{id}"
-        location = cache_get(key)
+        # dangling references are remembered for a while instead of re-queried
+        status = negative_cache_get(key)
+        if status == "invalid":
+            raise FhirServiceApiException(
+                f"Location {id} recently returned no usable resource", 502
+            )
+        if status is not None:
+            raise FhirServiceApiException(
+                f"Location {id} recently failed with status {status}", status
+            )
+
+        # Locations rarely change: past the soft TTL the cached one is served and refreshed in the background
+        location = cache_get(key, refresh=lambda: FhirService().get_location(id))
         if not location:
-            time.sleep(1)
             fs = FhirService()
-            location = fs.get_location(id)
-            cache_set(key, location)
+            try:
+                location = fs.get_location(id)
+            except CircuitOpenException:
+                # Epic is not asked while it keeps failing: serve an outdated Location if
+                # there is one, and do not remember the failure past the outage
+                location = cache_get_stale(key)
+                if not location:
+                    raise
+            except FhirServiceApiException as e:
+                negative_cache_set(key, e.status_code)
+                raise
+            else:
+                cache_set(key, location)
+
+        if isinstance(location, dict) and location.get("id"):
+            return location
+
+        negative_cache_set(key, "invalid")
+        cache_delete(key)
+        raise FhirServiceApiException(f"Location {id} returned no usable resource", 502)
 
-        location["encounter_data"] = encounter_data
-        return EpicLocationRepository.extract_factory(location)
+    @staticmethod
+    async def prefetch(ids, client):
+        """
+        Fetch the given Locations concurrently and cache the ones not cached yet.
+
+        Args:
+            ids (list): Location IDs to resolve.
+            client (AsyncFhirService): The async client bounding concurrency and rate.
+
+        Returns:
+            dict: The raw Locations that were fetched, keyed by ID.
+        """
+        missing = [
+            id
+            for id in dict.fromkeys(ids)
+            if not cache_get(
+                f"location-{id}", refresh=lambda id=id: client.fs.get_location(id)
+            )
+            and negative_cache_get(f"location-{id}") is None
+        ]
+        results = await asyncio.gather(
+            *[client.get_location(id) for id in missing], return_exceptions=True
+        )
+
+        locations = {}
+        for id, location in zip(missing, results):
+            if isinstance(location, Exception):
+                # left uncached, the sync extraction raises it again
+                logger.warning(f"Prefetching Location {id} failed: {location}")
+                if isinstance(location, FhirServiceApiException) and not isinstance(
+                    location, CircuitOpenException
+                ):
+                    negative_cache_set(f"location-{id}", location.status_code)
+                continue
+            cache_set(f"location-{id}", location)
+            locations[id] = location
+        return locations
+
+    @staticmethod
+    def prefetch_batch(ids):
+        """Cache the given Locations not cached yet with batched `Location?_id=` searches"""
+        return Repository.prefetch_search(
+            "Location", ids, refresh=lambda id: FhirService().get_location(id)
+        )
 
     @staticmethod
     def fetch_by_rawdata(encounter_data: dict = {}):
@@ -119,32 +225,14 @@ class EpicLocationRepository(Repository):
 
         return len(values) > 0
 
+    def _physical_type(self):
+        # HL7 standard of the location type, as given by the Encounter or else the Location itself
+        return self.get_object_detail(
+            self.rawdata, ["encounter_data", "physicalType", "coding", 0, "code"]
+        ) or self.get_object_detail(self.rawdata, ["physicalType", "coding", 0, "code"])
+
     def _is_room(self):
-        # HL7 standard of a room
-        _is_room = (
-            self.get_object_detail(
-                self.rawdata, ["encounter_data", "physicalType", "coding", 0, "code"]
-            )
-            == "ro"
-        )
-        if _is_room:
-            loc_ref = self.get_object_detail(
-                self.rawdata, ["encounter_data", "location", "reference"]
-            )
-            loc_id = loc_ref.split("/")[1]
-            return EpicLocationRepository.fetch_by_id(loc_id)
+        return self._physical_type() == "ro"
 
     def _is_bed(self):
-        # HL7 standard of a bed
-        _is_bed = (
-            self.get_object_detail(
-                self.rawdata, ["encounter_data", "physicalType", "coding", 0, "code"]
-            )
-            == "bd"
-        )
-        if _is_bed:
-            return Bed(
-                id=self.get_object_detail(
-                    self.rawdata, ["encounter_data", "identifier", "value"]
-                )
-            )
+        return self._physical_type() == "bd"
@@ -0,0 +1,26 @@
+from app.repository import Repository
+from app.utils.cache import cache_get, cache_set
+from app.services.fhir import FhirService
+
+
+class EpicOrganizationRepository(Repository):
+    def __init__(self) -> None:
+        super().__init__()
+
+    @staticmethod
+    def fetch_raw(id: str):
+        """
+        Fetch the raw FHIR organization by its ID, from the cache when possible.
+
+        Raises:
+            FhirServiceApiException: If there is an error fetching the organization from the FHIR service.
+        """
+        key = f"organization-{id}"
+        # Organizations rarely change: past the soft TTL the cached one is served and refreshed in the background
+        organization = cache_get(
+            key, refresh=lambda: FhirService().get_organization(id)
+        )
+        if not organization:
+            organization = FhirService().get_organization(id)
+            cache_set(key, organization)
+        return organization
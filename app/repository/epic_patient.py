@@ -1,7 +1,22 @@
 from app.repository import Repository
-from app.utils.cache import cache_get, cache_set
-from app.services.fhir import FhirService
+from app.utils.cache import (
+    cache_get,
+    cache_get_stale,
+    cache_set,
+    cache_delete,
+    negative_cache_get,
+    negative_cache_set,
+)
+from app.services.fhir import (
+    FhirService,
+    FhirServiceApiException,
+    CircuitOpenException,
+)
 from app.models.patient import Patient
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class EpicPatientRepository(Repository):
@@ -11,16 +26,70 @@ class EpicPatientRepository(Repository):
     @staticmethod
     def fetch_by_id(id):
         key = f"patient-{id}"
+        # dangling references are remembered for a while instead of re-queried
+        status = negative_cache_get(key)
+        if status == "invalid":
+            return None
+        if status is not None:
+            raise FhirServiceApiException(
+                f"Patient {id} recently failed with status {status}", status
+            )
+
         raw_data = cache_get(key)
         if not raw_data:
             fs = FhirService()
-            raw_data = fs.get_patient(id)
-            cache_set(key, raw_data)
+            try:
+                raw_data = fs.get_patient(id)
+            except CircuitOpenException:
+                # Epic is not asked while it keeps failing: serve an outdated Patient if
+                # there is one, and do not remember the failure past the outage
+                raw_data = cache_get_stale(key)
+                if not raw_data:
+                    raise
+            except FhirServiceApiException as e:
+                negative_cache_set(key, e.status_code)
+                raise
+            else:
+                cache_set(key, raw_data)
 
         patient = EpicPatientRepository.extract_factory(raw_data)
         if patient.id:
             return patient
 
+        negative_cache_set(key, "invalid")
+        cache_delete(key)
+
+    @staticmethod
+    async def prefetch(ids, client):
+        """Fetch the given Patients concurrently and cache the ones not cached yet"""
+        missing = [
+            id
+            for id in dict.fromkeys(ids)
+            if not cache_get(f"patient-{id}")
+            and negative_cache_get(f"patient-{id}") is None
+        ]
+        results = await asyncio.gather(
+            *[client.get_patient(id) for id in missing], return_exceptions=True
+        )
+
+        patients = {}
+        for id, patient in zip(missing, results):
+            if isinstance(patient, Exception):
+                logger.warning(f"Prefetching Patient {id} failed: {patient}")
+                if isinstance(patient, FhirServiceApiException) and not isinstance(
+                    patient, CircuitOpenException
+                ):
+                    negative_cache_set(f"patient-{id}", patient.status_code)
+                continue
+            cache_set(f"patient-{id}", patient)
+            patients[id] = patient
+        return patients
+
+    @staticmethod
+    def prefetch_batch(ids):
+        """Cache the given Patients not cached yet with batched `Patient?_id=` searches"""
+        return Repository.prefetch_search("Patient", ids)
+
     @staticmethod
     def extract_factory(rawdata):
         repo = EpicPatientRepository()
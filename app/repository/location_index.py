@@ -0,0 +1,169 @@
+import time
+import logging
+import threading
+from config import Config
+from app.services.bulk import get_bulk_export_manager
+from app.services.fhir import FhirServiceException
+from app.repository.epic_location import EpicLocationRepository
+from app.utils.ndjson import iter_ndjson_file
+
+logger = logging.getLogger(__name__)
+
+
+class LocationIndex(object):
+    """
+    In-memory graph of the Epic Locations: hospital → department → room → bed.
+
+    Every node holds the Location's fields with its classification flags
+    (`is_hospital`, `is_department`, `is_room`, `is_bed`) computed once when it is
+    indexed, its parent, its chain of ancestors and its nearest hospital, so
+    parent and ancestor queries are dict lookups.
+
+    The index is filled from the Location files of the latest bulk export and,
+    for Locations it does not hold yet, one by one through the cache. A node is
+    re-read from the cache after `ttl` seconds, so Locations changed by another
+    worker or by a later export reach this one; `update` re-indexes a changed
+    Location together with the ancestor chains of its descendants.
+    """
+
+    def __init__(self, ttl) -> None:
+        self.ttl = ttl
+        # id -> {"location", "parent", "ancestors", "hospital", "indexed_at"}
+        self._nodes = {}
+        self._children = {}  # id -> set of child ids
+        self._export_id = None
+        self._export_checked_at = 0
+        self._lock = threading.RLock()
+
+    def get(self, id):
+        """Returns the node of Location `id`, reading the Location if not indexed or outdated"""
+        self._sync_export()
+        node = self._nodes.get(id)
+        if node is None or node["indexed_at"] + self.ttl < time.time():
+            node = self.update(EpicLocationRepository.fetch_raw(id))
+
+        # index the chain of partOf parents too, ancestor queries need all of it; a
+        # Location moved under a parent not indexed yet has the end of its chain missing
+        parent = node["ancestors"][-1] if node["ancestors"] else None
+        while parent and parent not in self._nodes:
+            try:
+                parent = self.update(EpicLocationRepository.fetch_raw(parent))["parent"]
+            except FhirServiceException as e:
+                logger.warning(f"Indexing parent Location {parent} failed: {e}")
+                break
+        return node
+
+    def parent(self, id):
+        return self.get(id)["parent"]
+
+    def ancestors(self, id):
+        """IDs of the Location's ancestors, from its parent up to the root"""
+        return self.get(id)["ancestors"]
+
+    def hospital(self, id):
+        """ID of the Location itself when a hospital, else of its nearest hospital ancestor"""
+        return self.get(id)["hospital"]
+
+    def update(self, rawdata):
+        """Indexes a new or changed raw FHIR Location, returns its node"""
+        location = EpicLocationRepository.extract_factory(rawdata)
+        node = {
+            "location": vars(location),
+            "parent": location.get_partOf_reference(),
+            "ancestors": (),
+            "hospital": None,
+            "indexed_at": time.time(),
+        }
+
+        with self._lock:
+            previous = self._nodes.get(location.id)
+            if previous is not None and previous["parent"] != node["parent"]:
+                self._children.get(previous["parent"], set()).discard(location.id)
+            if node["parent"]:
+                self._children.setdefault(node["parent"], set()).add(location.id)
+
+            self._nodes[location.id] = node
+            self._reindex(location.id)
+        return node
+
+    def load(self, locations):
+        """Indexes many raw Locations, e.g. the Location file of a bulk export"""
+        count = 0
+        for rawdata in locations:
+            self.update(rawdata)
+            count = count + 1
+        return count
+
+    def _reindex(self, id):
+        # ancestors and hospital of the node and of all its descendants, parents first
+        pending = [id]
+        while pending:
+            node_id = pending.pop()
+            node = self._nodes[node_id]
+
+            ancestors = ()
+            parent = self._nodes.get(node["parent"])
+            if node["parent"]:
+                ancestors = (node["parent"],)
+                if parent is not None:
+                    ancestors = ancestors + parent["ancestors"]
+            if node_id in ancestors:
+                # a partOf cycle, cut it where it closes
+                ancestors = ancestors[: ancestors.index(node_id)]
+
+            node["ancestors"] = ancestors
+            node["hospital"] = next(
+                (
+                    location_id
+                    for location_id in (node_id,) + ancestors
+                    if location_id in self._nodes
+                    and self._nodes[location_id]["location"]["is_hospital"]
+                ),
+                None,
+            )
+
+            pending.extend(
+                child
+                for child in self._children.get(node_id, ())
+                if child in self._nodes and child not in (node_id,) + ancestors
+            )
+
+    def _sync_export(self):
+        # picks up the Locations of a newly completed bulk export, checked once per ttl
+        now = time.time()
+        if self._export_checked_at + self.ttl > now:
+            return
+        self._export_checked_at = now
+
+        latest = get_bulk_export_manager().latest()
+        if latest is None or latest["job_id"] == self._export_id:
+            return
+
+        with self._lock:
+            if latest["job_id"] == self._export_id:
+                return
+            self._export_id = latest["job_id"]
+
+        count = 0
+        for path in latest["files"].get("Location", []):
+            try:
+                count = count + self.load(iter_ndjson_file(path))
+            except OSError as e:
+                logger.warning(f"Indexing Locations from {path} failed: {e}")
+        logger.info(f"Indexed {count} Locations of bulk export {latest['job_id']}")
+
+    def stats(self):
+        return {"locations": len(self._nodes), "export": self._export_id}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_location_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LocationIndex(ttl=Config.LOCATION_INDEX_TTL)
+    return _index
@@ -0,0 +1,411 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import traceback
+from datetime import datetime
+from config import Config
+from app.services.cron import CronService
+from app.services.outbox import get_outbox
+from app.services.digest import get_digest_store, payload_digest
+
+logger = logging.getLogger(__name__)
+
+
+# job results of the messages handed to the outbox, by outbox entry status
+OUTBOX_STATUSES = {"pending": "queued", "delivered": "success", "failed": "failed"}
+
+
+class AdtJobQueue(object):
+    """
+    Durable queue of received HL7 ADT messages, processed in the background.
+
+    Jobs live in a SQLite database (WAL mode) shared by all uWSGI workers. Every
+    worker runs `workers` daemon threads that claim queued jobs; a claim is a
+    lease of `lease` seconds, renewed by a heartbeat while the job runs, so the
+    jobs of a worker that died are picked up again once their lease has run out.
+    A job whose lease ran out `max_attempts` times fails instead of being claimed
+    again. Finished jobs are kept for `retention` seconds.
+
+    Job statuses: "queued", "running", "completed" (every encounter was handed to
+    the TnT outbox, see the per-encounter results), "failed" (the encounters
+    could not be fetched or extracted).
+    """
+
+    def __init__(
+        self,
+        path,
+        workers,
+        lease=300,
+        retention=7 * 24 * 3600,
+        max_attempts=3,
+        tick=1,
+    ) -> None:
+        self.path = path
+        self.workers = workers
+        self.lease = lease
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.tick = tick
+        self._local = threading.local()
+        self._pid = None
+        self._purged_at = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS adt_jobs "
+                "(id TEXT PRIMARY KEY, status TEXT NOT NULL, patient_id TEXT, "
+                "message TEXT NOT NULL, results TEXT NOT NULL, error TEXT, "
+                "attempts INTEGER NOT NULL, created_at REAL NOT NULL, "
+                "updated_at REAL NOT NULL, lease_until REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS adt_jobs_status ON adt_jobs (status, created_at)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, message, patient_id):
+        """Stores the HL7 message as a queued job and returns the job right away"""
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        self.connection().execute(
+            "INSERT INTO adt_jobs (id, status, patient_id, message, results, attempts, "
+            "created_at, updated_at) VALUES (?, 'queued', ?, ?, '[]', 0, ?, ?)",
+            (job_id, patient_id, message, now, now),
+        )
+        self.ensure_running()
+        self._wakeup.set()
+        return self.get(job_id)
+
+    def enqueue_many(self, messages):
+        """
+        Stores `(message, patient_id)` pairs as queued jobs in one transaction and
+        returns their IDs, in order.
+        """
+        now = time.time()
+        jobs = [
+            (str(uuid.uuid4()), patient_id, message) for message, patient_id in messages
+        ]
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO adt_jobs (id, status, patient_id, message, results, attempts, "
+                "created_at, updated_at) VALUES (?, 'queued', ?, ?, '[]', 0, ?, ?)",
+                [
+                    (job_id, patient_id, message, now, now)
+                    for job_id, patient_id, message in jobs
+                ],
+            )
+        self.ensure_running()
+        self._wakeup.set()
+        return [job_id for job_id, _, _ in jobs]
+
+    def get(self, job_id):
+        row = (
+            self.connection()
+            .execute("SELECT * FROM adt_jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        if row is not None:
+            return self._to_dict(row)
+
+    def claim(self):
+        """Leases the oldest queued (or abandoned running) job, None when there is none"""
+        conn = self.connection()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # abandoned that often, the job most likely crashes its worker
+            conn.execute(
+                "UPDATE adt_jobs SET status = 'failed', error = ?, lease_until = NULL, "
+                "updated_at = ? WHERE status = 'running' AND lease_until < ? "
+                "AND attempts >= ?",
+                (
+                    f"Abandoned after {self.max_attempts} attempts",
+                    now,
+                    now,
+                    self.max_attempts,
+                ),
+            )
+            row = conn.execute(
+                "SELECT id FROM adt_jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE adt_jobs SET status = 'running', attempts = attempts + 1, "
+                "lease_until = ?, updated_at = ? WHERE id = ?",
+                (now + self.lease, now, row["id"]),
+            )
+        return self.get(row["id"])
+
+    def record(self, job_id, results):
+        """Stores the results so far and renews the lease"""
+        now = time.time()
+        self.connection().execute(
+            "UPDATE adt_jobs SET results = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(results), now + self.lease, now, job_id),
+        )
+
+    def renew(self, job_id):
+        """Extends the lease of a running job"""
+        self.connection().execute(
+            "UPDATE adt_jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+            (time.time() + self.lease, job_id),
+        )
+
+    def heartbeat(self, job_id):
+        """
+        Renews the lease of the job every third of the lease in a daemon thread,
+        until the returned event is set.
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3):
+                try:
+                    self.renew(job_id)
+                except sqlite3.Error:
+                    logger.exception(f"Renewing the lease of ADT job {job_id} failed")
+
+        threading.Thread(target=beat, daemon=True).start()
+        return stop
+
+    def finish(self, job_id, status, results, error=None):
+        self.connection().execute(
+            "UPDATE adt_jobs SET status = ?, results = ?, error = ?, lease_until = NULL, "
+            "updated_at = ? WHERE id = ?",
+            (status, json.dumps(results), error, time.time(), job_id),
+        )
+
+    def purge(self):
+        """Deletes finished jobs older than the retention, returns how many were removed"""
+        return (
+            self.connection()
+            .execute(
+                "DELETE FROM adt_jobs WHERE status IN ('completed', 'failed') "
+                "AND updated_at < ?",
+                (time.time() - self.retention,),
+            )
+            .rowcount
+        )
+
+    def _purge_expired(self):
+        # when idle, at most once an hour per process
+        if self._purged_at + 3600 > time.time():
+            return
+        self._purged_at = time.time()
+        try:
+            self.purge()
+        except sqlite3.Error:
+            pass  # retried on the next idle hour
+
+    def ensure_running(self):
+        """Starts the worker threads of this process, if not running yet"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        for _ in range(self.workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.Error:
+                logger.exception("Claiming an ADT job failed")
+                job = None
+
+            if job is None:
+                self._purge_expired()
+                self._wakeup.wait(self.tick)
+                self._wakeup.clear()
+                continue
+
+            self.process(job)
+
+    def process(self, job):
+        results = []
+
+        def on_result(result):
+            results.append(result)
+            self.record(job["id"], results)
+
+        # fetching and extracting the first encounter alone may outlast the lease
+        heartbeat = self.heartbeat(job["id"])
+        try:
+            deliver_patient_encounters(job["patient_id"], on_result, job["id"])
+        except Exception as e:
+            logger.error(f"ADT job {job['id']} failed: {e}")
+            traceback.print_exc()
+            self.finish(job["id"], "failed", results, str(e))
+            return
+        finally:
+            heartbeat.set()
+
+        logger.info(f"ADT job {job['id']} processed {len(results)} encounters")
+        self.finish(job["id"], "completed", results)
+
+    def _to_dict(self, row):
+        job = dict(row)
+        job["results"] = json.loads(job["results"])
+
+        # queued messages report how far the outbox got with them
+        entries = get_outbox().get_many(
+            result["outbox_id"] for result in job["results"] if "outbox_id" in result
+        )
+        for result in job["results"]:
+            entry = entries.get(result.get("outbox_id"))
+            if entry is not None:
+                result.update(
+                    {
+                        "status": OUTBOX_STATUSES[entry["status"]],
+                        "status_code": entry["status_code"],
+                        "attempts": entry["attempts"],
+                    }
+                )
+                if entry["error"]:
+                    result["error"] = entry["error"]
+
+        job["counts"] = {
+            status: sum(1 for result in job["results"] if result["status"] == status)
+            for status in ["queued", "success", "failed", "skipped"]
+        }
+        del job["lease_until"]
+        return job
+
+
+def deliver_patient_encounters(patient_id, on_result=None, job_id=None):
+    """
+    Appends the ADT messages of the patient's encounters to the TnT outbox as they
+    are extracted, and returns the result of every message, see
+    `deliver_adt_messages`.
+
+    `on_result` is called with every result as it comes in.
+    """
+    responses = []
+    messages = CronService().iter_adt_messages(patient_id)
+    for result in deliver_adt_messages(messages, job_id):
+        responses.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    skipped = sum(1 for result in responses if result["status"] == "skipped")
+    if skipped:
+        logger.info(f"Skipped {skipped} unchanged ADT messages of patient {patient_id}")
+    return responses
+
+
+def deliver_exported_encounters(workers=None):
+    """
+    Appends the ADT messages of the encounters of the latest bulk export to the
+    TnT outbox, and yields the result of every message, see `deliver_adt_messages`.
+    Raises BulkExportPendingException while there is no export yet.
+    """
+    return deliver_adt_messages(CronService().iter_exported_adt_messages(workers))
+
+
+def deliver_adt_messages(messages, job_id=None):
+    """
+    Appends `(message, error)` pairs, see `CronService.sanitize`, to the TnT
+    outbox and yields the result of every message. The outbox delivers them in the
+    background, a result holds the "outbox_id" of its entry.
+
+    With ADT_CHANGE_DETECTION, a message identical to the last one queued for its
+    hospital stay and hospital is not sent again, its result has the status
+    "skipped", see `queue_adt_message`. An encounter that cannot be sanitized or queued gets a "failed"
+    result, the others are still sent.
+    """
+    digests = get_digest_store() if Config.ADT_CHANGE_DETECTION else None
+    outbox = get_outbox()
+
+    for encounter, error in messages:
+        stay_id = encounter.get("hospital_stay").get("id")
+        result = {
+            "patient_id": encounter.get("patient").get("id"),
+            "hospital_stay_id": stay_id,
+        }
+
+        # one bad encounter fails its own result, the next ones are still sent
+        try:
+            if error is not None:
+                raise error
+            result.update(queue_adt_message(encounter, digests, outbox, job_id))
+        except Exception as e:
+            logger.error(
+                f"Error processing encounter {encounter.get('encounter_id')}: {e}"
+            )
+            traceback.print_exc()
+            result.update({"status": "failed", "error": str(e), "status_code": 400})
+
+        yield result
+
+
+def queue_adt_message(encounter, digests, outbox, job_id=None):
+    """
+    Appends an ADT message to the outbox unless it is unchanged, returns its status.
+
+    A message is unchanged when it is identical to the newest one appended for its
+    hospital stay and hospital, pending or not, or to the last one TnT
+    acknowledged once the outbox no longer has any. Comparing with an older one
+    would skip a revert to it while a newer state is still waiting, leaving TnT
+    on that newer state.
+    """
+    stay_id = encounter.get("hospital_stay").get("id")
+    # one message per hospital, and the messages of an encounter share the stay ID
+    hospital_id = (encounter.get("hospital") or {}).get("id")
+    digest = payload_digest(encounter)
+    if digests is not None:
+        entry = outbox.last_entry(stay_id, hospital_id)
+        if entry is not None:
+            last_digest = entry["digest"]
+        else:
+            last_digest = digests.get(stay_id, hospital_id)
+        if last_digest == digest:
+            return {"status": "skipped", "status_code": None}
+
+    json_request = {
+        "type": "adt",
+        "message_id": None,
+        "payload": encounter,
+        "message_created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "sending_system_id": "EPIC",
+    }
+    outbox_id = outbox.append(json_request, stay_id, hospital_id, digest, job_id)
+    return {"status": "queued", "status_code": None, "outbox_id": outbox_id}
+
+
+_queue = None
+
+
+def get_adt_job_queue():
+    global _queue
+    if _queue is None:
+        _queue = AdtJobQueue(
+            Config.ADT_JOB_DB,
+            workers=Config.ADT_JOB_WORKERS,
+            lease=Config.ADT_JOB_LEASE,
+            retention=Config.ADT_JOB_RETENTION,
+            max_attempts=Config.ADT_JOB_MAX_ATTEMPTS,
+        )
+    return _queue
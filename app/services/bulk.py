@@ -0,0 +1,447 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+from app.services.fhir import FhirService, FhirServiceException
+from app.services.ratelimit import retry_after
+from app.utils.cache import cache_set_many
+from app.utils.iterators import batched
+from app.utils.ndjson import iter_ndjson_file
+
+logger = logging.getLogger(__name__)
+
+
+class BulkExportJobManager(object):
+    """
+    Runs FHIR bulk $export jobs in the background.
+
+    Every job is persisted as a JSON document under `cache/bulk/`, holding its
+    status URL, last X-Progress, manifest and the time of its next poll. A daemon
+    scheduler thread per worker picks up jobs that are due; a non-blocking flock
+    per job makes sure only one worker kicks off or polls a job at a time, and
+    since the state lives on disk a restarted worker resumes polling where the
+    previous one stopped. Network errors, 429 and 5xx responses are retried with
+    an exponential backoff, other errors fail the job. Finished jobs are deleted
+    after `retention` seconds.
+
+    Job statuses: "pending" (not kicked off yet), "in-progress", "completed",
+    "failed".
+    """
+
+    ACTIVE_STATUSES = ["pending", "in-progress"]
+    LATEST_EXPORT = "latest-export.json"
+
+    def __init__(self, directory=None, retention=7 * 24 * 3600, tick=1) -> None:
+        self.directory = directory or os.path.join("cache", "bulk")
+        self.retention = retention
+        self.tick = tick
+        self._pid = None
+        self._purged_at = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def start(self, group_id, types=None, since=None):
+        """
+        Registers a new export job and returns it right away. With `since` (a FHIR
+        instant) only resources changed after it are exported.
+        """
+        now = time.time()
+        job = {
+            "id": str(uuid.uuid4()),
+            "group_id": group_id,
+            "types": types or Config.BULK_EXPORT_TYPES,
+            "since": since,
+            "status": "pending",
+            "status_url": None,
+            "progress": None,
+            "manifest": None,
+            "error": None,
+            "polls": 0,
+            "retries": 0,
+            "created_at": now,
+            "updated_at": now,
+            "next_poll_at": now,
+        }
+        self._save(job)
+        self.ensure_running()
+        self._wakeup.set()
+        return job
+
+    def start_or_get_active(self, group_id, types=None):
+        """Returns the running job for this group and types, starting one if there is none"""
+        types = types or Config.BULK_EXPORT_TYPES
+        # checked and created under one lock, or two workers could both start an export
+        with self._flock(os.path.join(self.directory, "start.lock")):
+            for job in self.list():
+                if (
+                    job["status"] in self.ACTIVE_STATUSES
+                    and job["group_id"] == group_id
+                    and job["types"] == types
+                ):
+                    self.ensure_running()
+                    return job
+
+            # with BULK_EXPORT_INCREMENTAL, only export what changed since the last export
+            since = self.watermark() if Config.BULK_EXPORT_INCREMENTAL else None
+            return self.start(group_id, types, since)
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def list(self):
+        jobs = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and name != self.LATEST_EXPORT:
+                job = self.get(name[: -len(".json")])
+                if job is not None:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda job: job["created_at"])
+
+    def ensure_running(self):
+        """Starts the scheduler thread of this process, if not running yet"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_due_jobs()
+                self._purge_expired()
+            except Exception:
+                logger.exception("Bulk export scheduler failed")
+
+            self._wakeup.wait(self.tick)
+            self._wakeup.clear()
+
+    def purge(self):
+        """
+        Deletes finished jobs older than the retention, with their downloads unless
+        they are still the latest export or within its grace period. Returns how
+        many jobs were removed.
+        """
+        latest = self.latest() or {}
+        in_use = {latest.get("job_id")} | {
+            export["job_id"] for export in latest.get("superseded", [])
+        }
+        removed = 0
+        for job in self.list():
+            if (
+                job["status"] in self.ACTIVE_STATUSES
+                or job["updated_at"] + self.retention > time.time()
+            ):
+                continue
+
+            for extension in [".json", ".lock"]:
+                try:
+                    os.remove(self._path(job["id"], extension))
+                except OSError:
+                    pass
+            if job["id"] not in in_use:
+                shutil.rmtree(self._path(job["id"], ""), ignore_errors=True)
+            removed += 1
+        return removed
+
+    def _purge_expired(self):
+        # at most once an hour per process
+        if self._purged_at + 3600 > time.time():
+            return
+        self._purged_at = time.time()
+        self.purge()
+
+    def run_due_jobs(self):
+        for job in self.list():
+            if (
+                job["status"] in self.ACTIVE_STATUSES
+                and job["next_poll_at"] <= time.time()
+            ):
+                self._step(job["id"])
+
+    @contextmanager
+    def _flock(self, path, blocking=True):
+        """Holds an exclusive flock on `path`, yields False when not blocking and taken"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(
+                    fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _step(self, job_id):
+        with self._flock(self._path(job_id, ".lock"), blocking=False) as locked:
+            if not locked:
+                return  # another worker is handling this job
+
+            # re-read under the lock, another worker may have advanced it meanwhile
+            job = self.get(job_id)
+            if (
+                job is None
+                or job["status"] not in self.ACTIVE_STATUSES
+                or job["next_poll_at"] > time.time()
+            ):
+                return
+
+            try:
+                if job["status"] == "pending":
+                    self._kick_off(job)
+                else:
+                    self._poll(job)
+                job["retries"] = 0
+            except FhirServiceException as e:
+                if e.status_code == 429 or e.status_code >= 500:
+                    self._retry(job, e.message)
+                else:
+                    logger.error(f"Bulk export job {job_id} failed: {e.message}")
+                    job["status"] = "failed"
+                    job["error"] = str(e.message)
+            except Exception as e:
+                # network trouble
+                self._retry(job, e)
+
+            job["updated_at"] = time.time()
+            self._save(job)
+
+    def _retry(self, job, error):
+        """Keeps the job and tries again after an exponential backoff"""
+        job["retries"] = job.get("retries", 0) + 1
+        delay = Config.FHIR_BULK_POLL_INTERVAL * 2 ** min(job["retries"] - 1, 5)
+        logger.warning(
+            f"Bulk export job {job['id']} will be retried in {delay:.0f}s: {error}"
+        )
+        job["error"] = str(error)
+        job["next_poll_at"] = time.time() + delay
+
+    def _kick_off(self, job):
+        fs = FhirService()
+        response = fs.get_group(job["group_id"], job["types"], job.get("since"))
+        job["status"] = "in-progress"
+        job["status_url"] = response.headers.get("Content-Location")
+        job["next_poll_at"] = time.time() + retry_after(
+            response, Config.FHIR_BULK_POLL_INTERVAL
+        )
+
+    def _poll(self, job):
+        fs = FhirService()
+        response = fs.get_bulk_status(job["status_url"])
+        job["polls"] = job["polls"] + 1
+
+        if response.status_code == 202:
+            job["progress"] = response.headers.get("X-Progress")
+            job["next_poll_at"] = time.time() + retry_after(
+                response, Config.FHIR_BULK_POLL_INTERVAL
+            )
+            return
+
+        job["manifest"] = response.json()
+        self.on_complete(job, fs)
+        job["status"] = "completed"
+        job["progress"] = None
+
+    def on_complete(self, job, fs: FhirService):
+        """
+        Downloads every file of the manifest, then publishes them as the latest
+        export, where CronService reads the encounters. Exported Patients and
+        Locations are merged into the cache so extraction does not fetch them one
+        by one.
+
+        An incremental export (`since`) only has the resources changed since the
+        previous one, so its files are merged into the previous export's, see
+        `merge`, and readers still see every resource. The export's
+        transactionTime becomes the watermark the next incremental export starts
+        from; it only moves once the whole export is stored. The files of the
+        export it replaces are kept for BULK_EXPORT_GRACE seconds, for the readers
+        still iterating over them.
+        """
+        files = self.download(job, fs)
+        self.load_resources(files)
+
+        previous = self.latest()
+        if job.get("since") and previous is not None:
+            files = self.merge(previous["files"], files, self._path(job["id"], ""))
+
+        latest = {
+            "job_id": job["id"],
+            "since": job.get("since"),
+            "transaction_time": job["manifest"].get("transactionTime"),
+            "completed_at": time.time(),
+            "files": files,
+            "superseded": [],
+        }
+        if previous and previous["job_id"] != job["id"]:
+            latest["superseded"] = previous.get("superseded", []) + [
+                {"job_id": previous["job_id"], "at": time.time()}
+            ]
+        latest["superseded"] = self._remove_superseded(latest["superseded"])
+        self._write(os.path.join(self.directory, self.LATEST_EXPORT), latest)
+
+    def _remove_superseded(self, superseded):
+        """Deletes the files of exports superseded over BULK_EXPORT_GRACE seconds ago"""
+        kept = []
+        for export in superseded:
+            if export["at"] + Config.BULK_EXPORT_GRACE < time.time():
+                shutil.rmtree(self._path(export["job_id"], ""), ignore_errors=True)
+            else:
+                kept.append(export)
+        return kept
+
+    def download(self, job, fs: FhirService):
+        """
+        Downloads all manifest files concurrently (BULK_DOWNLOAD_WORKERS), each
+        resuming a partial download left by an interrupted attempt.
+
+        Returns:
+            dict: Local file paths per resource type, in manifest order.
+        """
+        directory = self._path(job["id"], "")
+        os.makedirs(directory, exist_ok=True)
+
+        outputs = job["manifest"].get("output", [])
+        paths = [
+            os.path.join(directory, f"{output['type']}-{n}.ndjson")
+            for n, output in enumerate(outputs)
+        ]
+        with ThreadPoolExecutor(max_workers=Config.BULK_DOWNLOAD_WORKERS) as executor:
+            list(
+                executor.map(
+                    lambda args: fs.download_bulk_file(*args),
+                    [(output["url"], path) for output, path in zip(outputs, paths)],
+                )
+            )
+
+        files = {}
+        for output, path in zip(outputs, paths):
+            files.setdefault(output["type"], []).append(path)
+        return files
+
+    def merge(self, previous_files, files, directory):
+        """
+        Merges the files of an incremental export into those of the export before
+        it, by resource type and ID: a changed resource replaces its previous
+        version in place, new resources are appended. Writes one file per type to
+        `directory`, removes the incremental files and returns the merged files.
+
+        A `_since` export does not report deleted resources, they are kept until
+        the next full export (POST /encounter/export?full=true).
+        """
+        merged = {}
+        for resource_type in sorted(set(previous_files) | set(files)):
+            # only the changed resources are held in memory
+            changed = {}
+            for path in files.get(resource_type, []):
+                for resource in iter_ndjson_file(path):
+                    changed[resource["id"]] = resource
+
+            path = os.path.join(directory, f"{resource_type}.ndjson")
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as file:
+                for previous_path in previous_files.get(resource_type, []):
+                    for resource in iter_ndjson_file(previous_path):
+                        resource = changed.pop(resource["id"], resource)
+                        file.write(json.dumps(resource) + "\n")
+                for resource in changed.values():
+                    file.write(json.dumps(resource) + "\n")
+            os.replace(tmp, path)
+            merged[resource_type] = [path]
+
+        for path in sum(files.values(), []):
+            os.remove(path)
+        return merged
+
+    def load_resources(self, files):
+        """
+        Upserts the exported Patients and Locations into the cache, keyed
+        `<type>-<id>`, with the TTLs `cache_ttl` gives their key family.
+        """
+        for resource_type in ["Patient", "Location"]:
+            prefix = resource_type.lower()
+            for path in files.get(resource_type, []):
+                for batch in batched(iter_ndjson_file(path), 500):
+                    cache_set_many({f"{prefix}-{r['id']}": r for r in batch})
+
+    def watermark(self):
+        """transactionTime of the latest completed export, None before the first one"""
+        latest = self.latest()
+        return latest.get("transaction_time") if latest else None
+
+    def latest(self):
+        """The latest completed export: its job, transaction time and local files"""
+        try:
+            with open(os.path.join(self.directory, self.LATEST_EXPORT)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _path(self, job_id, extension=".json"):
+        return os.path.join(self.directory, f"{job_id}{extension}")
+
+    def _save(self, job):
+        self._write(self._path(job["id"]), job)
+
+    def _write(self, path, data):
+        # write-then-rename, a crash never leaves a truncated document behind
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp, path)
+
+
+def exported_files(resource_type):
+    """
+    Local files of `resource_type` from the latest completed export, or None when
+    there is no export younger than BULK_EXPORT_TTL.
+    """
+    latest = get_bulk_export_manager().latest()
+    if latest is None or latest["completed_at"] + Config.BULK_EXPORT_TTL < time.time():
+        return None
+    return latest["files"].get(resource_type, [])
+
+
+# Service Exception Classes
+
+
+class BulkExportPendingException(Exception):
+    """Raised when the requested data is still being exported"""
+
+    status_code = 202
+
+    def __init__(self, job) -> None:
+        super().__init__(f"Bulk export {job['id']} is {job['status']}")
+        self.job = job
+        self.message = str(self)
+
+    def to_dict(self):
+        return {"message": self.message, "job": self.job}
+
+
+_manager = None
+
+
+def get_bulk_export_manager():
+    global _manager
+    if _manager is None:
+        _manager = BulkExportJobManager(retention=Config.BULK_JOB_RETENTION)
+    return _manager
@@ -0,0 +1,198 @@
+import time
+import logging
+import threading
+from collections import deque
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """
+    Per-worker circuit breaker for one upstream (or endpoint family).
+
+    Calls are recorded in a sliding window of `window` seconds. Once it holds at
+    least `min_calls` calls, the circuit opens when the share of failed calls
+    reaches `failure_rate` or the share of calls slower than `slow_call_seconds`
+    reaches `slow_call_rate`. While open, calls are rejected without reaching the
+    upstream. After `open_seconds` the circuit half-opens and lets
+    `half_open_probes` probe calls through: it closes when they all succeed and
+    opens again as soon as one fails.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_rate=0.5,
+        min_calls=10,
+        window=60,
+        slow_call_seconds=10,
+        slow_call_rate=0.8,
+        open_seconds=30,
+        half_open_probes=3,
+    ) -> None:
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self.state = CLOSED
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._calls = deque()  # (time, failed, slow)
+        self._probes = 0  # probes let through while half-open
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go to the upstream now; False counts as a rejected call"""
+        with self._lock:
+            if self.state == OPEN and self.opened_at + self.open_seconds <= time.time():
+                self._transition(HALF_OPEN)
+
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._probes < self.half_open_probes:
+                self._probes += 1
+                return True
+
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Gives back the probe slot of an allowed call that was not made after all"""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probes:
+                self._probes -= 1
+
+    def record(self, failed, duration):
+        """Records the outcome of a call that `allow` let through"""
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        self._transition(CLOSED)
+                return
+            if self.state == OPEN:
+                return  # a call in flight when the circuit opened
+
+            now = time.time()
+            self._calls.append((now, failed, slow))
+            self._expire(now)
+
+            calls = len(self._calls)
+            if calls >= self.min_calls:
+                failures = sum(1 for _, failed, _ in self._calls if failed)
+                slow_calls = sum(1 for _, _, slow in self._calls if slow)
+                if (
+                    failures >= self.failure_rate * calls
+                    or slow_calls >= self.slow_call_rate * calls
+                ):
+                    self._transition(OPEN)
+
+    def _expire(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _transition(self, state):
+        if state == OPEN:
+            self.opened_at = time.time()
+            self.times_opened += 1
+        self.state = state
+        self._probes = 0
+        self._probe_successes = 0
+        if state != HALF_OPEN:
+            self._calls.clear()
+        logger.warning(f"Circuit {self.name} is {state}")
+
+    def retry_after(self):
+        """Seconds until an open circuit half-opens, 0 otherwise"""
+        if self.state != OPEN:
+            return 0
+        return max(self.opened_at + self.open_seconds - time.time(), 0)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.time())
+            calls = len(self._calls)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "failure_rate": (
+                    round(sum(1 for _, failed, _ in self._calls if failed) / calls, 4)
+                    if calls
+                    else 0.0
+                ),
+                "slow_call_rate": (
+                    round(sum(1 for _, _, slow in self._calls if slow) / calls, 4)
+                    if calls
+                    else 0.0
+                ),
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "retry_after": round(self.retry_after(), 1),
+            }
+
+
+def allow_all(breakers):
+    """
+    Asks every breaker to let a call through. Returns the first one that refuses,
+    after giving back the slots of those that allowed it, or None.
+    """
+    for i, breaker in enumerate(breakers):
+        if not breaker.allow():
+            for allowed in breakers[:i]:
+                allowed.release()
+            return breaker
+    return None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+    def __init__(self, breaker) -> None:
+        super().__init__(
+            f"Circuit {breaker.name} is open, retry in {breaker.retry_after():.0f}s"
+        )
+        self.breaker = breaker
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """Returns the circuit breaker of this process registered under `name`"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(
+                    name,
+                    failure_rate=Config.CIRCUIT_FAILURE_RATE,
+                    min_calls=Config.CIRCUIT_MIN_CALLS,
+                    window=Config.CIRCUIT_WINDOW,
+                    slow_call_seconds=Config.CIRCUIT_SLOW_CALL_SECONDS,
+                    slow_call_rate=Config.CIRCUIT_SLOW_CALL_RATE,
+                    open_seconds=Config.CIRCUIT_OPEN_SECONDS,
+                    half_open_probes=Config.CIRCUIT_HALF_OPEN_PROBES,
+                )
+    return breaker
+
+
+def get_circuit_stats():
+    return {name: breaker.stats() for name, breaker in sorted(_breakers.items())}
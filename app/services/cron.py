@@ -1,13 +1,74 @@
-from .fhir import FhirService
 from config import Config
+from .fhir_async import AsyncFhirService
+from .bulk import get_bulk_export_manager, BulkExportPendingException
 from app.repository.epic_encounter import EpicEncounterRepository
 from app.utils.cache import cache_set
-import json
+from app.utils.sanitizers import sanitize_adt_message
+from app.utils.fake_data import randomize_encounter
+from app.utils.iterators import batched, ordered_map
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import threading
+import asyncio
+import logging
+import copy
+import os
+
+logger = logging.getLogger(__name__)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def extract_chunk(encounters):
+    """
+    Extracts a chunk of encounters after reading their Patients and Locations with
+    a few _id searches. Module level, so process pool workers can unpickle it.
+    """
+    EpicEncounterRepository.prefetch_references(encounters)
+    return [
+        EpicEncounterRepository.extract_factory(encounter) for encounter in encounters
+    ]
+
+
+def get_executor(workers):
+    """
+    The extraction pool of this process for `workers` workers, created on first
+    use and reused by every later extraction.
+    """
+    key = (Config.EXTRACTION_EXECUTOR, workers)
+    with _executors_lock:
+        executor, pid = _executors.get(key, (None, None))
+        if executor is None or pid != os.getpid():
+            if Config.EXTRACTION_EXECUTOR == "thread":
+                executor = ThreadPoolExecutor(max_workers=workers)
+            else:
+                # spawned, not forked: a fork would copy the locks held by this worker's threads
+                executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            _executors[key] = (executor, os.getpid())
+        return executor
+
+
+def in_uwsgi():
+    """Whether this process is a uWSGI worker, where sys.executable is not python"""
+    try:
+        import uwsgi  # only importable inside uWSGI
+    except ImportError:
+        return False
+    return True
 
 
 class CronService(object):
-    MAX_LISTEN_TRIES = 5
-    data = []
+    """
+    Turns Epic encounters into ADT messages as a pipeline of generators:
+    fetch → extract → sanitize → emit. Every call has its own pipeline, and only
+    the batch being extracted is held in memory, so consumers can start posting
+    the first ADT message before the last encounter is extracted.
+    """
+
+    BATCH_SIZE = 50
 
     def __init__(self) -> None:
         pass
@@ -16,21 +77,129 @@ class CronService(object):
         return self.parse_encounters()
 
     def parse_encounters(self):
-        encounters = self.fetch_encounters()
-        for encounter in encounters:
-            encounter_agreegation = EpicEncounterRepository.extract_factory(encounter)
-            if encounter_agreegation:
-                self.data.extend(encounter_agreegation)
+        return list(self.iter_encounters())
+
+    def iter_encounters(self, workers=None):
+        """Yields the ADT messages of the exported encounters"""
+        return self.emit(self.extract_encounters(self.fetch_encounters(), workers))
+
+    def iter_exported_adt_messages(self, workers=None):
+        """
+        Yields `(message, error)` pairs for the exported encounters, the ADT message
+        sanitized for TnT, see `sanitize`.
+        """
+        return self.sanitize(self.iter_encounters(workers))
+
+    def extract_encounters(self, encounters, workers=None):
+        """
+        Yields the aggregation of every encounter, in input order.
+
+        Encounters are extracted in chunks of EXTRACTION_CHUNK_SIZE. With more than
+        one worker (EXTRACTION_WORKERS), chunks are spread over a pool of processes,
+        or of threads with EXTRACTION_EXECUTOR=thread, keeping at most two chunks
+        per worker in flight. The pool is created once per process, see
+        `get_executor`. Inside a uWSGI worker, where spawned children would start
+        the uwsgi binary, the process pool is replaced by in-process extraction;
+        the `cron.py` command runs it outside of uWSGI.
+        """
+        workers = workers if workers is not None else Config.EXTRACTION_WORKERS
+        chunks = batched(encounters, Config.EXTRACTION_CHUNK_SIZE)
+        if workers > 1 and Config.EXTRACTION_EXECUTOR != "thread" and in_uwsgi():
+            logger.warning(
+                "Process pool extraction is not available in uWSGI workers, "
+                "extracting in process"
+            )
+            workers = 1
+
+        if workers <= 1:
+            for chunk in chunks:
+                yield from extract_chunk(chunk)
+            return
 
-        return self.data
+        executor = get_executor(workers)
+        for aggregations in ordered_map(executor, extract_chunk, chunks, workers * 2):
+            yield from aggregations
 
     def parse_partient_encounters(self, patient_id):
-        encounters = self.fetch_patient_encounters(patient_id)
-        for encounter in encounters:
-            encounter_agreegation = EpicEncounterRepository.extract_factory(encounter)
+        return list(self.iter_patient_encounters(patient_id))
+
+    def iter_patient_encounters(self, patient_id):
+        """Yields the ADT messages of a patient's encounters"""
+        return self.emit(
+            self.extract_patient_encounters(self.fetch_patient_encounters(patient_id))
+        )
+
+    def iter_adt_messages(self, patient_id):
+        """
+        Yields `(message, error)` pairs for a patient's encounters, the ADT message
+        sanitized for TnT, see `sanitize`.
+        """
+        return self.sanitize(self.iter_patient_encounters(patient_id))
+
+    def extract_patient_encounters(self, encounters):
+        """Yields the aggregation of every encounter, extracted in bounded batches"""
+        # one event loop and one async client for the whole run, so the batches share
+        # the worker threads and the concurrency/rate limits
+        loop = asyncio.new_event_loop() if Config.FHIR_ASYNC_EXTRACTION else None
+        client = AsyncFhirService() if loop is not None else None
+        try:
+            # encounters arrive page by page, extract them in bounded batches
+            for batch in batched(encounters, CronService.BATCH_SIZE):
+                # the batch's Patients and Locations are read with a few _id searches up front,
+                # only the references those searches did not return are resolved one by one
+                EpicEncounterRepository.prefetch_references(batch)
+                if loop is not None:
+                    yield from loop.run_until_complete(
+                        self.extract_encounters_async(batch, client)
+                    )
+                else:
+                    for encounter in batch:
+                        yield EpicEncounterRepository.extract_factory(encounter)
+        finally:
+            if loop is not None:
+                loop.run_until_complete(loop.shutdown_default_executor())
+                loop.close()
+
+    @staticmethod
+    def emit(aggregations):
+        """Yields the ADT messages of the aggregations, one per hospital stay"""
+        for encounter_agreegation in aggregations:
             if encounter_agreegation:
-                self.data.extend(encounter_agreegation)
-        return self.data
+                yield from encounter_agreegation
+
+    @staticmethod
+    def sanitize(encounters):
+        """
+        Yields `(message, None)` for every ADT message completed and sanitized the
+        way TnT expects it. A message that cannot be sanitized is yielded as
+        `(encounter, exception)` and the next ones still follow.
+        """
+        for encounter in encounters:
+            try:
+                if "hospital" in encounter and isinstance(encounter["hospital"], dict):
+                    encounter["hospital_stay"]["hospital"] = copy.deepcopy(
+                        encounter["hospital"]
+                    )
+                    encounter["hospital"]["abbreviation"] = Config.HOSPITAL_ABBREVIATION
+
+                message = sanitize_adt_message(encounter)
+                if Config.TNT_ENVIRONMENT == "development":
+                    message = randomize_encounter(message)
+            except Exception as e:
+                yield encounter, e
+                continue
+
+            yield message, None
+
+    async def extract_encounters_async(self, encounters, client=None):
+        """Extract encounters concurrently, sharing one concurrency/rate limit, in input order"""
+        client = client if client is not None else AsyncFhirService()
+        return await asyncio.gather(
+            *[
+                EpicEncounterRepository.extract_factory_async(encounter, client)
+                for encounter in encounters
+            ]
+        )
 
     def fetch_encounters(self):
         encounters = EpicEncounterRepository.read_test_data()
@@ -38,54 +207,34 @@ class CronService(object):
             # @TODO check if len is not 0
             return encounters
 
-        fs = FhirService()
-        response = fs.get_group(Config.EPIC_FHIR_GROUP_ID)
-        listen = True
-        tries = 0
-        while listen:
-            res = fs.listen_bulk_request(response.headers.get("Content-Location"))
-            if res is not None and res.strip() not in [""]:
-                obj = json.loads(res)
-                if "output" in obj:
-                    encounter_files = [
-                        entry for entry in obj["output"] if entry["type"] == "Encounter"
-                    ]
-                    encounter_file = encounter_files[0]
-                    e_res = fs.bulk_file_request(encounter_file["url"])
-
-                    parts = e_res.text.split("\r\n")
-
-                    encounters = [
-                        json.loads(p.strip()) for p in parts if p not in [None, ""]
-                    ]
-
-                    # save to file @TODO implement a small database for this
-                    cache_set("encounters", encounters)
-                    return encounters
-
-            tries = tries + 1
-            print(f"No of tries {tries}")
-            if tries > CronService.MAX_LISTEN_TRIES:
-                listen = False
+        # streamed from the local NDJSON export, one encounter in memory at a time
+        encounters = EpicEncounterRepository.read_exported_data()
+        if encounters is not None:
+            return encounters
+
+        # the export runs in the background, its completion writes the local NDJSON export
+        job = get_bulk_export_manager().start_or_get_active(Config.EPIC_FHIR_GROUP_ID)
+        raise BulkExportPendingException(job)
 
     def fetch_patient_encounters(self, patient_id):
-        """Fetches encounters for a specific patient from either test data or live FHIR data."""
+        """Yields encounters for a specific patient from either test data or live FHIR data."""
         # First try to fetch test data if available
         encounters = EpicEncounterRepository.read_patient_test_data(patient_id)
         if encounters:
-            return encounters
+            yield from encounters
+            return
 
-        # If no test data, proceed to fetch from live FHIR service
+        # If no test data, proceed to fetch from live FHIR service, following every Bundle page
         try:
-            # Directly fetch patient encounters using the patient ID
-            encounters = EpicEncounterRepository.read_patient_data(patient_id)
-            encounters = [entry["resource"] for entry in encounters["entry"]]
-            # Cache the results for performance optimization
-            cache_set(f"patient-encounters-{patient_id}", encounters)
-            return encounters
+            fetched = []
+            for encounter in EpicEncounterRepository.read_patient_data(patient_id):
+                # test data is never read back in production, do not keep it in memory there
+                if Config.TNT_ENVIRONMENT != "production":
+                    fetched.append(encounter)
+                yield encounter
+
+            if fetched:
+                cache_set(f"patient-encounters-{patient_id}", fetched)
         except Exception as e:
             # Log and handle errors appropriately
             print(f"Failed to fetch encounters for patient {patient_id}: {str(e)}")
-            return (
-                []
-            )  # Return an empty list or raise an exception as per your error handling policy
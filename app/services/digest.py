@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from config import Config
+
+
+class DigestStore(object):
+    """
+    Remembers, per hospital stay and hospital, the digest of the last ADT message
+    TnT acknowledged, in a SQLite database shared by all workers. Once the outbox
+    no longer has a message of the stay, a message whose digest matches has not
+    changed since it was delivered and need not be sent again. An encounter
+    produces one message per hospital, and those messages may share the hospital
+    stay ID, hence the hospital in the key.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                columns = [
+                    row[1] for row in conn.execute("PRAGMA table_info(adt_digests)")
+                ]
+                if columns and "hospital_id" not in columns:
+                    # keyed by stay only, digests are an optimization: each message is resent once
+                    conn.execute("DROP TABLE adt_digests")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS adt_digests "
+                    "(hospital_stay_id TEXT NOT NULL, hospital_id TEXT NOT NULL, "
+                    "digest TEXT NOT NULL, acknowledged_at REAL NOT NULL, "
+                    "PRIMARY KEY (hospital_stay_id, hospital_id))"
+                )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, hospital_stay_id, hospital_id):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT digest FROM adt_digests WHERE hospital_stay_id = ? "
+                "AND hospital_id = ?",
+                (hospital_stay_id, hospital_id or ""),
+            )
+            .fetchone()
+        )
+        return row[0] if row is not None else None
+
+    def set(self, hospital_stay_id, hospital_id, digest):
+        self.connection().execute(
+            "INSERT INTO adt_digests (hospital_stay_id, hospital_id, digest, "
+            "acknowledged_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(hospital_stay_id, hospital_id) DO UPDATE SET "
+            "digest = excluded.digest, acknowledged_at = excluded.acknowledged_at",
+            (hospital_stay_id, hospital_id or "", digest, time.time()),
+        )
+
+    def delete(self, hospital_stay_id, hospital_id):
+        self.connection().execute(
+            "DELETE FROM adt_digests WHERE hospital_stay_id = ? AND hospital_id = ?",
+            (hospital_stay_id, hospital_id or ""),
+        )
+
+
+def payload_digest(payload):
+    """SHA-256 of the payload serialized canonically (sorted keys, no whitespace)"""
+    raw = json.dumps(
+        payload,
+        sort_keys=True,
+        separators=(",", ":"),
+        default=lambda o: o.to_dict() if hasattr(o, "to_dict") else str(o),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+_store = None
+
+
+def get_digest_store():
+    global _store
+    if _store is None:
+        _store = DigestStore(Config.ADT_DIGEST_DB)
+    return _store
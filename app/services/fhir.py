@@ -1,16 +1,53 @@
+import os
 import jwt
 import time
 import uuid
-import requests
 import urllib.parse
 from config import Config
-import json
+from app.services.http import get_session, get_pool_stats
+from app.services.token import get_token_manager, load_private_key
+from app.services.ratelimit import get_rate_limiter
+from app.services.circuit import CircuitOpenError, get_circuit_breaker
+from app.utils.iterators import prefetch as prefetch_pages
+from app.utils.singleflight import single_flight
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class FhirService(object):
     auth_token = None
 
+    @property
+    def session(self):
+        # shared keep-alive pool, reused by every repository instantiating FhirService
+        return get_session("epic")
+
+    @property
+    def rate_limiter(self):
+        return get_rate_limiter("epic", Config.EPIC_RATE_LIMIT, Config.EPIC_RATE_BURST)
+
+    def send(self, method, url, **kwargs):
+        # fail fast while Epic, or the resource family of the url, keeps failing
+        breakers = [
+            get_circuit_breaker("epic"),
+            get_circuit_breaker(f"epic-{endpoint_family(url)}"),
+        ]
+        try:
+            return self.rate_limiter.send(
+                self.session, method, url, breakers=breakers, **kwargs
+            )
+        except CircuitOpenError as e:
+            raise CircuitOpenException(str(e))
+
+    @staticmethod
+    def pool_stats():
+        return get_pool_stats().get("epic", {})
+
     def authenticate(self):
+        return self.exchange_token().get("access_token")
+
+    def exchange_token(self):
         payload = {
             "iss": Config.EPIC_CLIENT_ID,
             "sub": Config.EPIC_CLIENT_ID,
@@ -19,8 +56,7 @@ class FhirService(object):
             "jti": str(uuid.uuid4()),
         }
 
-        with open(Config.EPIC_API_PRIVATE_KEY_PATH, "r") as key_file:
-            private_key = key_file.read()
+        private_key = load_private_key(Config.EPIC_API_PRIVATE_KEY_PATH)
 
         token = jwt.encode(payload, private_key, algorithm="RS256")
 
@@ -33,19 +69,21 @@ class FhirService(object):
             "scope": "patient/* launch/patient export.any location.read careplan.any",
         }
 
-        response = requests.post(url, headers=headers, data=data)
+        response = self.send("POST", url, headers=headers, data=data)
         if response.status_code != 200:
             raise FhirServiceAuthenticationException(
                 response.content, response.status_code
             )
 
-        res = response.json()
-        return res.get("access_token")
+        return response.json()
 
-    def get_auth_token(self):
-        if self.auth_token is None:
-            self.auth_token = self.authenticate()
+    @property
+    def token_manager(self):
+        # one token per expiry window, shared by all workers
+        return get_token_manager("epic", self.exchange_token)
 
+    def get_auth_token(self):
+        self.auth_token = self.token_manager.get_token()
         return self.auth_token
 
     def get_request_headers(self):
@@ -55,11 +93,17 @@ class FhirService(object):
             "Accept": "application/json",
         }
 
-    def get_request(self, url, headers=None, return_response=False):
+    def get_request(self, url, headers=None, return_response=False, stream=False):
         if headers is None:
             headers = self.get_request_headers()
 
-        response = requests.get(url, headers=headers)
+        response = self.send("GET", url, headers=headers, stream=stream)
+        if response.status_code == 401 and "Authorization" in headers:
+            # the shared token was revoked or expired early, exchange it once and retry
+            self.token_manager.invalidate(self.auth_token)
+            headers["Authorization"] = f"Bearer {self.get_auth_token()}"
+            response = self.send("GET", url, headers=headers, stream=stream)
+
         if response.status_code == 200 or response.status_code == 202:
             return response if return_response else response.json()
         else:
@@ -68,6 +112,74 @@ class FhirService(object):
                 response.status_code,
             )
 
+    def iter_bundle_pages(self, url):
+        """Yields the pages of a search Bundle, following link[relation=next] lazily"""
+        while url:
+            page = self.get_request(url)
+            yield page
+            url = next(
+                (
+                    link.get("url")
+                    for link in page.get("link", [])
+                    if link.get("relation") == "next"
+                ),
+                None,
+            )
+
+    def iter_bundle_entries(self, url, prefetch=False):
+        """
+        Yields the entries matched by a search, one at a time, across all pages.
+
+        Args:
+            url (str): URL of the first page of the search.
+            prefetch (bool): Fetch the next page in the background while the
+                current one is being consumed.
+        """
+        pages = self.iter_bundle_pages(url)
+        if prefetch:
+            pages = prefetch_pages(pages)
+
+        for page in pages:
+            for entry in page.get("entry", []):
+                # skip OperationOutcome entries ("outcome") and _include'd resources
+                if entry.get("search", {}).get("mode", "match") != "match":
+                    continue
+                if "resource" in entry:
+                    yield entry
+
+    def iter_bundle(self, url, prefetch=False):
+        """Yields the resources matched by a search, see `iter_bundle_entries`"""
+        for entry in self.iter_bundle_entries(url, prefetch):
+            yield entry["resource"]
+
+    def search_bundle(self, resource_type, params):
+        """
+        Runs a search and returns a single searchset Bundle holding the matching
+        entries of every page, following link[relation=next].
+        """
+        url = self.search_url(resource_type, params)
+        entries = list(self.iter_bundle_entries(url, prefetch=True))
+        return {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(entries),
+            "entry": entries,
+        }
+
+    def search_url(self, resource_type, params, count=None):
+        filtered_params = {k: v for k, v in params.items() if v not in [None, ""]}
+        count = count if count is not None else Config.FHIR_SEARCH_COUNT
+        if count:
+            filtered_params["_count"] = count
+        qs = urllib.parse.urlencode(filtered_params)
+
+        return f"{Config.EPIC_API_URL}/api/FHIR/R4/{resource_type}?{qs}"
+
+    def iter_search_ids(self, resource_type, ids):
+        """Yields the resources of `resource_type` among `ids`, read with a single `_id` search"""
+        params = {"_id": ",".join(ids)}
+        return self.iter_bundle(self.search_url(resource_type, params, len(ids)))
+
     def get_aggregate_patient_data(self, patient_id):
         patient_data = {}
 
@@ -83,21 +195,29 @@ class FhirService(object):
 
     def get_patient(self, patient_id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Patient/{patient_id}"
-        return self.get_request(url)
+        # concurrent reads of the same resource share one upstream call
+        return single_flight("patient").do(patient_id, lambda: self.get_request(url))
 
     def get_patient_encounters(self, patient_id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Encounter?patient={patient_id}"
         return self.get_request(url)
 
+    def iter_patient_encounters(self, patient_id, count=None, prefetch=False):
+        url = self.search_url("Encounter", {"patient": patient_id}, count)
+        return self.iter_bundle(url, prefetch)
+
     def get_medication_statement(self, patient_id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/STU3/MedicationStatement?patient={patient_id}"
         return self.get_request(url)
 
-    def get_group(self, group_id, _type="Encounter"):
+    def get_group(self, group_id, _type="Encounter", since=None):
         url = (
             f"{Config.EPIC_API_URL}/api/FHIR/R4/Group/{group_id}/$export?_type={_type}"
         )
-        print(url)
+        if since:
+            # incremental export, only resources changed after the watermark
+            url = f"{url}&_since={urllib.parse.quote(since)}"
+        logger.debug(f"Kicking off bulk export {url}")
         headers = self.get_request_headers()
         headers["Prefer"] = "respond-async"
         headers["Accept"] = "application/fhir+json"
@@ -110,43 +230,58 @@ class FhirService(object):
                 response.status_code,
             )
 
-    def listen_bulk_request(self, location):
-        print(location)
-        time.sleep(10)
-        response = self.get_request(location, return_response=True)
-        if response.status_code in [200, 202]:
-            print(response.headers)
-            print("\n\n===\n")
-            if "Searched 0" in response.headers.get("X-Progress", ""):
-                return None
+    def get_bulk_status(self, location):
+        """Polls a bulk export status URL, returning the 202 (in progress) or 200 (manifest) response"""
+        return self.get_request(location, return_response=True)
+
+    def download_bulk_file(self, url, path, chunk_size=65536):
+        """
+        Downloads a bulk export file to `path`. The body is written as received,
+        gzip compressed when BULK_DOWNLOAD_GZIP is set, to `path`.part first; an
+        interrupted download is resumed from there with an HTTP Range request.
+        """
+        if os.path.exists(path):
+            return path
+
+        part = f"{path}.part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+        headers = self.get_request_headers()
+        headers["Accept"] = "application/fhir+ndjson"
+        headers["Accept-Encoding"] = "gzip" if Config.BULK_DOWNLOAD_GZIP else "identity"
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        response = self.send("GET", url, headers=headers, stream=True)
+        try:
+            if response.status_code == 416 and offset:
+                pass  # the previous attempt already received everything
+            elif response.status_code in [200, 206]:
+                # a server ignoring Range answers 200 with the whole file
+                mode = "ab" if response.status_code == 206 else "wb"
+                with open(part, mode) as file:
+                    for chunk in response.raw.stream(chunk_size, decode_content=False):
+                        file.write(chunk)
             else:
-                return response.text
-        else:
-            raise FhirServiceApiException(
-                f"Error fetching data from {response.url}: {response.status_code}. {response.content}",
-                response.status_code,
-            )
+                raise FhirServiceApiException(
+                    f"Error fetching data from {response.url}: {response.status_code}. {response.content}",
+                    response.status_code,
+                )
+        finally:
+            response.close()
 
-    def bulk_file_request(self, url):
-        return self.get_request(url, return_response=True)
+        os.replace(part, path)
+        return path
 
     def search_encounter(self, params):
-        filtered_params = {k: v for k, v in params.items() if v not in [None, ""]}
-        qs = urllib.parse.urlencode(filtered_params)
-
-        url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Encounter?{qs}"
-        return self.get_request(url)
+        return self.search_bundle("Encounter", params)
 
     def get_encounter(self, encouter, params=None):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Encounter/{encouter}"
         return self.get_request(url)
 
     def search_organization(self, params):
-        filtered_params = {k: v for k, v in params.items() if v not in [None, ""]}
-        qs = urllib.parse.urlencode(filtered_params)
-
-        url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Organization?{qs}"
-        return self.get_request(url)
+        return self.search_bundle("Organization", params)
 
     def get_organization(self, id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Organization/{id}"
@@ -154,18 +289,27 @@ class FhirService(object):
 
     def get_location(self, id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/Location/{id}"
-        return self.get_request(url)
+        return single_flight("location").do(id, lambda: self.get_request(url))
 
     def search_careplan(self, params):
-        filtered_params = {k: v for k, v in params.items() if v not in [None, ""]}
-        qs = urllib.parse.urlencode(filtered_params)
-
-        url = f"{Config.EPIC_API_URL}/api/FHIR/R4/CarePlan?{qs}"
-        return self.get_request(url)
+        return self.search_bundle("CarePlan", params)
 
     def get_careplan(self, id):
         url = f"{Config.EPIC_API_URL}/api/FHIR/R4/CarePlan/{id}"
-        return self.get_request(url)
+        return single_flight("careplan").do(id, lambda: self.get_request(url))
+
+
+# resource types with a circuit breaker of their own, any other url shares "epic-other"
+ENDPOINT_FAMILIES = ["Patient", "Location", "Encounter", "CarePlan"]
+
+
+def endpoint_family(url):
+    """The resource type a FHIR url is about, e.g. Location for .../R4/Location/123"""
+    segments = urllib.parse.urlsplit(url).path.split("/")
+    for previous, segment in zip(segments, segments[1:]):
+        if previous in ("R4", "STU3", "DSTU2") and segment in ENDPOINT_FAMILIES:
+            return segment
+    return "other"
 
 
 # Service Exception Classes
@@ -190,3 +334,7 @@ class FhirServiceAuthenticationException(FhirServiceException):
 
 class FhirServiceApiException(FhirServiceException):
     pass
+
+
+class CircuitOpenException(FhirServiceApiException):
+    status_code = 503
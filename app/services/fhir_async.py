@@ -0,0 +1,53 @@
+import time
+import asyncio
+from config import Config
+from app.services.fhir import FhirService
+
+
+class AsyncFhirService(object):
+    """
+    asyncio client for the Epic FHIR API.
+
+    Calls are dispatched to worker threads that share the pooled session and the
+    access token of the sync `FhirService`, so awaiting many of them with
+    `asyncio.gather` resolves them concurrently. `max_concurrency` bounds the
+    number of requests in flight and `max_rate` the number of requests started
+    per second.
+    """
+
+    def __init__(self, max_concurrency=None, max_rate=None, fhir_service=None) -> None:
+        self.fs = fhir_service if fhir_service is not None else FhirService()
+        self.semaphore = asyncio.Semaphore(
+            max_concurrency or Config.FHIR_ASYNC_MAX_CONCURRENCY
+        )
+        self.interval = 1 / (max_rate or Config.FHIR_ASYNC_MAX_RATE)
+        self._next_start = 0
+        self._rate_lock = asyncio.Lock()
+
+    async def _throttle(self):
+        async with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_start - now
+            self._next_start = max(now, self._next_start) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def call(self, fn, *args, **kwargs):
+        async with self.semaphore:
+            await self._throttle()
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def get_patient(self, patient_id):
+        return await self.call(self.fs.get_patient, patient_id)
+
+    async def get_location(self, id):
+        return await self.call(self.fs.get_location, id)
+
+    async def get_encounter(self, id):
+        return await self.call(self.fs.get_encounter, id)
+
+    async def get_careplan(self, id):
+        return await self.call(self.fs.get_careplan, id)
+
+    async def get_patient_encounters(self, patient_id):
+        return await self.call(self.fs.get_patient_encounters, patient_id)
@@ -0,0 +1,94 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+
+
+class PooledSession(requests.Session):
+    """
+    A requests Session with keep-alive connection pooling and default timeouts.
+
+    Connections opened by one call are returned to the pool and reused by the
+    next call to the same host, so only the first request pays the TCP + TLS
+    handshake.
+    """
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block, timeout) -> None:
+        super().__init__()
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_connections,  # number of hosts kept pooled
+            pool_maxsize=pool_maxsize,  # connections kept alive per host
+            pool_block=pool_block,  # hard per-host limit when True
+        )
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+        self.headers["Connection"] = "keep-alive"
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def pool_stats(self):
+        """
+        Returns, per pooled host, the number of connections opened and the number of
+        requests sent over them. A reuse ratio close to 1 means most requests skipped
+        the handshake.
+        """
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            requests_sent = pool.num_requests
+            connections = pool.num_connections
+            stats[host] = {
+                "connections": connections,
+                "requests": requests_sent,
+                "idle": pool.pool.qsize() if pool.pool is not None else 0,
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+                "reuse_ratio": round(1 - connections / requests_sent, 4)
+                if requests_sent
+                else 0.0,
+            }
+        return stats
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name):
+    """
+    Returns the pooled session registered under `name` for the current process.
+
+    Sessions are keyed by pid as well, so uWSGI workers forked from the master never
+    share sockets inherited from the parent.
+    """
+    key = (name, os.getpid())
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = PooledSession(
+                    pool_connections=Config.HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+                    pool_block=Config.HTTP_POOL_BLOCK,
+                    timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT),
+                )
+                _sessions[key] = session
+    return session
+
+
+def get_pool_stats():
+    """Pool statistics of every session opened by the current process"""
+    pid = os.getpid()
+    return {
+        name: session.pool_stats()
+        for (name, session_pid), session in list(_sessions.items())
+        if session_pid == pid
+    }
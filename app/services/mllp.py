@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from app.services.adt import get_adt_job_queue
+from app.utils.hl7parser import hl7parser, hl7message, hl7messageexception
+
+logger = logging.getLogger(__name__)
+
+# MLLP framing: <VT> message <FS><CR>
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\x0d"
+
+
+class MllpServer(object):
+    """
+    Receives HL7 ADT messages over MLLP (persistent TCP connections) and queues
+    them as ADT jobs, like POST /adtmessage/hl7 does.
+
+    Every message is answered with an ACK once its job is stored: AA when it was
+    queued, AE when it has no patient or could not be stored, AR when it could not
+    be parsed. Senders may pipeline up to `window` messages per connection; ACKs
+    come back in the order the messages arrived. Messages of all connections are
+    stored `batch_size` at a time, in one transaction, off the event loop.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        queue=None,
+        encoding="utf-8",
+        max_message_size=1024 * 1024,
+        batch_size=100,
+        window=100,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.queue = queue or get_adt_job_queue()
+        self.encoding = encoding
+        self.max_message_size = max_message_size
+        self.batch_size = batch_size
+        self.window = window
+        self.stats = {"connections": 0, "accepted": 0, "errors": 0, "rejected": 0}
+        self._pending = []  # (raw message, patient ID, parsed message, future)
+        self._ready = None
+        self._store = None
+
+    async def start(self):
+        """Starts storing messages and listening, returns the asyncio server"""
+        self._ready = asyncio.Event()
+        self._start_store()
+        server = await asyncio.start_server(
+            self.handle, self.host, self.port, limit=self.max_message_size
+        )
+        logger.info(f"MLLP listener on {self.host}:{self.port}")
+        return server
+
+    async def serve_forever(self):
+        server = await self.start()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._store.cancel()
+
+    def _start_store(self):
+        self._store = asyncio.create_task(self._store_pending())
+        self._store.add_done_callback(self._store_done)
+
+    def _store_done(self, task):
+        if task.cancelled():
+            return
+        # without the store task no message would ever be acknowledged again
+        logger.critical(
+            "The MLLP store task stopped, restarting it",
+            exc_info=task.exception(),
+        )
+        self._start_store()
+        self._ready.set()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        self.stats["connections"] += 1
+        acks = asyncio.Queue(maxsize=self.window)
+        sender = asyncio.create_task(self._send_acks(writer, acks))
+        try:
+            while True:
+                try:
+                    frame = await reader.readuntil(END_BLOCK)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial.strip():
+                        logger.warning(f"{peer} closed the connection mid-message")
+                    break
+                except asyncio.LimitOverrunError:
+                    # the stream cannot be resynchronized, the sender has to reconnect
+                    logger.error(
+                        f"{peer} sent a message over {self.max_message_size} bytes"
+                    )
+                    ack = hl7message([]).acknowledgement("AR", "Message too large")
+                    await acks.put(self._answer(ack, "rejected"))
+                    break
+
+                start = frame.find(START_BLOCK)
+                if start < 0:
+                    logger.warning(f"{peer} sent data outside an MLLP frame, skipped")
+                    continue
+                await acks.put(self.receive(frame[start + 1 : -len(END_BLOCK)]))
+        except ConnectionError as e:
+            logger.warning(f"Connection from {peer} lost: {e}")
+        else:
+            # answer the messages still in flight before closing
+            await acks.put(None)
+            await sender
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def _send_acks(self, writer, acks):
+        while True:
+            ack = await acks.get()
+            if ack is None:
+                return
+            # shielded: a connection reset cancels this task, not the stored message's ACK
+            ack = await asyncio.shield(ack)
+            try:
+                writer.write(START_BLOCK + ack.encode(self.encoding) + END_BLOCK)
+                await writer.drain()
+            except ConnectionError:
+                pass  # the reader notices the connection is gone
+
+    def receive(self, payload):
+        """Parses a message and returns a future of its ACK"""
+        raw = payload.decode(self.encoding, errors="replace")
+        try:
+            message = hl7parser.parse(raw)
+        except hl7messageexception as e:
+            return self._answer(
+                hl7message([]).acknowledgement("AR", str(e)), "rejected"
+            )
+
+        patient = message.get_patient()
+        if not patient or not patient["patient_id"]:
+            return self._answer(
+                message.acknowledgement(
+                    "AE", "PID segment not found in the HL7 message"
+                ),
+                "errors",
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((raw, patient["patient_id"], message, future))
+        self._ready.set()
+        return future
+
+    def _answer(self, ack, outcome):
+        self.stats[outcome] += 1
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(ack)
+        return future
+
+    async def _store_pending(self):
+        # group commit: messages arriving while a batch is stored go into the next one
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._pending:
+                batch = self._pending[: self.batch_size]
+                del self._pending[: self.batch_size]
+                try:
+                    await loop.run_in_executor(
+                        None,
+                        self.queue.enqueue_many,
+                        [(raw, patient_id) for raw, patient_id, _, _ in batch],
+                    )
+                except Exception as e:
+                    logger.error(f"Queueing {len(batch)} ADT messages failed: {e}")
+                    self.stats["errors"] += len(batch)
+                    self._acknowledge(batch, "AE", "Could not queue the message")
+                    continue
+
+                self.stats["accepted"] += len(batch)
+                self._acknowledge(batch, "AA")
+
+    def _acknowledge(self, batch, code, text=None):
+        for _, _, message, future in batch:
+            if not future.done():  # skips the ACKs of connections already gone
+                future.set_result(message.acknowledgement(code, text))
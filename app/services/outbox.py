@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import logging
+import threading
+from config import Config
+from app.services.tnt import TnTService
+from app.services.digest import get_digest_store
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """
+    Durable, append-only outbox of ADT messages for TnT, delivered at least once.
+
+    Every message is stored in a SQLite database (WAL mode) before it is sent. A
+    dispatcher thread per worker claims due entries under a lease, delivers them
+    with `TnTService.deliver` (batched and concurrent) and acknowledges them.
+    Messages that failed transiently (429, 5xx or no response) are retried with
+    exponential backoff, without ever giving up; messages TnT rejected (other
+    4xx) are kept as "failed" until `replay` queues them again.
+
+    Messages of the same hospital stay and hospital are delivered in the order
+    they were appended. Once acknowledged, an entry's payload is dropped and the entry
+    itself is deleted after `retention` seconds.
+
+    Entry statuses: "pending", "delivered", "failed".
+    """
+
+    def __init__(
+        self, path, claim_size, lease=300, retention=7 * 24 * 3600, tick=1
+    ) -> None:
+        self.path = path
+        self.claim_size = claim_size
+        self.lease = lease
+        self.retention = retention
+        self.tick = tick
+        self._local = threading.local()
+        self._pid = None
+        self._compacted_at = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT, "
+                "hospital_stay_id TEXT, digest TEXT, message TEXT, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL, status_code INTEGER, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                "next_attempt_at REAL NOT NULL, lease_until REAL, hospital_id TEXT)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(outbox)")]
+            if "hospital_id" not in columns:
+                conn.execute("ALTER TABLE outbox ADD COLUMN hospital_id TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, next_attempt_at)"
+            )
+            conn.execute("DROP INDEX IF EXISTS outbox_stay")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_stay_hospital "
+                "ON outbox (hospital_stay_id, hospital_id, status, id)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(
+        self, json_request, hospital_stay_id, hospital_id, digest=None, job_id=None
+    ):
+        """Persists a message for delivery and returns its entry ID"""
+        now = time.time()
+        cursor = self.connection().execute(
+            "INSERT INTO outbox (job_id, hospital_stay_id, hospital_id, digest, message, "
+            "status, attempts, created_at, updated_at, next_attempt_at) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, ?)",
+            (
+                job_id,
+                hospital_stay_id,
+                hospital_id,
+                digest,
+                json.dumps(json_request),
+                now,
+                now,
+                now,
+            ),
+        )
+        self.ensure_running()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def last_entry(self, hospital_stay_id, hospital_id):
+        """
+        ID, status and digest of the message of the hospital stay and hospital
+        appended last, whatever its status, None when there is none (any more)
+        """
+        row = (
+            self.connection()
+            .execute(
+                "SELECT id, status, digest FROM outbox WHERE hospital_stay_id = ? "
+                "AND hospital_id IS ? ORDER BY id DESC LIMIT 1",
+                (hospital_stay_id, hospital_id),
+            )
+            .fetchone()
+        )
+        return dict(row) if row is not None else None
+
+    def get_many(self, ids):
+        """Status, attempts and last error of the given entries, keyed by ID"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        rows = self.connection().execute(
+            "SELECT id, status, attempts, status_code, error FROM outbox WHERE id IN (%s)"
+            % ",".join("?" * len(ids)),
+            ids,
+        )
+        return {row["id"]: dict(row) for row in rows}
+
+    def claim(self):
+        """
+        Leases up to `claim_size` due entries, at most the oldest pending one per
+        hospital stay and hospital, and returns them oldest first.
+        """
+        conn = self.connection()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, hospital_stay_id, hospital_id, digest, message, attempts "
+                "FROM outbox AS o WHERE status = 'pending' AND next_attempt_at <= ? "
+                "AND (lease_until IS NULL OR lease_until < ?) "
+                "AND id = (SELECT MIN(id) FROM outbox WHERE status = 'pending' "
+                "AND hospital_stay_id IS o.hospital_stay_id "
+                "AND hospital_id IS o.hospital_id) "
+                "ORDER BY id LIMIT ?",
+                (now, now, self.claim_size),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET lease_until = ? WHERE id = ?",
+                [(now + self.lease, row["id"]) for row in rows],
+            )
+        return [dict(row) for row in rows]
+
+    def acknowledge(self, entry, result):
+        """Records the delivery result of a claimed entry"""
+        now = time.time()
+        status_code = result.get("status_code")
+        if result["status"] == "success":
+            # compacted: the payload is not needed once TnT has it
+            self.connection().execute(
+                "UPDATE outbox SET status = 'delivered', message = NULL, attempts = attempts + 1, "
+                "status_code = ?, error = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                (status_code, now, entry["id"]),
+            )
+            if entry["digest"] and entry["hospital_stay_id"]:
+                get_digest_store().set(
+                    entry["hospital_stay_id"], entry["hospital_id"], entry["digest"]
+                )
+            return
+
+        transient = status_code is None or status_code == 429 or status_code >= 500
+        self.connection().execute(
+            "UPDATE outbox SET status = ?, attempts = attempts + 1, status_code = ?, "
+            "error = ?, next_attempt_at = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+            (
+                "pending" if transient else "failed",
+                status_code,
+                result.get("error"),
+                now + retry_delay(entry["attempts"]),
+                now,
+                entry["id"],
+            ),
+        )
+
+    def replay(self, job_id=None):
+        """Queues the failed entries (of one job) again, returns how many"""
+        query = (
+            "UPDATE outbox SET status = 'pending', next_attempt_at = ?, updated_at = ? "
+            "WHERE status = 'failed'"
+        )
+        params = [time.time(), time.time()]
+        if job_id is not None:
+            query += " AND job_id = ?"
+            params.append(job_id)
+
+        count = self.connection().execute(query, params).rowcount
+        self._wakeup.set()
+        return count
+
+    def compact(self):
+        """Deletes delivered entries older than the retention, returns how many"""
+        return (
+            self.connection()
+            .execute(
+                "DELETE FROM outbox WHERE status = 'delivered' AND updated_at < ?",
+                (time.time() - self.retention,),
+            )
+            .rowcount
+        )
+
+    def stats(self):
+        rows = self.connection().execute(
+            "SELECT status, COUNT(*) AS count, MIN(created_at) AS oldest FROM outbox GROUP BY status"
+        )
+        stats = {status: {"count": 0} for status in ["pending", "delivered", "failed"]}
+        for row in rows:
+            stats[row["status"]] = {"count": row["count"], "oldest_at": row["oldest"]}
+        return stats
+
+    def ensure_running(self):
+        """Starts the dispatcher thread of this process, if not running yet"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                delivered = self.dispatch()
+            except Exception:
+                logger.exception("Dispatching the TnT outbox failed")
+                delivered = 0
+
+            if not delivered:
+                self._compact_expired()
+                self._wakeup.wait(self.tick)
+                self._wakeup.clear()
+
+    def dispatch(self):
+        """Delivers one claim of due entries, returns how many were attempted"""
+        entries = self.claim()
+        if not entries:
+            return 0
+
+        messages = [json.loads(entry["message"]) for entry in entries]
+        results = TnTService().deliver(messages)
+        for entry, (_, result) in zip(entries, results):
+            self.acknowledge(entry, result)
+        return len(entries)
+
+    def _compact_expired(self):
+        # when idle, at most once an hour per process
+        if self._compacted_at + 3600 > time.time():
+            return
+        self._compacted_at = time.time()
+        try:
+            self.compact()
+        except sqlite3.Error:
+            pass  # retried on the next idle hour
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at OUTBOX_BACKOFF_MAX"""
+    delay = min(Config.OUTBOX_BACKOFF_MAX, Config.HTTP_BACKOFF_BASE * 2**attempts)
+    return random.uniform(delay / 2, delay)
+
+
+_outbox = None
+
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox(
+            Config.OUTBOX_DB,
+            claim_size=Config.OUTBOX_CLAIM_SIZE,
+            lease=Config.OUTBOX_LEASE,
+            retention=Config.OUTBOX_RETENTION,
+        )
+    return _outbox
@@ -0,0 +1,228 @@
+import os
+import re
+import json
+import time
+import fcntl
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+from config import Config
+from app.services.circuit import CircuitOpenError, allow_all
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = [429, 503]
+
+# a read timeout may come after the server acted on the request, only these are resent
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+
+class SharedTokenBucket(object):
+    """
+    Token bucket whose state lives in a flock-guarded file, so every uWSGI worker
+    draws from the same budget for an upstream host.
+
+    `rate` tokens are added per second up to `capacity`. A Retry-After received by
+    any worker blocks the bucket for all workers until it has elapsed.
+    """
+
+    def __init__(self, path, rate, capacity) -> None:
+        # a bucket that never refills, or never holds a whole token, blocks forever
+        if not rate > 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        if not capacity >= 1:
+            raise ValueError(
+                f"Token bucket capacity must be at least 1, got {capacity}"
+            )
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+
+    def acquire(self):
+        while True:
+            with self._state() as state:
+                now = time.time()
+                blocked_until = state.get("blocked_until", 0)
+                tokens = min(
+                    self.capacity,
+                    state.get("tokens", self.capacity)
+                    + (now - state.get("updated", now)) * self.rate,
+                )
+                state["updated"] = now
+
+                if blocked_until <= now and tokens >= 1:
+                    state["tokens"] = tokens - 1
+                    return
+
+                state["tokens"] = tokens
+                wait = max(blocked_until - now, (1 - tokens) / self.rate)
+            time.sleep(wait)
+
+    def block_for(self, seconds):
+        with self._state() as state:
+            state["blocked_until"] = max(
+                state.get("blocked_until", 0), time.time() + seconds
+            )
+
+    @contextmanager
+    def _state(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = os.read(fd, 4096)
+            try:
+                state = json.loads(raw) if raw else {}
+            except ValueError:
+                state = {}
+
+            yield state
+
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, json.dumps(state).encode("utf-8"))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+class RateLimiter(object):
+    """One shared token bucket per upstream host, plus Retry-After aware retries"""
+
+    def __init__(self, name, rate, capacity, max_retries=None) -> None:
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.max_retries = (
+            max_retries if max_retries is not None else Config.HTTP_MAX_RETRIES
+        )
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(host)
+                if bucket is None:
+                    slug = re.sub(r"[^A-Za-z0-9.-]", "_", host)
+                    bucket = SharedTokenBucket(
+                        os.path.join("cache", f"ratelimit-{self.name}-{slug}.json"),
+                        self.rate,
+                        self.capacity,
+                    )
+                    self._buckets[host] = bucket
+        return bucket
+
+    def send(
+        self, session, method, url, retry_status_codes=None, breakers=(), **kwargs
+    ):
+        """
+        Sends a request once the host's bucket allows it. Responses with a status
+        in `retry_status_codes` (429/503 by default) and connection errors are
+        retried, waiting for the server's Retry-After if given, otherwise for an
+        exponential backoff with full jitter. Timeouts are only retried for
+        idempotent methods, or when the connection could not be established. The
+        last response is returned when retries are exhausted, so callers keep
+        handling the status code themselves.
+
+        Every attempt is recorded in the circuit `breakers`, timed without the
+        wait for the bucket: errors, 5xx responses and a 429 still returned after
+        the last retry count as failures. An attempt a breaker refuses raises
+        CircuitOpenError, also in the middle of the retries.
+        """
+        retry_status_codes = retry_status_codes or RETRY_STATUS_CODES
+        retry_errors = (
+            (requests.ConnectionError, requests.Timeout)
+            if method.upper() in IDEMPOTENT_METHODS
+            else requests.ConnectionError  # includes ConnectTimeout, not ReadTimeout
+        )
+        bucket = self.bucket(url)
+        attempt = 0
+        while True:
+            refused = allow_all(breakers)
+            if refused is not None:
+                raise CircuitOpenError(refused)
+
+            try:
+                bucket.acquire()
+            except BaseException:
+                for breaker in breakers:
+                    breaker.release()
+                raise
+
+            started = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except Exception as e:
+                for breaker in breakers:
+                    breaker.record(True, time.monotonic() - started)
+                if not isinstance(e, retry_errors) or attempt >= self.max_retries:
+                    raise
+                wait = backoff(attempt)
+                logger.warning(f"{method} {url} failed ({e}), retrying in {wait:.1f}s")
+            else:
+                last = (
+                    response.status_code not in retry_status_codes
+                    or attempt >= self.max_retries
+                )
+                failed = response.status_code >= 500 or (
+                    last and response.status_code == 429
+                )
+                for breaker in breakers:
+                    breaker.record(failed, time.monotonic() - started)
+                if last:
+                    return response
+
+                wait = retry_after(response)
+                if wait is not None:
+                    # the server asked every client to hold off, not only this worker
+                    bucket.block_for(wait)
+                else:
+                    wait = backoff(attempt)
+                logger.warning(
+                    f"{method} {url} returned {response.status_code}, retrying in {wait:.1f}s"
+                )
+                # hand the connection back to the pool, a stream=True body is unread
+                response.close()
+
+            attempt = attempt + 1
+            time.sleep(wait)
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(
+        0, min(Config.HTTP_BACKOFF_MAX, Config.HTTP_BACKOFF_BASE * 2**attempt)
+    )
+
+
+def retry_after(response, default=None):
+    """Seconds to wait according to the Retry-After header (delta-seconds or HTTP-date)"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return default
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+_limiters = {}
+
+
+def get_rate_limiter(name, rate, capacity):
+    limiter = _limiters.get(name)
+    if limiter is None:
+        limiter = _limiters.setdefault(name, RateLimiter(name, rate, capacity))
+    return limiter
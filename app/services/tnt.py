@@ -1,7 +1,14 @@
 from flask import current_app as app
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from config import Config
+from app.services.http import get_session
+from app.services.ratelimit import get_rate_limiter
+from app.services.circuit import CircuitOpenError, get_circuit_breaker
+from app.utils.iterators import batched, ordered_map
+import os
 import logging
+import threading
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -26,8 +33,28 @@ logger.addHandler(stream_handler)
 
 
 class TnTService(object):
-    def post_adt_message(self, json_request):
-        url = Config.TNT_RECEIVE_ENDPOINT
+    """
+    Delivers ADT messages to TnT.
+
+    `post_adt_message` posts a single message. `deliver` posts many of them over
+    the pooled "tnt" session, TNT_DELIVERY_CONCURRENCY requests at a time (shared
+    by every caller in the worker), in batches of TNT_BATCH_SIZE messages when a
+    batch endpoint (TNT_BATCH_ENDPOINT) is configured. 429 and transient 5xx
+    responses are retried with backoff; while the "tnt" circuit breaker is open
+    requests fail right away with a 503.
+    """
+
+    RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+    @property
+    def session(self):
+        return get_session("tnt")
+
+    @property
+    def rate_limiter(self):
+        return get_rate_limiter("tnt", Config.TNT_RATE_LIMIT, Config.TNT_RATE_BURST)
+
+    def get_request_headers(self):
         headers = {
             "Content-Type": "application/json",
             "X-Authorization-Scopes": "events.create",  # Add this line
@@ -36,8 +63,24 @@ class TnTService(object):
         # Check if TNT_ACCESS_TOKEN is available, if so, use Bearer token
         if Config.TNT_ENVIRONMENT == "production":
             headers["Authorization"] = f"Bearer {Config.TNT_ACCESS_TOKEN}"
+        return headers
+
+    def send(self, url, payload):
+        # shared per-host token bucket, 429/5xx are retried after Retry-After or a jittered backoff;
+        # while TnT keeps failing, fail fast with a 503 the outbox retries later
+        try:
+            response = self.rate_limiter.send(
+                self.session,
+                "POST",
+                url,
+                retry_status_codes=self.RETRY_STATUS_CODES,
+                breakers=[get_circuit_breaker("tnt")],
+                headers=self.get_request_headers(),
+                json=payload,
+            )
+        except CircuitOpenError as e:
+            raise TnTServiceException(str(e), 503)
 
-        response = requests.post(url, headers=headers, json=json_request)
         logger.info(f"Response from TNT: {response.status_code} - {response.text}")
         if response.status_code > 204:
             raise TnTServiceException(
@@ -46,6 +89,101 @@ class TnTService(object):
 
         return response
 
+    def post_adt_message(self, json_request):
+        return self.send(Config.TNT_RECEIVE_ENDPOINT, json_request)
+
+    def post_adt_messages(self, json_requests):
+        """Posts many ADT messages as one JSON array to the batch endpoint"""
+        return self.send(Config.TNT_BATCH_ENDPOINT, json_requests)
+
+    def deliver(self, json_requests):
+        """
+        Posts every ADT message of the iterable and yields `(json_request, result)`
+        pairs in input order, with at most TNT_DELIVERY_CONCURRENCY requests in
+        flight. A result holds the "status" ("success" or "failed"), the
+        "status_code" and, when failed, the "error".
+        """
+        batch_size = Config.TNT_BATCH_SIZE if Config.TNT_BATCH_ENDPOINT else 1
+        batches = batched(json_requests, max(batch_size, 1))
+        for results in ordered_map(
+            get_delivery_executor(),
+            self._deliver_batch,
+            batches,
+            Config.TNT_DELIVERY_CONCURRENCY,
+        ):
+            yield from results
+
+    def _deliver_batch(self, json_requests):
+        if len(json_requests) > 1:
+            try:
+                response = self.post_adt_messages(json_requests)
+                return [
+                    (json_request, delivery_result(response.status_code))
+                    for json_request in json_requests
+                ]
+            except TnTServiceException as e:
+                if e.status_code >= 500:
+                    return [
+                        (json_request, delivery_result(e.status_code, e))
+                        for json_request in json_requests
+                    ]
+                # a rejected batch may hold a single bad message, post them one by one
+                logger.warning(
+                    f"TnT rejected a batch of {len(json_requests)} ADT messages ({e.status_code}), "
+                    "posting them one by one"
+                )
+            except requests.RequestException as e:
+                return [
+                    (json_request, delivery_result(None, e))
+                    for json_request in json_requests
+                ]
+            except Exception as e:
+                return [
+                    (json_request, delivery_result(400, e))
+                    for json_request in json_requests
+                ]
+
+        results = []
+        for json_request in json_requests:
+            try:
+                response = self.post_adt_message(json_request)
+                results.append((json_request, delivery_result(response.status_code)))
+            except TnTServiceException as e:
+                results.append((json_request, delivery_result(e.status_code, e)))
+            except requests.RequestException as e:
+                # no response at all, the status code stays unknown
+                results.append((json_request, delivery_result(None, e)))
+            except Exception as e:
+                results.append((json_request, delivery_result(400, e)))
+        return results
+
+
+def delivery_result(status_code, error=None):
+    if error is None:
+        return {"status": "success", "status_code": status_code}
+
+    logger.error(f"Posting an ADT message to TnT failed: {error}")
+    return {"status": "failed", "error": str(error), "status_code": status_code}
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_delivery_executor():
+    """Thread pool bounding the concurrent TnT requests of this process"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            # threads do not survive a fork, start a pool per process
+            _executor_pid = os.getpid()
+            _executor = ThreadPoolExecutor(
+                max_workers=Config.TNT_DELIVERY_CONCURRENCY,
+                thread_name_prefix="tnt-delivery",
+            )
+    return _executor
+
 
 class TnTServiceException(Exception):
     def __init__(self, message, status_code=400):
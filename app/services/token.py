@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from cryptography.hazmat.primitives import serialization
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=4)
+def load_private_key(path):
+    """Reads and parses the RS256 signing key once per process"""
+    with open(path, "rb") as key_file:
+        return serialization.load_pem_private_key(key_file.read(), password=None)
+
+
+class TokenManager(object):
+    """
+    Caches an OAuth access token until shortly before it expires.
+
+    The token is kept in memory and mirrored to a small file slot guarded by an
+    exclusive `flock`, so the uWSGI workers of one host share a single token: the
+    first worker to find the slot empty or expiring does the exchange, the others
+    read its result. The token is renewed on demand, from `refresh_margin` seconds
+    before `expires_in` runs out: one thread exchanges while the others keep using
+    the still valid token, so only a missing or expired token blocks a request.
+    """
+
+    def __init__(self, exchange, slot_path, refresh_margin=60) -> None:
+        self.exchange = exchange  # callable returning the /oauth2/token response json
+        self.slot_path = slot_path
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+
+    def get_token(self):
+        if self._is_fresh(self.expires_at):
+            return self.token
+
+        if self._is_valid():
+            # expiring: renewed by whichever thread gets the lock, not waited for
+            if not self._lock.acquire(blocking=False):
+                return self.token
+            try:
+                if not self._is_fresh(self.expires_at):
+                    self._load_or_exchange()
+            except Exception:
+                logger.exception("Renewing the access token failed, still using it")
+            finally:
+                self._lock.release()
+            return self.token
+
+        with self._lock:
+            if not self._is_fresh(self.expires_at):
+                self._load_or_exchange()
+            return self.token
+
+    def invalidate(self, token=None):
+        """Drop the cached token, e.g. after the upstream answered 401 with it"""
+        with self._lock:
+            if token is not None and token != self.token:
+                return  # another thread already replaced it
+            self.token = None
+            self.expires_at = 0
+            with self._slot() as slot:
+                data = self._read_slot(slot)
+                if token is None or data.get("access_token") == token:
+                    self._write_slot(slot, {})
+
+    def _is_fresh(self, expires_at):
+        return self.token is not None and expires_at - self.refresh_margin > time.time()
+
+    def _is_valid(self):
+        return self.token is not None and self.expires_at > time.time()
+
+    def _load_or_exchange(self):
+        with self._slot() as slot:
+            data = self._read_slot(slot)
+            if data.get("expires_at", 0) - self.refresh_margin <= time.time():
+                res = self.exchange()
+                data = {
+                    "access_token": res.get("access_token"),
+                    "expires_at": int(time.time()) + int(res.get("expires_in", 300)),
+                }
+                self._write_slot(slot, data)
+                logger.info("Exchanged a new access token")
+
+        self.token = data["access_token"]
+        self.expires_at = data["expires_at"]
+
+    @contextmanager
+    def _slot(self):
+        fd = os.open(self.slot_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read_slot(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        raw = os.read(fd, 65536)
+        try:
+            return json.loads(raw) if raw else {}
+        except ValueError:
+            return {}
+
+    def _write_slot(self, fd, data):
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, json.dumps(data).encode("utf-8"))
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_token_manager(name, exchange):
+    """Returns the token manager registered under `name` for the current process"""
+    key = (name, os.getpid())
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.get(key)
+            if manager is None:
+                manager = TokenManager(
+                    exchange,
+                    slot_path=os.path.join(Config.TOKEN_SLOT_DIR, f"token-{name}.json"),
+                    refresh_margin=Config.EPIC_TOKEN_REFRESH_MARGIN,
+                )
+                _managers[key] = manager
+    return manager
@@ -1,46 +1,470 @@
 from flask import current_app as app
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
 import os
 import json
+import logging
+import sqlite3
+import threading
 import time, math
 
+logger = logging.getLogger(__name__)
+
+
+class MemoryCache(object):
+    """
+    Bounded, per-process LRU in front of the file cache.
+
+    Entries are kept serialized, so every hit hands out a fresh object that callers
+    may mutate freely. The tier is bounded by entry count and by size in bytes, and
+    an entry never outlives its cache timeout nor `max_ttl` seconds, which bounds
+    how long a worker can miss a value rewritten by another worker.
+    """
+
+    def __init__(self, max_entries, max_bytes, max_ttl) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires, serialized value, stale_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, key, raw, expires, stale_at=None):
+        if len(raw) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (
+                min(expires, time.time() + self.max_ttl),
+                raw,
+                stale_at if stale_at is not None else expires,
+            )
+            self.size += len(raw)
+
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, raw, _ = self._entries.pop(key)
+        self.size -= len(raw)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+memory_cache = MemoryCache(
+    max_entries=Config.CACHE_MEMORY_MAX_ENTRIES,
+    max_bytes=Config.CACHE_MEMORY_MAX_BYTES,
+    max_ttl=Config.CACHE_MEMORY_TTL,
+)
+
+
+class FileCacheBackend(object):
+    """One JSON document per key under cache/"""
+
+    def get(self, key):
+        jsonfile = cache_file(key)
+        if os.path.exists(jsonfile):
+            with open(jsonfile) as file:
+                data = json.load(file)
+            return data["expires"], data["value"], data.get("stale_at", data["expires"])
+
+    def get_many(self, keys):
+        entries = {}
+        for key in keys:
+            try:
+                entry = self.get(key)
+            except:
+                entry = None
+            if entry is not None:
+                entries[key] = entry
+        return entries
+
+    def set(self, key, raw, expires, stale_at):
+        # write-then-rename, readers never see a half written entry
+        path = cache_file(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as file:
+            file.write(
+                '{"expires": %d, "stale_at": %d, "value": %s}'
+                % (expires, stale_at, raw)
+            )
+        os.replace(tmp, path)
+
+    def set_many(self, items):
+        for key, raw, expires, stale_at in items:
+            self.set(key, raw, expires, stale_at)
+
+    def delete(self, key):
+        jsonfile = cache_file(key)
+        if os.path.exists(jsonfile):
+            os.remove(jsonfile)
+
+
+class SqliteCacheBackend(object):
+    """
+    All keys in one SQLite database in WAL mode.
+
+    Writes are single-statement upserts, so concurrent uWSGI workers never see a
+    half written entry, and an index on `expires` lets a background thread sweep
+    expired rows cheaply. Connections are opened per thread and per process.
+    """
+
+    CHUNK_SIZE = 500  # stays below SQLITE_MAX_VARIABLE_NUMBER
+
+    def __init__(self, path, sweep_interval) -> None:
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._sweeper_pid = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires INTEGER NOT NULL, "
+                "stale_at INTEGER)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+            if "stale_at" not in columns:
+                conn.execute("ALTER TABLE cache ADD COLUMN stale_at INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            self._start_sweeper()
+        return conn
+
+    def get(self, key):
+        row = (
+            self.connection()
+            .execute("SELECT expires, value, stale_at FROM cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is not None:
+            return row[0], json.loads(row[1]), row[2] if row[2] is not None else row[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        entries = {}
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i : i + self.CHUNK_SIZE]
+            rows = self.connection().execute(
+                "SELECT key, expires, value, stale_at FROM cache WHERE key IN (%s)"
+                % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            for key, expires, value, stale_at in rows:
+                entries[key] = (
+                    expires,
+                    json.loads(value),
+                    stale_at if stale_at is not None else expires,
+                )
+        return entries
+
+    def set(self, key, raw, expires, stale_at):
+        self.set_many([(key, raw, expires, stale_at)])
+
+    def set_many(self, items):
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO cache (key, value, expires, stale_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, "
+                "expires = excluded.expires, stale_at = excluded.stale_at",
+                items,
+            )
+
+    def delete(self, key):
+        self.connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def sweep(self):
+        """Deletes expired rows, returns how many were removed"""
+        return (
+            self.connection()
+            .execute("DELETE FROM cache WHERE expires < ?", (int(time.time()),))
+            .rowcount
+        )
+
+    def _start_sweeper(self):
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+
+        def sweep_forever():
+            while True:
+                time.sleep(self.sweep_interval)
+                try:
+                    self.sweep()
+                except sqlite3.Error:
+                    pass  # retried on the next interval
+
+        threading.Thread(target=sweep_forever, daemon=True).start()
+
+
+def get_backend():
+    if Config.CACHE_BACKEND == "sqlite":
+        return SqliteCacheBackend(Config.CACHE_SQLITE_PATH, Config.CACHE_SWEEP_INTERVAL)
+    return FileCacheBackend()
+
+
+backend = get_backend()
+
 
 def cache_file(key):
     return os.path.join("cache", "cache-%s.json" % (key,))
 
 
+# cache key prefixes and the family of the keys starting with them, most specific first
+KEY_FAMILIES = [
+    ("negative-", "negative"),
+    ("patient-encounters-", "patient-encounters"),
+    ("patient-", "patient"),
+    ("location-", "location"),
+    ("organization-", "organization"),
+    ("careplan-", "careplan"),
+]
+
+
+def key_family(key):
+    """The family of a cache key, see KEY_FAMILIES, None for keys of no family"""
+    return next(
+        (family for prefix, family in KEY_FAMILIES if key.startswith(prefix)), None
+    )
+
+
+def cache_ttl(key, timeout):
+    """
+    Returns (stale_at, expires) for a new entry. Key families listed in
+    Config.CACHE_TTL_POLICIES use their soft/hard TTLs instead of `timeout`.
+    """
+    now = math.ceil(time.time())
+    policy = Config.CACHE_TTL_POLICIES.get(key_family(key))
+    if policy is None:
+        return now + timeout, now + timeout
+
+    soft, hard = policy
+    return now + soft, now + hard
+
+
 def cache_set(key, value, timeout=9600):
-    jsonfile = cache_file(key)
-    data = {"expires": math.ceil(time.time()) + timeout, "value": value}
+    stale_at, expires = cache_ttl(key, timeout)
 
     try:
-        with open(jsonfile, "w") as file:
-            file.write(json.dumps(data, indent=4))
+        raw = json.dumps(value)
+        backend.set(key, raw, expires, stale_at)
 
+        memory_cache.set(key, raw, expires, stale_at)
         return True
     except:
         return False
 
 
-def cache_get(key):
-    jsonfile = cache_file(key)
+def cache_set_many(values, timeout=9600):
+    """Stores every key/value pair of the `values` dict in one batch"""
     try:
-        if os.path.exists(jsonfile):
-            with open(jsonfile) as file:
-                data = json.load(file)
+        items = []
+        for key, value in values.items():
+            stale_at, expires = cache_ttl(key, timeout)
+            items.append((key, json.dumps(value), expires, stale_at))
+        backend.set_many(items)
 
-            if data["expires"] < time.time():
+        for key, raw, expires, stale_at in items:
+            memory_cache.set(key, raw, expires, stale_at)
+        return True
+    except:
+        return False
+
+
+def cache_get(key, refresh=None):
+    """
+    Returns the cached value of `key`, or None when missing or expired.
+
+    Past its soft TTL (stale-while-revalidate), an entry is still returned when a
+    `refresh` callable is given: the stale value is served immediately and
+    `refresh()` runs in a background worker to store a fresh value. Without
+    `refresh`, stale entries are treated as expired.
+    """
+    entry = memory_cache.get(key)
+    if entry is not None:
+        raw, stale_at = entry
+        value = json.loads(raw)
+    else:
+        try:
+            entry = backend.get(key)
+            if entry is None:
                 return None
 
-            return data["value"]
+            expires, value, stale_at = entry
+            if expires < time.time():
+                return None
+
+            memory_cache.set(key, json.dumps(value), expires, stale_at)
+        except:
+            cache_delete(key)
+            return None
+
+    if stale_at < time.time():
+        if refresh is None:
+            return None
+        revalidate(key, refresh)
+
+    return value
+
+
+def cache_get_stale(key):
+    """
+    Returns the value of `key` whatever its age, or None once the backend dropped
+    it (the SQLite sweeper deletes expired rows). Only for when the upstream cannot
+    be asked, while its circuit is open.
+    """
+    try:
+        entry = backend.get(key)
     except:
-        cache_delete(key)
         return None
+    return entry[1] if entry is not None else None
+
+
+def cache_get_many(keys, refresh=None):
+    """
+    Returns a dict holding the keys found and not expired.
+
+    Like `cache_get`, entries past their soft TTL are only returned when a
+    `refresh` callable is given; it is called with the key, in a background
+    worker, to store a fresh value.
+    """
+    now = time.time()
+    values = {}
+    stale = []
+    missing = []
+    for key in keys:
+        entry = memory_cache.get(key)
+        if entry is None:
+            missing.append(key)
+        else:
+            values[key] = json.loads(entry[0])
+            if entry[1] < now:
+                stale.append(key)
+
+    if missing:
+        for key, (expires, value, stale_at) in backend.get_many(missing).items():
+            if expires >= now:
+                memory_cache.set(key, json.dumps(value), expires, stale_at)
+                values[key] = value
+                if stale_at < now:
+                    stale.append(key)
+
+    for key in stale:
+        if refresh is None:
+            del values[key]
+        else:
+            revalidate(key, lambda key=key: refresh(key))
+
+    return values
+
+
+_revalidating = set()
+_revalidating_lock = threading.Lock()
+_revalidate_executor = None
+_revalidate_pid = None
+
+
+def revalidate(key, refresh):
+    """Refreshes `key` in the background, at most once at a time per key and process"""
+    global _revalidate_executor, _revalidate_pid
+
+    with _revalidating_lock:
+        if key in _revalidating:
+            return
+        _revalidating.add(key)
+        if _revalidate_pid != os.getpid():
+            # worker threads do not survive a fork, start a pool per process
+            _revalidate_pid = os.getpid()
+            _revalidate_executor = ThreadPoolExecutor(
+                max_workers=Config.CACHE_REFRESH_WORKERS,
+                thread_name_prefix="cache-revalidate",
+            )
+
+    def run():
+        try:
+            cache_set(key, refresh())
+        except Exception as e:
+            logger.warning(f"Revalidating {key} failed, serving stale value: {e}")
+        finally:
+            with _revalidating_lock:
+                _revalidating.discard(key)
+
+    _revalidate_executor.submit(run)
 
 
 def cache_delete(key):
-    jsonfile = cache_file(key)
-    if os.path.exists(jsonfile):
-        os.remove(jsonfile)
+    memory_cache.delete(key)
+    backend.delete(key)
+
+
+def negative_cache_set(key, status):
+    """
+    Remembers that fetching `key` failed with `status` (an HTTP status code or
+    "invalid" for an unusable body), for the TTL Config.NEGATIVE_CACHE_TTLS gives
+    that status or its class ("5xx"). Statuses with no or a zero TTL (e.g. 401 or
+    429) are not remembered.
+    """
+    policies = Config.NEGATIVE_CACHE_TTLS
+    ttl = policies.get(str(status))
+    if ttl is None and isinstance(status, int):
+        ttl = policies.get(f"{status // 100}xx")
+
+    if ttl:
+        return cache_set(f"negative-{key}", status, ttl)
+    return False
+
+
+def negative_cache_get(key):
+    """Returns the status remembered by `negative_cache_set`, or None"""
+    return cache_get(f"negative-{key}")
+
+
+def cache_stats():
+    return {"backend": Config.CACHE_BACKEND, "memory": memory_cache.stats()}
 
 
 def get_json_data(jsonfile):
@@ -1,12 +1,28 @@
+import re
+import uuid
+from datetime import datetime
+
+# segment terminators: \r is the standard one, \n and \r\n are accepted as well
+SEGMENT_SEPARATOR = re.compile(r"\r\n|\r|\n")
+
+# field, component, repetition, escape and sub-component separators when MSH has none
+DEFAULT_SEPARATORS = "|^~\\&"
+
+# escape sequences that stand for a separator, by the index of the separator
+ESCAPED_SEPARATORS = {"F": 0, "S": 1, "R": 2, "E": 3, "T": 4}
+
+
 class hl7parser:
     @staticmethod
     def parse(hl7_message):
         """
-        Parses an HL7 message into its constituent segments.
+        Parses an HL7 v2 message into its constituent segments.
 
         This static method takes a raw HL7 message string, removes any leading or trailing
-        whitespace, and splits it into individual segments based on newline characters.
-        It returns an instance of the `hl7message` class with the segments as its attribute.
+        whitespace (including MLLP framing characters), and splits it into individual
+        segments on carriage returns (newlines are accepted as well). The separators are
+        read from MSH-1 and MSH-2, and the segments are indexed by name; their fields are
+        only split when first accessed.
 
         Args:
             hl7_message (str): The raw HL7 message string to be parsed.
@@ -20,42 +36,97 @@ class hl7parser:
         Returns:
             hl7message: An instance of the `hl7message` class with the parsed segments.
 
+        Raises:
+            hl7messageexception: If the MSH segment does not define its separators.
+
 
         Example:
             hl7_message = '''
-            MSH|^~\&|HIS|RIH|EKG|EKG|202309010830||ADT^A01|MSG00001|P|2.3
+            MSH|^~\\&|HIS|RIH|EKG|EKG|202309010830||ADT^A01|MSG00001|P|2.3
             EVN|A01|202309010830|||^KOOL^BILL
             PID|1||123456^^^RIH^MR||DOE^JOHN^A||19800101|M|||123 MAIN ST^^METROPOLIS^IL^62960||555-1234|||M|NON|123456789|987-65-4321
             NK1|1|DOE^JANE|SPOUSE|||||||EC
             PV1|1|I|2000^2012^01||||004777^WHITE^STEPHEN^A|||SUR|||||||004777^WHITE^STEPHEN^A|MED|||||||||||||||||||202309010800
             '''
-            parser = HL7Parser()
-            parsed_message = parser.parse(hl7_message)
-            print(parsed_message.segments)
+            parsed_message = hl7parser.parse(hl7_message)
+            print(parsed_message.get_segments())
 
         """
-        segments = hl7_message.strip().split("\n")
+        segments = [
+            segment.strip()
+            for segment in SEGMENT_SEPARATOR.split(hl7_message.strip())
+            if segment.strip()
+        ]
         return hl7message(segments=segments)
 
 
+def read_separators(msh):
+    """
+    Returns the field, component, repetition, escape and sub-component separators
+    declared by an MSH segment (MSH-1 and MSH-2).
+    """
+    if len(msh) < 5:
+        raise hl7messageexception("The MSH segment does not declare its separators")
+
+    field = msh[3]
+    encoding = msh[4:].split(field, 1)[0]
+    if not encoding or len(encoding) > 4 or field in encoding:
+        raise hl7messageexception(f"Invalid MSH encoding characters: {encoding!r}")
+
+    # trailing encoding characters may be left out, the defaults fill in
+    return field + encoding + DEFAULT_SEPARATORS[1 + len(encoding) :]
+
+
 class hl7message:
-    def __init__(self, segments: list) -> None:
+    def __init__(self, segments: list, separators=None) -> None:
         self.segments = segments
+        if separators is None:
+            msh = next((s for s in segments if s.startswith("MSH")), None)
+            separators = read_separators(msh) if msh else DEFAULT_SEPARATORS
+        self.separators = separators
 
-    def get_segment(self, segment, update=True):
-        if hasattr(self, segment):
-            return getattr(self, segment)
+        # segment name -> positions, built once; segments are parsed on first access
+        self.index = {}
+        for position, segment in enumerate(segments):
+            self.index.setdefault(segment.split(separators[0], 1)[0], []).append(
+                position
+            )
+        self._parsed = {}
 
-        for s in self.segments:
-            if s.startswith(segment):
-                parts = s.split("|")
-                parsed = [p.split("^") for p in parts]
-                if update:
-                    self.__dict__.update({segment: parsed})
-                return parsed
+    def segment(self, segment, occurrence=0):
+        """Returns the `occurrence`-th segment with that name, or None"""
+        positions = self.index.get(segment, [])
+        if occurrence >= len(positions):
+            return None
 
-    def get_segments(self):
-        return self.segments
+        position = positions[occurrence]
+        parsed = self._parsed.get(position)
+        if parsed is None:
+            parsed = self._parsed[position] = hl7segment(
+                self.segments[position], self.separators
+            )
+        return parsed
+
+    def get_segment(self, segment, update=True):
+        """
+        Returns the first segment with that name, or None. Indexing the segment
+        gives the components of the first repetition of a field, so that
+        `get_field(segment, 3, 0)` is the first component of e.g. PID-3.
+        """
+        if not update:
+            positions = self.index.get(segment)
+            if not positions:
+                return None
+            return hl7segment(self.segments[positions[0]], self.separators)
+        return self.segment(segment)
+
+    def get_segments(self, segment=None):
+        """Returns every occurrence of a segment, or all raw segments without a name"""
+        if segment is None:
+            return self.segments
+        return [
+            self.segment(segment, n) for n in range(len(self.index.get(segment, [])))
+        ]
 
     def get_patient(self):
         pid_segment = self.get_segment("PID")
@@ -77,6 +148,173 @@ class hl7message:
         except IndexError:
             return default
 
+    def acknowledgement(self, code="AA", text=None, control_id=None):
+        """
+        Builds the ACK of this message: AA (accepted), AE (application error) or AR
+        (rejected), with the sender and receiver of the MSH swapped.
+        """
+        msh = self.get_segment("MSH") or hl7segment("MSH", self.separators)
+        field = self.separators[0]
+        now = datetime.now().strftime("%Y%m%d%H%M%S")
+        header = [
+            "MSH",
+            self.separators[1:],
+            msh.field(5, 0, default=""),
+            msh.field(6, 0, default=""),
+            msh.field(3, 0, default=""),
+            msh.field(4, 0, default=""),
+            now,
+            "",
+            self.separators[1].join(["ACK", msh.field(9, 1, default=""), "ACK"]),
+            control_id or uuid.uuid4().hex[:20],
+            msh.field(11, 0, default="P"),
+            msh.field(12, 0, default="2.5"),
+        ]
+        ack = ["MSA", code, msh.field(10, 0, default="")]
+        if text:
+            ack.append(self.escape(text))
+        return "\r".join([field.join(header), field.join(ack)]) + "\r"
+
+    def escape(self, value):
+        """Encodes the separators in a value as escape sequences"""
+        escape = self.separators[3]
+        value = value.replace(escape, f"{escape}E{escape}")
+        for sequence, index in ESCAPED_SEPARATORS.items():
+            if sequence != "E":
+                value = value.replace(
+                    self.separators[index], f"{escape}{sequence}{escape}"
+                )
+        return value
+
+
+class hl7segment:
+    """
+    A segment whose fields are split on first access. Fields are numbered as in
+    the HL7 specification: 0 is the segment name and, for MSH, 1 is the field
+    separator and 2 the encoding characters. Values have their escape sequences
+    decoded.
+    """
+
+    def __init__(self, raw, separators=DEFAULT_SEPARATORS) -> None:
+        self.raw = raw
+        self.separators = separators
+        self._fields = None
+        self._components = {}
+
+    @property
+    def name(self):
+        return self.raw.split(self.separators[0], 1)[0]
+
+    @property
+    def fields(self):
+        """The raw (still escaped) fields"""
+        if self._fields is None:
+            fields = self.raw.split(self.separators[0])
+            if fields[0] == "MSH":
+                # MSH-1 is the field separator itself, MSH-2 is not split any further
+                fields.insert(1, self.separators[0])
+            self._fields = fields
+        return self._fields
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, index):
+        components = self._components.get(index)
+        if components is None:
+            value = self.fields[index]
+            if index == 0 or (self.fields[0] == "MSH" and index in (1, 2)):
+                components = [value]
+            else:
+                components = self.split_components(
+                    value.split(self.separators[2], 1)[0]
+                )
+            self._components[index] = components
+        return components
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def __str__(self):
+        return self.raw
+
+    def repetitions(self, index):
+        """
+        The repetitions of a field, each as a list of components. A component with
+        sub-components keeps them joined by the sub-component separator, see
+        `subcomponents`.
+        """
+        return [
+            self.split_components(value)
+            for value in self.fields[index].split(self.separators[2])
+        ]
+
+    def split_components(self, value):
+        components = value.split(self.separators[1])
+        if self.separators[3] not in value:
+            return components
+        # escape sequences never span separators, decoding each component is enough
+        return [self.unescape(component) for component in components]
+
+    def subcomponents(self, index, component=0, repetition=0):
+        """The sub-components of one component of a field"""
+        _, separator, repeat, _, subcomponent = self.separators
+        try:
+            value = (
+                self.fields[index].split(repeat)[repetition].split(separator)[component]
+            )
+        except IndexError:
+            return []
+        return [self.unescape(part) for part in value.split(subcomponent)]
+
+    def field(self, index, component=None, repetition=0, default=None):
+        """
+        Returns the components of a field repetition (the first by default), one
+        of them, or `default` when the segment does not have it.
+        """
+        try:
+            components = (
+                self[index] if repetition == 0 else self.repetitions(index)[repetition]
+            )
+            return components if component is None else components[component]
+        except IndexError:
+            return default
+
+    def unescape(self, value):
+        """Decodes the escape sequences (\\F\\, \\S\\, \\T\\, \\R\\, \\E\\, \\Xhh\\, \\.br\\) of a value"""
+        escape = self.separators[3]
+        if escape not in value:
+            return value
+        return escape_pattern(escape).sub(
+            lambda match: self._unescape(match.group(1), match.group(0)), value
+        )
+
+    def _unescape(self, sequence, original):
+        if sequence in ESCAPED_SEPARATORS:
+            return self.separators[ESCAPED_SEPARATORS[sequence]]
+        if sequence.startswith("X"):
+            try:
+                return bytes.fromhex(sequence[1:]).decode("latin-1")
+            except ValueError:
+                return original
+        if sequence == ".br":
+            return "\r"
+        if sequence in ("H", "N"):
+            return ""  # highlighting on/off carries no data
+        return original
+
+
+_escape_patterns = {}
+
+
+def escape_pattern(escape):
+    pattern = _escape_patterns.get(escape)
+    if pattern is None:
+        pattern = _escape_patterns[escape] = re.compile(
+            re.escape(escape) + "([^" + re.escape(escape) + "]*)" + re.escape(escape)
+        )
+    return pattern
+
 
 class hl7messageexception(Exception):
     pass
@@ -0,0 +1,74 @@
+import queue
+import threading
+from collections import deque
+from itertools import islice
+
+_DONE = object()
+
+
+def prefetch(iterable, depth=1):
+    """
+    Iterates `iterable` in a background thread, keeping up to `depth` items ready
+    ahead of the consumer. Exceptions raised by the producer are re-raised in the
+    consumer; abandoning the iterator stops the producer.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item, error=None):
+        # gives up once the consumer is gone, a full queue would block forever
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except Exception as e:
+            put(_DONE, e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def batched(iterable, size):
+    """Yields lists of at most `size` consecutive items"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def ordered_map(executor, fn, iterable, window):
+    """
+    Like `executor.map(fn, iterable)`, but submits at most `window` items ahead of
+    the consumer instead of the whole iterable at once. Results are yielded in
+    input order.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
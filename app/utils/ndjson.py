@@ -0,0 +1,43 @@
+import gzip
+import json
+
+
+def iter_ndjson_lines(chunks):
+    """
+    Yields the non-empty lines of an NDJSON byte stream given as chunks of any
+    size. Lines may end with "\n" or "\r\n", including a "\r\n" split across
+    two chunks; only one line is held in memory at a time.
+    """
+    pending = b""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line.strip():
+                yield line
+
+    pending = pending.rstrip(b"\r")
+    if pending.strip():
+        yield pending
+
+
+def iter_ndjson(chunks):
+    """Yields the parsed resources of an NDJSON byte stream, one line at a time"""
+    for line in iter_ndjson_lines(chunks):
+        yield json.loads(line)
+
+
+def open_ndjson_file(path):
+    """Opens an NDJSON file for reading bytes, transparently decompressing gzip"""
+    with open(path, "rb") as file:
+        magic = file.read(2)
+    return gzip.open(path, "rb") if magic == b"\x1f\x8b" else open(path, "rb")
+
+
+def iter_ndjson_file(path, chunk_size=65536):
+    """Yields the parsed resources of an NDJSON file, plain or gzip compressed"""
+    with open_ndjson_file(path) as file:
+        yield from iter_ndjson(iter(lambda: file.read(chunk_size), b""))
@@ -0,0 +1,159 @@
+import os
+import copy
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from config import Config
+
+
+class _Call(object):
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key into one upstream call.
+
+    Within a process, followers wait for the leader's call and receive a copy of
+    its result (or its exception). Across uWSGI workers, leaders of the same key
+    serialize on a flock'ed file of that key and write their result into it; for
+    `result_ttl` seconds a worker that waited for the lock reuses that result
+    instead of calling upstream again. Lock files unused for `sweep_after`
+    seconds, and not locked at that time, are removed.
+    """
+
+    def __init__(self, name, shared=True, result_ttl=5, sweep_after=600) -> None:
+        self.name = name
+        self.shared = shared
+        self.result_ttl = result_ttl
+        self.sweep_after = sweep_after
+        self.directory = os.path.join("cache", "singleflight")
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._swept_at = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = self._do_shared(key, fn) if self.shared else fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _do_shared(self, key, fn):
+        digest = hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.name}-{digest}.lock")
+        fd = self._lock_file(path)
+        try:
+            published = self._read(fd)
+            if (
+                published is not None
+                and published["at"] + self.result_ttl >= time.time()
+            ):
+                return published["result"]
+
+            result = fn()
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps({"at": time.time(), "result": result}).encode(), 0)
+            return result
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            self._sweep()
+
+    def _lock_file(self, path):
+        """Opens and locks the lock file at `path`, returns its descriptor"""
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                # only callers of the same key wait here, for as long as fn() runs
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if self._is_linked(fd, path):
+                    return fd
+            except BaseException:
+                os.close(fd)
+                raise
+
+            # swept while waiting for it, callers from now on lock a new file
+            os.close(fd)
+
+    @staticmethod
+    def _is_linked(fd, path):
+        try:
+            return os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _read(self, fd):
+        try:
+            return json.loads(os.pread(fd, os.fstat(fd).st_size, 0) or b"null")
+        except ValueError:
+            return None
+
+    def _sweep(self):
+        now = time.time()
+        if self._swept_at + self.sweep_after > now:
+            return
+        self._swept_at = now
+
+        for name in os.listdir(self.directory):
+            if name.startswith(f"{self.name}-"):
+                path = os.path.join(self.directory, name)
+                try:
+                    fd = os.open(path, os.O_RDWR)
+                except OSError:
+                    continue
+                try:
+                    # a locked file is in use whatever its age, and one removed while
+                    # a caller waits for it is reopened by that caller (_lock_file)
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if (
+                        self._is_linked(fd, path)
+                        and os.fstat(fd).st_mtime + self.sweep_after < now
+                    ):
+                        os.remove(path)
+                except OSError:
+                    pass
+                finally:
+                    os.close(fd)
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def single_flight(name):
+    """Returns the process wide SingleFlight group registered under `name`"""
+    group = _groups.get(name)
+    if group is None:
+        with _groups_lock:
+            group = _groups.get(name)
+            if group is None:
+                group = _groups[name] = SingleFlight(
+                    name,
+                    shared=Config.SINGLE_FLIGHT_SHARED,
+                    result_ttl=Config.SINGLE_FLIGHT_RESULT_TTL,
+                )
+    return group
@@ -0,0 +1,155 @@
+"""
+Benchmarks CronService.extract_encounters on a synthetic bulk export.
+
+Every Patient and Location of the export is cached up front, so the run
+measures extraction itself (dict walking and cache reads), without network
+calls. Usage:
+
+    python -m benchmarks.extraction --encounters 20000 --workers 1,2,4,8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+
+def synthetic_export(directory, encounters, hospitals=4, departments=10, rooms=20):
+    """Writes the Encounter NDJSON file and returns (path, Patients, Locations)"""
+    locations = {}
+    for h in range(hospitals):
+        locations[f"H{h}"] = {
+            "resourceType": "Location",
+            "id": f"H{h}",
+            "name": f"Hospital {h}",
+            "identifier": [{"value": f"TAX{h}", "type": {"coding": [{"code": "TAX"}]}}],
+        }
+        for d in range(departments):
+            locations[f"H{h}D{d}"] = {
+                "resourceType": "Location",
+                "id": f"H{h}D{d}",
+                "name": f"Department {d}",
+                "managingOrganization": {"reference": f"Organization/O{h}"},
+                "partOf": {"reference": f"Location/H{h}"},
+            }
+            for r in range(rooms):
+                locations[f"H{h}D{d}R{r}"] = {
+                    "resourceType": "Location",
+                    "id": f"H{h}D{d}R{r}",
+                    "partOf": {"reference": f"Location/H{h}D{d}"},
+                    "physicalType": {"coding": [{"code": "ro"}]},
+                }
+
+    patients = {}
+    path = os.path.join(directory, "Encounter.ndjson")
+    with open(path, "w") as file:
+        for n in range(encounters):
+            h, d, r = n % hospitals, n % departments, n % rooms
+            patient_id = f"P{n % (encounters // 2 or 1)}"
+            patients[patient_id] = {
+                "resourceType": "Patient",
+                "id": patient_id,
+                "active": True,
+                "name": [{"given": ["Test"], "family": f"Patient {patient_id}"}],
+                "birthDate": "1970-01-01",
+                "gender": "unknown",
+            }
+            encounter = {
+                "resourceType": "Encounter",
+                "id": f"E{n}",
+                "class": {"display": "Inpatient"},
+                "hospitalization": {"dischargeDisposition": {"text": "Home"}},
+                "subject": {"reference": f"Patient/{patient_id}"},
+                "period": {"start": "2024-01-01T08:00:00Z"},
+                "location": [
+                    {
+                        "location": {"reference": f"Location/H{h}D{d}"},
+                        "period": {"start": "2024-01-01T08:00:00Z"},
+                    },
+                    {
+                        "location": {"reference": f"Location/H{h}D{d}R{r}"},
+                        "physicalType": {"coding": [{"code": "ro"}]},
+                    },
+                ],
+            }
+            file.write(json.dumps(encounter) + "\n")
+
+    return path, patients, locations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--encounters", type=int, default=20000)
+    parser.add_argument(
+        "--workers",
+        default=",".join(
+            str(n) for n in [1, 2, 4, 8, 16] if n == 1 or n <= (os.cpu_count() or 1)
+        ),
+        help="comma separated worker counts to compare",
+    )
+    parser.add_argument("--executor", choices=["process", "thread"], default="process")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="extraction-benchmark-")
+    # the app writes its cache and logs relative to the working directory
+    os.makedirs(os.path.join(directory, "cache"))
+    os.makedirs(os.path.join(directory, "logs"))
+    # pool workers inherit the environment, configure them before the app is imported
+    os.environ.update(
+        {
+            "CACHE_BACKEND": "sqlite",
+            "CACHE_SQLITE_PATH": os.path.join(directory, "cache", "cache.db"),
+            "EXTRACTION_EXECUTOR": args.executor,
+            "EXTRACTION_CHUNK_SIZE": str(args.chunk_size),
+        }
+    )
+    sys.path.insert(0, os.getcwd())
+    os.chdir(directory)
+    try:
+        run(args, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run(args, directory):
+    from app.services.cron import CronService
+    from app.utils.cache import cache_set_many
+    from app.utils.iterators import batched
+    from app.utils.ndjson import iter_ndjson_file
+
+    path, patients, locations = synthetic_export(directory, args.encounters)
+    for prefix, resources in [("patient", patients), ("location", locations)]:
+        for batch in batched(resources.values(), 500):
+            cache_set_many({f"{prefix}-{r['id']}": r for r in batch})
+
+    print(
+        f"{args.encounters} encounters, {len(patients)} patients, {len(locations)} locations, "
+        f"{args.executor} pool, chunks of {args.chunk_size}, {os.cpu_count()} cpus"
+    )
+    print(f"{'workers':>8} {'seconds':>9} {'enc/s':>9} {'speedup':>8}")
+
+    baseline = None
+    for workers in [int(n) for n in args.workers.split(",")]:
+        start = time.perf_counter()
+        results = list(
+            CronService().extract_encounters(iter_ndjson_file(path), workers)
+        )
+        elapsed = time.perf_counter() - start
+
+        digest = json.dumps(results, default=vars, sort_keys=True)
+        if baseline is None:
+            baseline = (elapsed, digest)
+        elif digest != baseline[1]:
+            raise SystemExit(f"{workers} workers returned different aggregations")
+
+        print(
+            f"{workers:>8} {elapsed:>9.2f} {args.encounters / elapsed:>9.0f} "
+            f"{baseline[0] / elapsed:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmarks app.utils.hl7parser against the hl7 library on synthetic ADT messages.
+
+Two workloads are timed: parsing alone, and parsing followed by the lookups the
+ADT endpoint makes (the patient from PID, plus the PV1 location). Both parsers
+must extract the same patient IDs. Usage:
+
+    python -m benchmarks.hl7parser --messages 20000 --repeat 3
+"""
+import os
+import sys
+import time
+import argparse
+
+
+def synthetic_messages(count):
+    """ADT^A01 messages with \\r separated segments, repeated segments and fields"""
+    messages = []
+    for n in range(count):
+        messages.append(
+            "\r".join(
+                [
+                    f"MSH|^~\\&|EPIC|HOSP|TNT|TNT|20240101{n % 2400:04d}||ADT^A01^ADT_A01|MSG{n:08d}|P|2.5.1",
+                    f"EVN|A01|20240101{n % 2400:04d}|||^DOE^JOHN",
+                    f"PID|1||P{n}^^^EPIC^MR~{900000 + n}^^^SSA^SS||DOE^JANE^A||19800101|F|||"
+                    f"12 MAIN ST^^METROPOLIS^IL^62960~PO BOX {n}^^METROPOLIS^IL^62960||555-1234|||M",
+                    "NK1|1|DOE^JOHN|SPO|||||||EC",
+                    "NK1|2|DOE^JUNIOR|CHD",
+                    f"PV1|1|I|H{n % 4}D{n % 10}^R{n % 20}^B1||||004777^WHITE^STEPHEN^A|||SUR|||||||"
+                    f"004777^WHITE^STEPHEN^A|MED|E{n}||||||||||||||||||||||||20240101{n % 2400:04d}",
+                    "OBX|1|TX|NOTE||Transfer \\T\\ follow-up\\.br\\planned||||||F",
+                ]
+            )
+        )
+    return messages
+
+
+def with_hl7parser(messages, lookups):
+    from app.utils.hl7parser import hl7parser
+
+    ids = []
+    for raw in messages:
+        message = hl7parser.parse(raw)
+        if lookups:
+            ids.append(message.get_patient()["patient_id"])
+            message.get_segment("PV1").field(3, 0)
+    return ids
+
+
+def with_hl7(messages, lookups):
+    import hl7
+
+    ids = []
+    for raw in messages:
+        message = hl7.parse(raw)
+        if lookups:
+            pid = message.segment("PID")
+            # the fields hl7message.get_patient reads
+            ids.append(str(pid[3][0][0]))
+            " ".join(str(component) for component in pid[5][0])
+            str(pid[7]), str(pid[8])
+            str(message.segment("PV1")[3][0][0])
+    return ids
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs per parser, the best is kept"
+    )
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd())
+    messages = synthetic_messages(args.messages)
+
+    print(f"{args.messages} messages, best of {args.repeat} runs")
+    print(f"{'workload':>12} {'parser':>10} {'seconds':>9} {'msg/s':>9} {'speedup':>8}")
+    for workload, lookups in [("parse", False), ("parse+read", True)]:
+        timings = {}
+        results = {}
+        for name, run in [("hl7", with_hl7), ("hl7parser", with_hl7parser)]:
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results[name] = run(messages, lookups)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best
+
+        if results["hl7"] != results["hl7parser"]:
+            raise SystemExit("hl7parser extracted different patient IDs than hl7")
+
+        for name, elapsed in timings.items():
+            print(
+                f"{workload:>12} {name:>10} {elapsed:>9.3f} {args.messages / elapsed:>9.0f} "
+                f"{timings['hl7'] / elapsed:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
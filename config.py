@@ -1,4 +1,5 @@
-from os import getenv
+from os import getenv, path
+
 
 class Config:
     EPIC_API_URL = getenv("EPIC_API_URL")
@@ -9,6 +10,156 @@ class Config:
     TNT_RECEIVE_ENDPOINT = getenv("TNT_RECEIVE_ENDPOINT")
     TNT_ACCESS_TOKEN = getenv("TNT_ACCESS_TOKEN")
     TNT_ENVIRONMENT = getenv("ENVIRONMENT")
-    
+
     HOSPITAL_ABBREVIATION = getenv("HOSPITAL_ABBREVIATION")
 
+    # Outgoing HTTP connection pool (per uWSGI worker)
+    HTTP_POOL_CONNECTIONS = int(getenv("HTTP_POOL_CONNECTIONS", 10))
+    HTTP_POOL_MAXSIZE = int(getenv("HTTP_POOL_MAXSIZE", 10))
+    HTTP_POOL_BLOCK = getenv("HTTP_POOL_BLOCK", "false").lower() == "true"
+    HTTP_CONNECT_TIMEOUT = float(getenv("HTTP_CONNECT_TIMEOUT", 5))
+    HTTP_READ_TIMEOUT = float(getenv("HTTP_READ_TIMEOUT", 60))
+
+    # Seconds before `expires_in` at which the shared Epic access token is renewed
+    EPIC_TOKEN_REFRESH_MARGIN = int(getenv("EPIC_TOKEN_REFRESH_MARGIN", 60))
+    # Directory of the token slots shared by the workers, the app's cache/ by default
+    TOKEN_SLOT_DIR = getenv(
+        "TOKEN_SLOT_DIR", path.join(path.dirname(path.abspath(__file__)), "cache")
+    )
+
+    # Concurrent resolution of the Patient/Location references of encounters
+    FHIR_ASYNC_EXTRACTION = getenv("FHIR_ASYNC_EXTRACTION", "true").lower() == "true"
+    FHIR_ASYNC_MAX_CONCURRENCY = int(getenv("FHIR_ASYNC_MAX_CONCURRENCY", 8))
+    # requests per second
+    FHIR_ASYNC_MAX_RATE = float(getenv("FHIR_ASYNC_MAX_RATE", 20))
+
+    # Token buckets per upstream host, shared by all workers (requests per second / burst)
+    EPIC_RATE_LIMIT = float(getenv("EPIC_RATE_LIMIT", 10))
+    EPIC_RATE_BURST = int(getenv("EPIC_RATE_BURST", 10))
+    TNT_RATE_LIMIT = float(getenv("TNT_RATE_LIMIT", 10))
+    TNT_RATE_BURST = int(getenv("TNT_RATE_BURST", 10))
+
+    # Retries of 429/503 responses and connection errors
+    HTTP_MAX_RETRIES = int(getenv("HTTP_MAX_RETRIES", 5))
+    HTTP_BACKOFF_BASE = float(getenv("HTTP_BACKOFF_BASE", 0.5))
+    HTTP_BACKOFF_MAX = float(getenv("HTTP_BACKOFF_MAX", 30))
+
+    # Bulk $export status polling interval when the server sends no Retry-After
+    FHIR_BULK_POLL_INTERVAL = float(getenv("FHIR_BULK_POLL_INTERVAL", 10))
+
+    # _count sent with FHIR searches (0 keeps the server default page size)
+    FHIR_SEARCH_COUNT = int(getenv("FHIR_SEARCH_COUNT", 0))
+
+    # Delivery to TnT: concurrent requests per process, optional batch endpoint accepting
+    # a JSON array of ADT messages and messages per batch
+    TNT_DELIVERY_CONCURRENCY = int(getenv("TNT_DELIVERY_CONCURRENCY", 4))
+    TNT_BATCH_ENDPOINT = getenv("TNT_BATCH_ENDPOINT")
+    TNT_BATCH_SIZE = int(getenv("TNT_BATCH_SIZE", 20))
+
+    # Background processing of /adtmessage/hl7: job database, worker threads per process,
+    # seconds before an unfinished job is taken over, seconds finished jobs are kept, and
+    # how many times a job is claimed before it fails
+    ADT_JOB_DB = getenv("ADT_JOB_DB", "cache/jobs.db")
+    ADT_JOB_WORKERS = int(getenv("ADT_JOB_WORKERS", 2))
+    ADT_JOB_LEASE = int(getenv("ADT_JOB_LEASE", 300))
+    ADT_JOB_RETENTION = int(getenv("ADT_JOB_RETENTION", 7 * 24 * 3600))
+    ADT_JOB_MAX_ATTEMPTS = int(getenv("ADT_JOB_MAX_ATTEMPTS", 3))
+
+    # Outbox of ADT messages for TnT: database, entries claimed per dispatch, seconds before an
+    # unacknowledged claim is retried, seconds delivered entries are kept, max retry backoff
+    OUTBOX_DB = getenv("OUTBOX_DB", "cache/outbox.db")
+    OUTBOX_CLAIM_SIZE = int(getenv("OUTBOX_CLAIM_SIZE", 50))
+    OUTBOX_LEASE = int(getenv("OUTBOX_LEASE", 300))
+    OUTBOX_RETENTION = int(getenv("OUTBOX_RETENTION", 7 * 24 * 3600))
+    OUTBOX_BACKOFF_MAX = float(getenv("OUTBOX_BACKOFF_MAX", 600))
+
+    # Circuit breakers per upstream (epic, tnt) and Epic resource type: open when at least
+    # CIRCUIT_MIN_CALLS calls in the last CIRCUIT_WINDOW seconds failed at CIRCUIT_FAILURE_RATE
+    # or took CIRCUIT_SLOW_CALL_SECONDS at CIRCUIT_SLOW_CALL_RATE, half-open with
+    # CIRCUIT_HALF_OPEN_PROBES probe calls after CIRCUIT_OPEN_SECONDS
+    CIRCUIT_FAILURE_RATE = float(getenv("CIRCUIT_FAILURE_RATE", 0.5))
+    CIRCUIT_MIN_CALLS = int(getenv("CIRCUIT_MIN_CALLS", 10))
+    CIRCUIT_WINDOW = float(getenv("CIRCUIT_WINDOW", 60))
+    CIRCUIT_SLOW_CALL_SECONDS = float(getenv("CIRCUIT_SLOW_CALL_SECONDS", 10))
+    CIRCUIT_SLOW_CALL_RATE = float(getenv("CIRCUIT_SLOW_CALL_RATE", 0.8))
+    CIRCUIT_OPEN_SECONDS = float(getenv("CIRCUIT_OPEN_SECONDS", 30))
+    CIRCUIT_HALF_OPEN_PROBES = int(getenv("CIRCUIT_HALF_OPEN_PROBES", 3))
+
+    # MLLP listener (mllp.py) for inbound ADT feeds: address, message encoding, largest
+    # accepted message in bytes, messages queued per transaction
+    MLLP_HOST = getenv("MLLP_HOST", "0.0.0.0")
+    MLLP_PORT = int(getenv("MLLP_PORT", 2575))
+    MLLP_ENCODING = getenv("MLLP_ENCODING", "utf-8")
+    MLLP_MAX_MESSAGE_SIZE = int(getenv("MLLP_MAX_MESSAGE_SIZE", 1024 * 1024))
+    MLLP_BATCH_SIZE = int(getenv("MLLP_BATCH_SIZE", 100))
+
+    # Skip ADT messages identical to the last one queued (or acknowledged) for the hospital stay
+    ADT_CHANGE_DETECTION = getenv("ADT_CHANGE_DETECTION", "true").lower() == "true"
+    ADT_DIGEST_DB = getenv("ADT_DIGEST_DB", "cache/digests.db")
+
+    # Parallel extraction of exported encounters: workers (1 extracts in the calling thread),
+    # "process" (python cron.py, uWSGI workers extract in process) or "thread" pool,
+    # encounters per work unit
+    EXTRACTION_WORKERS = int(getenv("EXTRACTION_WORKERS", 1))
+    EXTRACTION_EXECUTOR = getenv("EXTRACTION_EXECUTOR", "process")
+    EXTRACTION_CHUNK_SIZE = int(getenv("EXTRACTION_CHUNK_SIZE", 200))
+
+    # Seconds a Location stays in the in-memory hierarchy index before it is re-read from the cache
+    LOCATION_INDEX_TTL = int(getenv("LOCATION_INDEX_TTL", 300))
+
+    # IDs per `_id=a,b,c` search when prefetching the Patients/Locations of a batch (0 disables)
+    FHIR_PREFETCH_BATCH_SIZE = int(getenv("FHIR_PREFETCH_BATCH_SIZE", 50))
+
+    # Coalesce concurrent reads of the same Patient/Location/CarePlan, also across workers
+    SINGLE_FLIGHT_SHARED = getenv("SINGLE_FLIGHT_SHARED", "true").lower() == "true"
+    SINGLE_FLIGHT_RESULT_TTL = int(getenv("SINGLE_FLIGHT_RESULT_TTL", 5))
+
+    # In-process LRU tier in front of the cache store (per worker)
+    CACHE_MEMORY_MAX_ENTRIES = int(getenv("CACHE_MEMORY_MAX_ENTRIES", 2048))
+    CACHE_MEMORY_MAX_BYTES = int(getenv("CACHE_MEMORY_MAX_BYTES", 64 * 1024 * 1024))
+    CACHE_MEMORY_TTL = int(getenv("CACHE_MEMORY_TTL", 300))
+
+    # Cache store: "file" (one JSON file per key) or "sqlite" (single WAL database)
+    CACHE_BACKEND = getenv("CACHE_BACKEND", "file")
+    CACHE_SQLITE_PATH = getenv("CACHE_SQLITE_PATH", "cache/cache.db")
+    CACHE_SWEEP_INTERVAL = int(getenv("CACHE_SWEEP_INTERVAL", 300))
+
+    # Stale-while-revalidate (soft, hard) TTLs in seconds per cache key family. Past the
+    # soft TTL the cached value is served while it is refreshed in the background.
+    CACHE_TTL_POLICIES = {
+        "location": (
+            int(getenv("CACHE_LOCATION_SOFT_TTL", 3600)),
+            int(getenv("CACHE_LOCATION_HARD_TTL", 7 * 24 * 3600)),
+        ),
+        "organization": (
+            int(getenv("CACHE_ORGANIZATION_SOFT_TTL", 3600)),
+            int(getenv("CACHE_ORGANIZATION_HARD_TTL", 7 * 24 * 3600)),
+        ),
+    }
+    CACHE_REFRESH_WORKERS = int(getenv("CACHE_REFRESH_WORKERS", 2))
+
+    # Negative caching of failed Patient/Location lookups: seconds per status code or
+    # class, "invalid" for a body without a usable resource, 0 disables
+    NEGATIVE_CACHE_TTLS = {
+        "404": int(getenv("NEGATIVE_CACHE_TTL_404", 3600)),
+        "410": int(getenv("NEGATIVE_CACHE_TTL_404", 3600)),
+        "4xx": int(getenv("NEGATIVE_CACHE_TTL_4XX", 0)),
+        "5xx": int(getenv("NEGATIVE_CACHE_TTL_5XX", 30)),
+        "invalid": int(getenv("NEGATIVE_CACHE_TTL_INVALID", 600)),
+    }
+
+    # Bulk $export: seconds a downloaded export is used before a new one is started,
+    # exported resource types, parallel manifest downloads and their encoding
+    BULK_EXPORT_TTL = int(getenv("BULK_EXPORT_TTL", 9600))
+    BULK_EXPORT_TYPES = getenv("BULK_EXPORT_TYPES", "Encounter,Patient,Location")
+    BULK_DOWNLOAD_WORKERS = int(getenv("BULK_DOWNLOAD_WORKERS", 4))
+    BULK_DOWNLOAD_GZIP = getenv("BULK_DOWNLOAD_GZIP", "true").lower() == "true"
+    # seconds the files of a replaced export are kept for the readers still using them
+    BULK_EXPORT_GRACE = int(getenv("BULK_EXPORT_GRACE", 3600))
+    # seconds finished export jobs are kept
+    BULK_JOB_RETENTION = int(getenv("BULK_JOB_RETENTION", 7 * 24 * 3600))
+
+    # Export only what changed since the last export (_since=<transactionTime>), merged into it by ID
+    BULK_EXPORT_INCREMENTAL = (
+        getenv("BULK_EXPORT_INCREMENTAL", "true").lower() == "true"
+    )
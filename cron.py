@@ -0,0 +1,49 @@
+from dotenv import load_dotenv
+
+# Load environment variables from .env file, before the configuration is read
+load_dotenv()
+
+import sys
+import logging
+import argparse
+from collections import Counter
+from config import Config
+from app.services.adt import deliver_exported_encounters
+from app.services.bulk import BulkExportPendingException
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("cron")
+
+
+def main(argv=None):
+    """
+    Extracts the encounters of the latest bulk export, outside of uWSGI so they
+    can be spread over a process pool, and queues their ADT messages in the TnT
+    outbox the app workers deliver.
+    """
+    parser = argparse.ArgumentParser(description=" ".join(main.__doc__.split()))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=Config.EXTRACTION_WORKERS,
+        help="extraction workers, defaults to EXTRACTION_WORKERS",
+    )
+    args = parser.parse_args(argv)
+
+    counts = Counter()
+    try:
+        for result in deliver_exported_encounters(args.workers):
+            counts[result["status"]] += 1
+    except BulkExportPendingException as pending:
+        logger.info(f"{pending.message}, run again once it completed")
+        return 0
+
+    logger.info(
+        f"{sum(counts.values())} ADT messages: "
+        + ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+from dotenv import load_dotenv
+
+# Load environment variables from .env file, before the configuration is read
+load_dotenv()
+
+import asyncio
+import logging
+from config import Config
+from app.services.mllp import MllpServer
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    server = MllpServer(
+        Config.MLLP_HOST,
+        Config.MLLP_PORT,
+        encoding=Config.MLLP_ENCODING,
+        max_message_size=Config.MLLP_MAX_MESSAGE_SIZE,
+        batch_size=Config.MLLP_BATCH_SIZE,
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,151 @@
+import os
+import time
+import pytest
+from app.services.adt import AdtJobQueue, queue_adt_message
+from app.services.digest import DigestStore
+from app.services.outbox import Outbox
+
+
+def message(state):
+    return {
+        "hospital": {"id": "H1"},
+        "hospital_stay": {"id": "S1", "state": state},
+        "patient": {"id": "P1"},
+    }
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    # entries are inspected, not delivered
+    monkeypatch.setattr(Outbox, "ensure_running", lambda self: None)
+    digests = DigestStore(os.path.join(tmp_path, "digests.db"))
+    outbox = Outbox(os.path.join(tmp_path, "outbox.db"), claim_size=10)
+    monkeypatch.setattr("app.services.outbox.get_digest_store", lambda: digests)
+    return digests, outbox
+
+
+def queue(stores, state):
+    return queue_adt_message(message(state), *stores)["status"]
+
+
+def deliver(outbox):
+    for entry in outbox.claim():
+        outbox.acknowledge(entry, {"status": "success", "status_code": 200})
+
+
+def test_unchanged_messages_are_skipped(stores):
+    _, outbox = stores
+    assert queue(stores, "A") == "queued"
+    assert queue(stores, "A") == "skipped"
+
+    deliver(outbox)
+    assert queue(stores, "A") == "skipped"
+
+
+def test_changed_messages_are_queued(stores):
+    _, outbox = stores
+    assert queue(stores, "A") == "queued"
+    deliver(outbox)
+    assert queue(stores, "B") == "queued"
+    assert queue(stores, "C") == "queued"
+
+
+def test_reverting_while_a_change_is_pending_is_queued(stores):
+    _, outbox = stores
+    assert queue(stores, "A") == "queued"
+    deliver(outbox)
+    # B waits in the outbox, then the encounter goes back to A
+    assert queue(stores, "B") == "queued"
+    assert queue(stores, "A") == "queued"
+
+    deliver(outbox)
+    deliver(outbox)
+    assert outbox.stats()["pending"]["count"] == 0
+    assert queue(stores, "A") == "skipped"
+
+
+def test_acknowledged_digest_is_used_once_the_outbox_is_compacted(stores):
+    _, outbox = stores
+    outbox.retention = -1
+    assert queue(stores, "A") == "queued"
+    deliver(outbox)
+    assert outbox.compact() == 1
+
+    assert queue(stores, "A") == "skipped"
+    assert queue(stores, "B") == "queued"
+
+
+def test_hospitals_of_the_same_stay_are_compared_separately(stores):
+    assert queue(stores, "A") == "queued"
+    other = message("A")
+    other["hospital"] = {"id": "H2"}
+    assert queue_adt_message(other, *stores)["status"] == "queued"
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    # jobs are claimed by the test, not by worker threads
+    monkeypatch.setattr(AdtJobQueue, "ensure_running", lambda self: None)
+    return AdtJobQueue(
+        os.path.join(tmp_path, "adt.db"), workers=1, lease=60, max_attempts=2
+    )
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def test_a_leased_job_is_claimed_again_once_its_lease_ran_out(jobs, clock):
+    job_id = jobs.enqueue("MSH|^~\\&", "P1")["id"]
+    assert jobs.claim()["id"] == job_id
+
+    clock[0] += 59
+    assert jobs.claim() is None
+
+    clock[0] += 2
+    job = jobs.claim()
+    assert job["id"] == job_id
+    assert job["status"] == "running" and job["attempts"] == 2
+
+
+def test_a_job_abandoned_max_attempts_times_fails(jobs, clock):
+    job_id = jobs.enqueue("MSH|^~\\&", "P1")["id"]
+    for _ in range(jobs.max_attempts):
+        assert jobs.claim()["id"] == job_id
+        clock[0] += 61
+
+    assert jobs.claim() is None
+    job = jobs.get(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Abandoned after 2 attempts"
+
+
+def test_recording_results_renews_the_lease(jobs, clock):
+    job_id = jobs.enqueue("MSH|^~\\&", "P1")["id"]
+    jobs.claim()
+
+    clock[0] += 50
+    jobs.record(job_id, [{"status": "queued"}])
+    clock[0] += 50
+    assert jobs.claim() is None
+    assert jobs.get(job_id)["results"] == [{"status": "queued"}]
+
+
+def test_the_heartbeat_keeps_the_lease_until_stopped(tmp_path, monkeypatch):
+    monkeypatch.setattr(AdtJobQueue, "ensure_running", lambda self: None)
+    jobs = AdtJobQueue(os.path.join(tmp_path, "adt.db"), workers=1, lease=0.3)
+    job_id = jobs.enqueue("MSH|^~\\&", "P1")["id"]
+    jobs.claim()
+
+    stop = jobs.heartbeat(job_id)
+    try:
+        time.sleep(0.6)
+        assert jobs.claim() is None
+    finally:
+        stop.set()
+
+    time.sleep(0.4)
+    assert jobs.claim()["attempts"] == 2
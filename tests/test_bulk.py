@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import pytest
+from config import Config
+from app.services import bulk
+from app.services.bulk import BulkExportJobManager
+from app.services.fhir import FhirService, FhirServiceApiException
+from app.utils.ndjson import iter_ndjson_file
+
+
+class FakeFhirService(object):
+    """Serves the manifest files from `exports`, url -> resources"""
+
+    def __init__(self, exports) -> None:
+        self.exports = exports
+
+    def download_bulk_file(self, url, path):
+        with open(path, "w") as file:
+            for resource in self.exports[url]:
+                file.write(json.dumps(resource) + "\n")
+        return path
+
+
+def encounter(id, status="in-progress"):
+    return {"resourceType": "Encounter", "id": id, "status": status}
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # exported Patients and Locations are not cached by these tests
+    monkeypatch.setattr(bulk, "cache_set_many", lambda values: None)
+    return BulkExportJobManager(directory=str(tmp_path))
+
+
+def complete(manager, job_id, exports, since=None):
+    job = {
+        "id": job_id,
+        "since": since,
+        "manifest": {
+            "transactionTime": f"2024-01-0{job_id[-1]}T00:00:00Z",
+            "output": [{"type": url.split("/")[0], "url": url} for url in exports],
+        },
+    }
+    manager.on_complete(job, FakeFhirService(exports))
+    return manager.latest()
+
+
+def read(latest, resource_type):
+    return [
+        resource
+        for path in latest["files"][resource_type]
+        for resource in iter_ndjson_file(path)
+    ]
+
+
+def test_incremental_exports_are_merged_into_the_previous_one(manager):
+    complete(
+        manager,
+        "job1",
+        {
+            "Encounter/1": [encounter("E1"), encounter("E2")],
+            "Encounter/2": [encounter("E3")],
+            "Patient/1": [{"resourceType": "Patient", "id": "P1"}],
+        },
+    )
+    latest = complete(
+        manager,
+        "job2",
+        {"Encounter/1": [encounter("E2", "finished"), encounter("E4")]},
+        since=manager.watermark(),
+    )
+
+    assert latest["since"] == "2024-01-01T00:00:00Z"
+    assert manager.watermark() == "2024-01-02T00:00:00Z"
+    assert read(latest, "Encounter") == [
+        encounter("E1"),
+        encounter("E2", "finished"),
+        encounter("E3"),
+        encounter("E4"),
+    ]
+    # unchanged types are carried over into the new export
+    assert read(latest, "Patient") == [{"resourceType": "Patient", "id": "P1"}]
+    assert all(
+        path.startswith(manager._path("job2", ""))
+        for path in sum(latest["files"].values(), [])
+    )
+
+
+def test_full_exports_replace_the_previous_one(manager):
+    complete(manager, "job1", {"Encounter/1": [encounter("E1"), encounter("E2")]})
+    latest = complete(manager, "job2", {"Encounter/1": [encounter("E3")]})
+
+    assert read(latest, "Encounter") == [encounter("E3")]
+    assert [export["job_id"] for export in latest["superseded"]] == ["job1"]
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None, body=None, chunks=()) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+        self.url = "https://epic/file"
+        self.content = b""
+        self.raw = self
+        self.chunks = chunks
+
+    def json(self):
+        return self.body
+
+    def stream(self, chunk_size, decode_content=True):
+        for chunk in self.chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class PollingFhirService(FakeFhirService):
+    """Answers the kick-off, then the status polls from `statuses`"""
+
+    def __init__(self, exports, statuses) -> None:
+        super().__init__(exports)
+        self.statuses = statuses
+
+    def get_group(self, group_id, types, since=None):
+        return Response(202, {"Content-Location": "https://epic/status/1"})
+
+    def get_bulk_status(self, url):
+        status = self.statuses.pop(0)
+        if isinstance(status, Exception):
+            raise status
+        return status
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def polling(manager, monkeypatch, clock):
+    monkeypatch.setattr(BulkExportJobManager, "ensure_running", lambda self: None)
+    monkeypatch.setattr(Config, "FHIR_BULK_POLL_INTERVAL", 10)
+
+    def serve(*statuses):
+        fs = PollingFhirService({"Encounter/1": [encounter("E1")]}, list(statuses))
+        monkeypatch.setattr(bulk, "FhirService", lambda: fs)
+        return manager.start("G1", "Encounter")["id"]
+
+    return serve
+
+
+def step(manager, clock, job_id):
+    clock[0] = manager.get(job_id)["next_poll_at"]
+    manager.run_due_jobs()
+    return manager.get(job_id)
+
+
+MANIFEST = {
+    "transactionTime": "2024-01-01T00:00:00Z",
+    "output": [{"type": "Encounter", "url": "Encounter/1"}],
+}
+
+
+def test_job_lifecycle(manager, polling, clock):
+    job_id = polling(
+        Response(202, {"X-Progress": "50%", "Retry-After": "30"}),
+        Response(200, body=MANIFEST),
+    )
+    assert manager.get(job_id)["status"] == "pending"
+
+    job = step(manager, clock, job_id)
+    assert job["status"] == "in-progress"
+    assert job["status_url"] == "https://epic/status/1"
+    assert job["next_poll_at"] == clock[0] + 10
+
+    job = step(manager, clock, job_id)
+    assert job["progress"] == "50%"
+    assert job["next_poll_at"] == clock[0] + 30
+
+    job = step(manager, clock, job_id)
+    assert job["status"] == "completed" and job["polls"] == 2
+    assert manager.watermark() == "2024-01-01T00:00:00Z"
+    assert read(manager.latest(), "Encounter") == [encounter("E1")]
+
+
+def test_server_errors_while_polling_are_retried_with_backoff(manager, polling, clock):
+    job_id = polling(
+        FhirServiceApiException("Bad gateway", 502),
+        FhirServiceApiException("Unavailable", 503),
+        Response(200, body=MANIFEST),
+    )
+    step(manager, clock, job_id)
+
+    job = step(manager, clock, job_id)
+    assert job["status"] == "in-progress" and job["retries"] == 1
+    assert job["next_poll_at"] == clock[0] + 10
+    job = step(manager, clock, job_id)
+    assert job["retries"] == 2
+    assert job["next_poll_at"] == clock[0] + 20
+
+    job = step(manager, clock, job_id)
+    assert job["status"] == "completed" and job["retries"] == 0
+
+
+def test_client_errors_while_polling_fail_the_job(manager, polling, clock):
+    job_id = polling(FhirServiceApiException("Gone", 404))
+    step(manager, clock, job_id)
+
+    job = step(manager, clock, job_id)
+    assert job["status"] == "failed" and job["error"] == "Gone"
+
+
+def test_superseded_exports_are_kept_for_the_grace_period(manager, clock, monkeypatch):
+    monkeypatch.setattr(Config, "BULK_EXPORT_GRACE", 3600)
+    complete(manager, "job1", {"Encounter/1": [encounter("E1")]})
+    complete(manager, "job2", {"Encounter/1": [encounter("E2")]})
+    assert os.path.isdir(manager._path("job1", ""))
+
+    clock[0] += 3601
+    latest = complete(manager, "job3", {"Encounter/1": [encounter("E3")]})
+
+    assert not os.path.exists(manager._path("job1", ""))
+    assert os.path.isdir(manager._path("job2", ""))
+    assert [export["job_id"] for export in latest["superseded"]] == ["job2"]
+
+
+def test_an_interrupted_download_is_resumed_with_a_range_request(tmp_path, monkeypatch):
+    requests = []
+    responses = [
+        Response(200, chunks=[b"first ", ConnectionError("reset")]),
+        Response(206, chunks=[b"second"]),
+    ]
+
+    def send(self, method, url, headers=None, **kwargs):
+        requests.append(dict(headers))
+        return responses.pop(0)
+
+    monkeypatch.setattr(FhirService, "send", send)
+    monkeypatch.setattr(FhirService, "get_request_headers", lambda self: {})
+    path = str(tmp_path / "Encounter-0.ndjson")
+
+    with pytest.raises(ConnectionError):
+        FhirService().download_bulk_file("https://epic/file", path)
+    assert not os.path.exists(path)
+
+    assert FhirService().download_bulk_file("https://epic/file", path) == path
+    assert "Range" not in requests[0]
+    assert requests[1]["Range"] == "bytes=6-"
+    with open(path, "rb") as file:
+        assert file.read() == b"first second"
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import pytest
+from config import Config
+from app.utils import cache
+from app.utils.cache import (
+    FileCacheBackend,
+    SqliteCacheBackend,
+    cache_ttl,
+    key_family,
+)
+
+
+@pytest.fixture
+def now(monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: 1000)
+    monkeypatch.setattr(
+        Config,
+        "CACHE_TTL_POLICIES",
+        {"location": (60, 600), "organization": (30, 300)},
+    )
+    return 1000
+
+
+def test_key_families():
+    assert key_family("location-L1") == "location"
+    assert key_family("organization-O1") == "organization"
+    assert key_family("patient-P1") == "patient"
+    assert key_family("patient-encounters-P1") == "patient-encounters"
+    assert key_family("negative-location-L1") == "negative"
+    assert key_family("careplan-38717003-P1") == "careplan"
+    assert key_family("encounters") is None
+    assert key_family("locations-L1") is None
+
+
+def test_policies_give_soft_and_hard_ttls(now):
+    assert cache_ttl("location-L1", 10) == (now + 60, now + 600)
+    assert cache_ttl("organization-O1", 10) == (now + 30, now + 300)
+
+
+def test_other_keys_use_the_timeout(now):
+    assert cache_ttl("patient-P1", 10) == (now + 10, now + 10)
+    # not the patient family, and not a Location for being about one
+    assert cache_ttl("patient-encounters-P1", 10) == (now + 10, now + 10)
+    assert cache_ttl("negative-location-L1", 30) == (now + 30, now + 30)
+
+
+@pytest.fixture
+def sqlite_backend(tmp_path, monkeypatch):
+    # swept by the tests, not by the background thread
+    monkeypatch.setattr(SqliteCacheBackend, "_start_sweeper", lambda self: None)
+    return SqliteCacheBackend(os.path.join(tmp_path, "cache.db"), sweep_interval=300)
+
+
+def test_sqlite_set_upserts(sqlite_backend):
+    sqlite_backend.set("location-L1", json.dumps({"v": 1}), 2000, 1500)
+    sqlite_backend.set("location-L1", json.dumps({"v": 2}), 3000, 2500)
+
+    assert sqlite_backend.get("location-L1") == (3000, {"v": 2}, 2500)
+    count = sqlite_backend.connection().execute("SELECT COUNT(*) FROM cache")
+    assert count.fetchone()[0] == 1
+
+
+def test_sqlite_entries_without_stale_at_are_stale_when_expired(sqlite_backend):
+    sqlite_backend.set("patient-P1", json.dumps("P1"), 2000, None)
+    assert sqlite_backend.get("patient-P1") == (2000, "P1", 2000)
+
+
+def test_sqlite_sweep_deletes_expired_rows_only(sqlite_backend, now):
+    sqlite_backend.set_many(
+        [
+            ("patient-P1", json.dumps("P1"), now - 1, now - 1),
+            ("patient-P2", json.dumps("P2"), now + 60, now + 60),
+        ]
+    )
+
+    assert sqlite_backend.sweep() == 1
+    assert sqlite_backend.get("patient-P1") is None
+    assert sqlite_backend.get("patient-P2") == (now + 60, "P2", now + 60)
+
+
+def test_sqlite_get_many_reads_in_chunks(sqlite_backend, monkeypatch):
+    monkeypatch.setattr(SqliteCacheBackend, "CHUNK_SIZE", 3)
+    sqlite_backend.set_many(
+        [(f"patient-P{n}", json.dumps(n), 2000, 2000) for n in range(10)]
+    )
+
+    keys = [f"patient-P{n}" for n in range(12)]
+    entries = sqlite_backend.get_many(keys)
+
+    assert entries == {f"patient-P{n}": (2000, n, 2000) for n in range(10)}
+
+
+def test_file_set_replaces_the_entry_atomically(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("cache")
+    backend = FileCacheBackend()
+    backend.set("patient-P1", json.dumps("P1"), 2000, 1500)
+    backend.set("patient-P1", json.dumps("P2"), 3000, 2500)
+
+    assert backend.get("patient-P1") == (3000, "P2", 2500)
+    # the temporary file was renamed over the entry
+    assert os.listdir("cache") == [os.path.basename(cache.cache_file("patient-P1"))]
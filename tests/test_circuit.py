@@ -0,0 +1,162 @@
+import json
+import time
+import pytest
+from app.utils import cache
+from app.utils.cache import MemoryCache, cache_get, negative_cache_get
+from app.services import circuit
+from app.services.circuit import (
+    CircuitBreaker,
+    CircuitOpenError,
+    CLOSED,
+    OPEN,
+    HALF_OPEN,
+)
+from app.services.fhir import FhirService, CircuitOpenException
+from app.repository.epic_patient import EpicPatientRepository
+
+
+class Clock(object):
+    def __init__(self) -> None:
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class DictBackend(object):
+    """Keeps expired entries until they are deleted, as the file backend does"""
+
+    def __init__(self) -> None:
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, raw, expires, stale_at):
+        self.entries[key] = (expires, json.loads(raw), stale_at)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("test", min_calls=4, open_seconds=30, half_open_probes=2)
+
+
+def open_circuit(breaker):
+    for _ in range(breaker.min_calls):
+        assert breaker.allow()
+        breaker.record(True, 0.1)
+    assert breaker.state == OPEN
+
+
+def test_closed_until_the_failure_rate_is_reached(breaker):
+    for failed in (True, False, False):
+        assert breaker.allow()
+        breaker.record(failed, 0.1)
+    # below min_calls nothing is decided, then 2 failures out of 4 open it
+    assert breaker.state == CLOSED
+    breaker.record(True, 0.1)
+    assert breaker.state == OPEN
+
+
+def test_slow_calls_open_the_circuit(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(False, breaker.slow_call_seconds)
+    assert breaker.state == OPEN
+
+
+def test_open_circuit_rejects_calls(breaker, clock):
+    open_circuit(breaker)
+
+    clock.now += 10
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+    assert breaker.retry_after() == 20
+    assert str(CircuitOpenError(breaker)) == "Circuit test is open, retry in 20s"
+
+
+def test_half_open_closes_once_the_probes_succeed(breaker, clock):
+    open_circuit(breaker)
+
+    clock.now += 30
+    assert breaker.allow() and breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # only `half_open_probes` calls are let through
+    assert not breaker.allow()
+
+    breaker.record(False, 0.1)
+    assert breaker.state == HALF_OPEN
+    breaker.record(False, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls"] == 0
+
+
+def test_half_open_opens_again_on_a_failed_probe(breaker, clock):
+    open_circuit(breaker)
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+    assert breaker.retry_after() == 30
+
+
+def test_a_released_probe_slot_can_be_reused(breaker, clock):
+    open_circuit(breaker)
+
+    clock.now += 30
+    assert breaker.allow() and breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_allow_all_gives_back_the_slots_of_a_refused_call(clock):
+    first = CircuitBreaker("first", min_calls=1, half_open_probes=1)
+    second = CircuitBreaker("second", min_calls=1)
+    open_circuit(first)
+    open_circuit(second)
+
+    clock.now += 30
+    second.opened_at = clock.now
+    assert circuit.allow_all([first, second]) is second
+    assert first.state == HALF_OPEN
+    assert first.allow()
+
+
+@pytest.fixture
+def patients(monkeypatch, clock):
+    monkeypatch.setattr(cache, "backend", DictBackend())
+    monkeypatch.setattr(cache, "memory_cache", MemoryCache(100, 2**20, 60))
+
+    def get_patient(self, id):
+        raise CircuitOpenException("Circuit epic is open, retry in 30s")
+
+    monkeypatch.setattr(FhirService, "get_patient", get_patient)
+
+
+def test_an_open_circuit_serves_the_stale_value(patients, clock):
+    cache.cache_set("patient-P1", {"id": "P1", "name": [{"text": "DOE"}]}, 60)
+    clock.now += 120
+    assert cache_get("patient-P1") is None
+
+    patient = EpicPatientRepository.fetch_by_id("P1")
+
+    assert patient.id == "P1"
+    assert negative_cache_get("patient-P1") is None
+
+
+def test_an_open_circuit_is_not_negatively_cached(patients):
+    with pytest.raises(CircuitOpenException):
+        EpicPatientRepository.fetch_by_id("P2")
+
+    assert negative_cache_get("patient-P2") is None
@@ -0,0 +1,81 @@
+import time
+import asyncio
+import random
+import threading
+import pytest
+from config import Config
+from app.services import cron
+from app.services.cron import CronService
+
+
+def fake_extract_chunk(chunk):
+    # out of order completion, the results must still come back in input order
+    time.sleep(random.uniform(0, 0.01))
+    return [(n, threading.get_ident()) for n in chunk]
+
+
+@pytest.fixture
+def extraction(monkeypatch):
+    monkeypatch.setattr(Config, "EXTRACTION_CHUNK_SIZE", 3)
+    monkeypatch.setattr(cron, "extract_chunk", fake_extract_chunk)
+    monkeypatch.setattr(cron, "_executors", {})
+
+
+def test_thread_pool_extraction_keeps_input_order(monkeypatch, extraction):
+    monkeypatch.setattr(Config, "EXTRACTION_EXECUTOR", "thread")
+    results = list(CronService().extract_encounters(range(50), workers=4))
+
+    assert [n for n, _ in results] == list(range(50))
+    assert threading.get_ident() not in {thread for _, thread in results}
+
+
+def test_the_pool_is_created_once_per_process(monkeypatch, extraction):
+    monkeypatch.setattr(Config, "EXTRACTION_EXECUTOR", "thread")
+    list(CronService().extract_encounters(range(10), workers=2))
+    executor = cron.get_executor(2)
+    list(CronService().extract_encounters(range(10), workers=2))
+
+    assert cron.get_executor(2) is executor
+    assert len(cron._executors) == 1
+
+
+def test_uwsgi_workers_extract_in_process(monkeypatch, extraction):
+    monkeypatch.setattr(Config, "EXTRACTION_EXECUTOR", "process")
+    monkeypatch.setattr(cron, "in_uwsgi", lambda: True)
+    results = list(CronService().extract_encounters(range(10), workers=4))
+
+    assert results == [(n, threading.get_ident()) for n in range(10)]
+    assert cron._executors == {}
+
+
+def test_a_single_worker_extracts_in_process(monkeypatch, extraction):
+    results = list(CronService().extract_encounters(range(5), workers=1))
+
+    assert results == [(n, threading.get_ident()) for n in range(5)]
+    assert cron._executors == {}
+
+
+def test_async_batches_share_one_loop_and_extract_off_it(monkeypatch):
+    monkeypatch.setattr(Config, "FHIR_ASYNC_EXTRACTION", True)
+    monkeypatch.setattr(CronService, "BATCH_SIZE", 2)
+    monkeypatch.setattr(
+        cron.EpicEncounterRepository, "prefetch_references", lambda batch: None
+    )
+    loops, clients = set(), set()
+
+    async def extract_factory_async(encounter, client):
+        loops.add(id(asyncio.get_running_loop()))
+        clients.add(id(client))
+        thread = await asyncio.to_thread(threading.get_ident)
+        return encounter, thread
+
+    monkeypatch.setattr(
+        cron.EpicEncounterRepository,
+        "extract_factory_async",
+        staticmethod(extract_factory_async),
+    )
+    results = list(CronService().extract_patient_encounters(iter(range(5))))
+
+    assert [n for n, _ in results] == list(range(5))
+    assert threading.get_ident() not in {thread for _, thread in results}
+    assert len(loops) == 1 and len(clients) == 1
@@ -0,0 +1,72 @@
+import pytest
+from app.models.patient import PatientReference
+from app.repository import location_index
+from app.repository.location_index import LocationIndex
+from app.repository.epic_location import EpicLocationRepository
+from app.repository.epic_encounter import EpicEncounterRepository
+from tests.test_location_index import FakeBulkExportManager, hospital, location
+
+DEPARTMENT = {"managingOrganization": {"reference": "Organization/O1"}}
+LOCATIONS = {
+    "H1": hospital("H1"),
+    "D1": location("D1", "H1", **DEPARTMENT),
+    "D2": location("D2", "H1", **DEPARTMENT),
+    # a department under a wing, the hospital is not its direct parent
+    "W1": location("W1", "H1"),
+    "D3": location("D3", "W1", **DEPARTMENT),
+}
+
+
+@pytest.fixture(autouse=True)
+def index(monkeypatch):
+    monkeypatch.setattr(
+        EpicLocationRepository, "fetch_raw", staticmethod(lambda id: LOCATIONS[id])
+    )
+    monkeypatch.setattr(
+        location_index, "get_bulk_export_manager", lambda: FakeBulkExportManager()
+    )
+    monkeypatch.setattr(location_index, "_index", LocationIndex(ttl=300))
+
+
+def extract(*department_ids):
+    repo = EpicEncounterRepository()
+    repo.set_rawdata(
+        {
+            "id": "E1",
+            "period": {"start": "2024-01-01T08:00:00Z"},
+            "hospitalization": {},
+            "location": [
+                {
+                    "location": {"reference": f"Location/{id}"},
+                    "period": {"start": "2024-01-01T08:00:00Z"},
+                }
+                for id in department_ids
+            ],
+        }
+    )
+    repo.patient = PatientReference(id="P1")
+    repo._extract_hospital_and_departments()
+    return repo
+
+
+def test_every_department_of_a_hospital_is_matched_to_it():
+    repo = extract("D1", "D2")
+
+    assert repo.departments["D1"].hospital_id == "H1"
+    assert repo.departments["D2"].hospital_id == "H1"
+    assert [stay.id for stay in repo.department_stays["H1"]] == ["E1-D1", "E1-D2"]
+
+
+def test_the_hospital_is_the_hospital_location():
+    repo = extract("D1")
+
+    assert list(repo.hospitals) == ["H1"]
+    assert repo.hospitals["H1"].id == "H1"
+    assert repo.hospitals["H1"].is_hospital
+
+
+def test_the_nearest_hospital_up_the_partof_chain_is_used():
+    repo = extract("D3")
+
+    assert repo.departments["D3"].hospital_id == "H1"
+    assert [stay.id for stay in repo.department_stays["H1"]] == ["E1-D3"]
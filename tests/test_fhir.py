@@ -0,0 +1,61 @@
+import pytest
+from config import Config
+from app.services.fhir import FhirService
+
+
+def page(url, ids, next_url=None):
+    entries = [{"fullUrl": f"{url}#{id}", "resource": {"id": id}} for id in ids]
+    # an OperationOutcome is not a match and is left out
+    entries.append(
+        {
+            "resource": {"resourceType": "OperationOutcome"},
+            "search": {"mode": "outcome"},
+        }
+    )
+    link = [{"relation": "self", "url": url}]
+    if next_url:
+        link.append({"relation": "next", "url": next_url})
+    return {"resourceType": "Bundle", "link": link, "entry": entries}
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    monkeypatch.setattr(Config, "EPIC_API_URL", "https://epic")
+    monkeypatch.setattr(Config, "FHIR_SEARCH_COUNT", 0)
+    first = "https://epic/api/FHIR/R4/CarePlan?patient=P1&category=38717003"
+    bundles = {
+        first: page(first, ["C1", "C2"], "https://epic/page2"),
+        "https://epic/page2": page("https://epic/page2", ["C3"], "https://epic/page3"),
+        "https://epic/page3": page("https://epic/page3", []),
+    }
+    requested = []
+
+    def get_request(self, url, *args, **kwargs):
+        requested.append(url)
+        return bundles[url]
+
+    monkeypatch.setattr(FhirService, "get_request", get_request)
+    return first, requested
+
+
+def test_search_follows_every_next_link(pages):
+    first, requested = pages
+    bundle = FhirService().search_careplan(
+        {"patient": "P1", "category": "38717003", "encounter": None}
+    )
+
+    assert requested == [first, "https://epic/page2", "https://epic/page3"]
+    assert bundle["type"] == "searchset"
+    assert bundle["total"] == 3
+    assert [entry["resource"]["id"] for entry in bundle["entry"]] == ["C1", "C2", "C3"]
+    assert bundle["entry"][0]["fullUrl"] == f"{first}#C1"
+
+
+def test_pages_are_read_lazily(pages):
+    first, requested = pages
+    resources = FhirService().iter_bundle(first)
+
+    assert next(resources) == {"id": "C1"}
+    assert requested == [first]
+    assert [resource["id"] for resource in resources] == ["C2", "C3"]
+    assert len(requested) == 3
@@ -0,0 +1,131 @@
+import pytest
+from app.utils.hl7parser import (
+    hl7parser,
+    hl7segment,
+    hl7messageexception,
+    read_separators,
+    DEFAULT_SEPARATORS,
+)
+
+MESSAGE = "\r".join(
+    [
+        "MSH|^~\\&|EPIC|HOSP|TNT|TNTFAC|202401010830||ADT^A01^ADT_A01|MSG00001|P|2.5.1",
+        "EVN|A01|202401010830",
+        "PID|1||P1^^^EPIC^MR~900^^^SSA^SS||DOE^JANE^A||19800101|F|||"
+        "12 MAIN ST^^METROPOLIS&DOWNTOWN&NORTH^IL^62960",
+        "NK1|1|DOE^JOHN|SPO",
+        "NK1|2|DOE^JUNIOR|CHD",
+        "PV1|1|I|H1D1^R1^B1",
+    ]
+)
+
+
+def test_separators_are_read_from_msh():
+    message = hl7parser.parse("MSH#*-$@#EPIC#HOSP\nPID#1##X*Y-Z*W")
+    assert message.separators == "#*-$@"
+
+    pid = message.get_segment("PID")
+    assert pid[3] == ["X", "Y"]
+    assert pid.repetitions(3) == [["X", "Y"], ["Z", "W"]]
+
+
+def test_missing_encoding_characters_default():
+    assert hl7parser.parse("MSH|^~|EPIC\rPID|1").separators == DEFAULT_SEPARATORS
+    assert hl7parser.parse("PID|1||P1").separators == DEFAULT_SEPARATORS
+
+
+def test_invalid_msh_separators_raise():
+    with pytest.raises(hl7messageexception):
+        read_separators("MSH")
+    with pytest.raises(hl7messageexception):
+        read_separators("MSH||EPIC")
+
+
+def test_msh_fields_are_numbered_as_in_the_specification():
+    msh = hl7parser.parse(MESSAGE).get_segment("MSH")
+    assert msh[0] == ["MSH"]
+    assert msh[1] == ["|"]
+    assert msh[2] == ["^~\\&"]
+    assert msh.field(3, 0) == "EPIC"
+    assert msh.field(5, 0) == "TNT"
+    assert msh[9] == ["ADT", "A01", "ADT_A01"]
+    assert msh.field(10, 0) == "MSG00001"
+    assert msh.field(12, 0) == "2.5.1"
+    assert msh.field(30, 0, default="none") == "none"
+
+
+def test_repeated_segments():
+    message = hl7parser.parse(MESSAGE)
+    assert [nk1[2] for nk1 in message.get_segments("NK1")] == [
+        ["DOE", "JOHN"],
+        ["DOE", "JUNIOR"],
+    ]
+    assert message.segment("NK1", 1).field(1, 0) == "2"
+    assert message.segment("NK1", 2) is None
+    assert message.get_segments("OBX") == []
+    assert len(message.get_segments()) == 6
+
+
+def test_field_repetitions():
+    pid = hl7parser.parse(MESSAGE).get_segment("PID")
+    # indexing a field gives its first repetition
+    assert pid[3] == ["P1", "", "", "EPIC", "MR"]
+    assert pid.repetitions(3) == [
+        ["P1", "", "", "EPIC", "MR"],
+        ["900", "", "", "SSA", "SS"],
+    ]
+    assert pid.field(3, 0, repetition=1) == "900"
+    assert pid.field(3, 0, repetition=2) is None
+
+
+def test_sub_components():
+    pid = hl7parser.parse(MESSAGE).get_segment("PID")
+    assert pid.field(11, 2) == "METROPOLIS&DOWNTOWN&NORTH"
+    assert pid.subcomponents(11, 2) == ["METROPOLIS", "DOWNTOWN", "NORTH"]
+    assert pid.subcomponents(11, 9) == []
+
+
+def test_unescape():
+    segment = hl7segment(
+        "OBX|1|TX|||a\\F\\b\\S\\c\\T\\d\\R\\e\\E\\f\\X41\\\\.br\\g\\H\\"
+    )
+    assert segment.field(5, 0) == "a|b^c&d~e\\fA\rg"
+    # unknown escape sequences are kept as they are
+    assert segment.unescape("a\\Z\\b") == "a\\Z\\b"
+
+
+def test_escape_round_trip():
+    message = hl7parser.parse(MESSAGE)
+    value = "a|b^c~d\\e&f"
+    escaped = message.escape(value)
+    assert escaped == "a\\F\\b\\S\\c\\R\\d\\E\\e\\T\\f"
+    assert not any(separator in escaped.replace("\\", "") for separator in "|^~&")
+    assert hl7segment("X", message.separators).unescape(escaped) == value
+
+    segment = hl7segment(f"OBX|1|TX|||{escaped}^next", message.separators)
+    assert segment[5] == [value, "next"]
+
+
+def test_patient():
+    assert hl7parser.parse(MESSAGE).get_patient() == {
+        "patient_id": "P1",
+        "patient_name": "DOE JANE A",
+        "dob": "19800101",
+        "gender": "F",
+    }
+    assert hl7parser.parse("MSH|^~\\&|EPIC\rEVN|A01").get_patient() is None
+
+
+def test_acknowledgement():
+    message = hl7parser.parse(MESSAGE)
+    msh, msa = message.acknowledgement("AA", control_id="ACK1").rstrip("\r").split("\r")
+
+    fields = msh.split("|")
+    assert fields[:6] == ["MSH", "^~\\&", "TNT", "TNTFAC", "EPIC", "HOSP"]
+    assert fields[8:] == ["ACK^A01^ACK", "ACK1", "P", "2.5.1"]
+    assert msa == "MSA|AA|MSG00001"
+
+    ack = hl7parser.parse(message.acknowledgement("AE", "bad | value^"))
+    msa = ack.get_segment("MSA")
+    assert [msa[1], msa[2], msa[3]] == [["AE"], ["MSG00001"], ["bad | value^"]]
+    assert len(ack.get_segment("MSH").field(10, 0)) == 20
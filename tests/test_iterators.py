@@ -0,0 +1,64 @@
+import time
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.utils.iterators import prefetch, batched, ordered_map
+
+
+def test_prefetch_yields_every_item_in_order():
+    assert list(prefetch(range(100), depth=3)) == list(range(100))
+
+
+def test_prefetch_raises_the_producer_error():
+    def produce():
+        yield 1
+        raise ValueError("broken page")
+
+    items = prefetch(produce())
+    assert next(items) == 1
+    with pytest.raises(ValueError, match="broken page"):
+        next(items)
+
+
+def test_closing_prefetch_stops_the_producer():
+    produced = []
+
+    def produce():
+        while True:
+            produced.append(threading.get_ident())
+            yield len(produced)
+
+    items = prefetch(produce(), depth=1)
+    assert next(items) == 1
+    items.close()
+
+    # the producer blocked on the full queue gives up instead of reading on
+    time.sleep(1)
+    count = len(produced)
+    time.sleep(1)
+    assert len(produced) == count <= 3
+    assert threading.get_ident() not in produced
+
+
+def test_batched():
+    assert list(batched(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batched([], 3)) == []
+
+
+def test_ordered_map_bounds_the_work_in_flight():
+    submitted = []
+
+    def work(n):
+        time.sleep(0.01 * (n % 3))
+        return n * 2
+
+    def items():
+        for n in range(20):
+            submitted.append(n)
+            yield n
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = ordered_map(executor, work, items(), window=4)
+        assert next(results) == 0
+        assert len(submitted) == 4
+        assert list(results) == [n * 2 for n in range(1, 20)]
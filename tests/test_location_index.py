@@ -0,0 +1,129 @@
+import json
+import pytest
+from app.repository import location_index
+from app.repository.location_index import LocationIndex
+from app.repository.epic_location import EpicLocationRepository
+
+
+def hospital(id):
+    return {
+        "resourceType": "Location",
+        "id": id,
+        "identifier": [{"value": f"TAX-{id}", "type": {"coding": [{"code": "TAX"}]}}],
+    }
+
+
+def location(id, parent, **fields):
+    return dict(
+        {
+            "resourceType": "Location",
+            "id": id,
+            "partOf": {"reference": f"Location/{parent}"},
+        },
+        **fields,
+    )
+
+
+LOCATIONS = {
+    "H1": hospital("H1"),
+    "W1": location("W1", "H1"),
+    "D1": location("D1", "W1", managingOrganization={"reference": "Organization/O1"}),
+    "R1": location("R1", "D1", physicalType={"coding": [{"code": "ro"}]}),
+    "B1": location("B1", "R1", physicalType={"coding": [{"code": "bd"}]}),
+    "H2": hospital("H2"),
+}
+
+
+class FakeBulkExportManager(object):
+    def __init__(self, latest=None) -> None:
+        self.export = latest
+
+    def latest(self):
+        return self.export
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Locations served by fetch_raw, with the IDs read"""
+    locations = {id: dict(location) for id, location in LOCATIONS.items()}
+    reads = []
+
+    def fetch_raw(id):
+        reads.append(id)
+        return locations[id]
+
+    monkeypatch.setattr(EpicLocationRepository, "fetch_raw", staticmethod(fetch_raw))
+    monkeypatch.setattr(
+        location_index, "get_bulk_export_manager", lambda: FakeBulkExportManager()
+    )
+    return locations, reads
+
+
+def test_ancestors_and_hospital_are_resolved(upstream):
+    _, reads = upstream
+    index = LocationIndex(ttl=300)
+
+    assert index.ancestors("B1") == ("R1", "D1", "W1", "H1")
+    assert index.parent("B1") == "R1"
+    assert index.hospital("B1") == "H1"
+    assert index.hospital("D1") == "H1"
+    assert index.hospital("H1") == "H1"
+    # the whole partOf chain was indexed by the first lookup
+    assert reads == ["B1", "R1", "D1", "W1", "H1"]
+
+
+def test_moving_a_location_relinks_its_descendants(upstream):
+    locations, _ = upstream
+    index = LocationIndex(ttl=300)
+    assert index.hospital("B1") == "H1"
+
+    index.update(location("W1", "H2"))
+    assert index.ancestors("B1") == ("R1", "D1", "W1", "H2")
+    assert index.hospital("R1") == "H2"
+
+
+def test_partof_cycles_are_cut(upstream):
+    locations, _ = upstream
+    locations["C1"] = location("C1", "C2")
+    locations["C2"] = location("C2", "C1")
+    index = LocationIndex(ttl=300)
+
+    assert index.ancestors("C1") == ("C2",)
+    assert index.ancestors("C2") == ("C1",)
+    assert index.hospital("C1") is None
+
+
+def test_outdated_nodes_are_read_again(upstream):
+    locations, reads = upstream
+    index = LocationIndex(ttl=300)
+    index.get("H2")
+    index.get("H2")
+    assert reads == ["H2"]
+
+    locations["H2"] = dict(hospital("H2"), name="Renamed")
+    index._nodes["H2"]["indexed_at"] -= 301
+    assert index.get("H2")["location"]["name"] == "Renamed"
+    assert reads == ["H2", "H2"]
+
+
+def test_the_latest_bulk_export_is_indexed_once(upstream, monkeypatch, tmp_path):
+    _, reads = upstream
+    path = tmp_path / "Location.ndjson"
+    path.write_text("".join(json.dumps(l) + "\n" for l in LOCATIONS.values()))
+    manager = FakeBulkExportManager(
+        {"job_id": "job1", "files": {"Location": [str(path)]}}
+    )
+    monkeypatch.setattr(location_index, "get_bulk_export_manager", lambda: manager)
+    index = LocationIndex(ttl=300)
+
+    assert index.hospital("B1") == "H1"
+    assert reads == []
+    assert index.stats() == {"locations": len(LOCATIONS), "export": "job1"}
+
+    # a newer export is only looked for once per ttl
+    manager.export = {"job_id": "job2", "files": {"Location": []}}
+    index.get("B1")
+    assert index.stats()["export"] == "job1"
+    index._export_checked_at -= 301
+    index.get("B1")
+    assert index.stats()["export"] == "job2"
@@ -0,0 +1,95 @@
+import socket
+import struct
+import asyncio
+import threading
+from app.services.mllp import MllpServer, START_BLOCK, END_BLOCK
+
+MESSAGE = "\r".join(
+    [
+        "MSH|^~\\&|EPIC|HOSP|TNT|TNT|202401010830||ADT^A01|MSG{n}|P|2.5",
+        "PID|1||P{n}^^^EPIC^MR||DOE^JANE",
+        "PV1|1|I|H1D1^R1^B1",
+    ]
+)
+
+
+class FakeQueue(object):
+    """Stores jobs in memory; `release` is waited on before each batch is stored"""
+
+    def __init__(self) -> None:
+        self.jobs = []
+        self.storing = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def enqueue_many(self, messages):
+        self.storing.set()
+        self.release.wait(5)
+        self.jobs.extend(messages)
+        return [str(n) for n in range(len(messages))]
+
+
+def frame(n):
+    return START_BLOCK + MESSAGE.format(n=n).encode() + END_BLOCK
+
+
+async def read_ack(reader):
+    ack = await asyncio.wait_for(reader.readuntil(END_BLOCK), 5)
+    assert ack.startswith(START_BLOCK)
+    return ack[1 : -len(END_BLOCK)].decode().split("\r")[1].split("|")
+
+
+def run(test):
+    async def serve():
+        queue = FakeQueue()
+        mllp = MllpServer("127.0.0.1", 0, queue=queue)
+        server = await mllp.start()
+        try:
+            await test(mllp, queue, server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(serve())
+
+
+def test_pipelined_messages_are_acknowledged_in_order():
+    async def test(mllp, queue, port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(frame(1) + b"garbage" + END_BLOCK + frame(2))
+        writer.write(START_BLOCK + b"MSH|^~\\&|EPIC|HOSP\rEVN|A01" + END_BLOCK)
+        await writer.drain()
+
+        assert (await read_ack(reader))[:3] == ["MSA", "AA", "MSG1"]
+        assert (await read_ack(reader))[:3] == ["MSA", "AA", "MSG2"]
+        assert (await read_ack(reader))[:2] == ["MSA", "AE"]
+        writer.close()
+        assert [patient for _, patient in queue.jobs] == ["P1", "P2"]
+
+    run(test)
+
+
+def test_peer_reset_while_storing_does_not_stop_acknowledgements():
+    async def test(mllp, queue, port):
+        queue.release.clear()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(frame(1))
+        await writer.drain()
+        while not queue.storing.is_set():
+            await asyncio.sleep(0.01)
+
+        # reset the connection (RST) while the message is being stored
+        sock = writer.get_extra_info("socket")
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        writer.transport.abort()
+        await asyncio.sleep(0.1)
+        queue.release.set()
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(frame(2))
+        await writer.drain()
+        assert (await read_ack(reader))[:3] == ["MSA", "AA", "MSG2"]
+        writer.close()
+        assert [patient for _, patient in queue.jobs] == ["P1", "P2"]
+
+    run(test)
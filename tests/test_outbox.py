@@ -0,0 +1,129 @@
+import os
+import time
+import pytest
+from config import Config
+from app.services import outbox as outbox_module
+from app.services.outbox import Outbox, retry_delay
+
+
+class FakeDigestStore(object):
+    def __init__(self) -> None:
+        self.digests = {}
+
+    def set(self, hospital_stay_id, hospital_id, digest):
+        self.digests[(hospital_stay_id, hospital_id)] = digest
+
+
+@pytest.fixture
+def digests(monkeypatch):
+    store = FakeDigestStore()
+    monkeypatch.setattr(outbox_module, "get_digest_store", lambda: store)
+    return store
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch, digests):
+    # entries are claimed by the tests, not by a dispatcher thread
+    monkeypatch.setattr(Outbox, "ensure_running", lambda self: None)
+    return Outbox(os.path.join(tmp_path, "outbox.db"), claim_size=10)
+
+
+def append(outbox, name, stay, hospital="H1"):
+    return outbox.append({"name": name}, stay, hospital, digest=name, job_id="job1")
+
+
+def success(outbox, entry):
+    outbox.acknowledge(entry, {"status": "success", "status_code": 200})
+
+
+def failure(outbox, entry, status_code, error="nope"):
+    outbox.acknowledge(
+        entry, {"status": "failed", "status_code": status_code, "error": error}
+    )
+
+
+def test_claims_the_oldest_entry_per_stay_and_hospital(outbox, digests):
+    append(outbox, "s1-a", "S1")
+    append(outbox, "s1-b", "S1")
+    append(outbox, "s2-a", "S2")
+    append(outbox, "s1-h2", "S1", "H2")
+
+    entries = outbox.claim()
+    assert [entry["digest"] for entry in entries] == ["s1-a", "s2-a", "s1-h2"]
+    # leased: not claimed again, and S1's next message waits for the first one
+    assert outbox.claim() == []
+
+    for entry in entries:
+        success(outbox, entry)
+    assert [entry["digest"] for entry in outbox.claim()] == ["s1-b"]
+    assert digests.digests == {
+        ("S1", "H1"): "s1-a",
+        ("S2", "H1"): "s2-a",
+        ("S1", "H2"): "s1-h2",
+    }
+
+
+def test_delivered_entries_drop_their_payload(outbox):
+    id = append(outbox, "a", "S1")
+    success(outbox, outbox.claim()[0])
+
+    entry = outbox.get_many([id])[id]
+    assert entry["status"] == "delivered"
+    assert entry["attempts"] == 1
+    row = outbox.connection().execute("SELECT message FROM outbox").fetchone()
+    assert row["message"] is None
+
+
+def test_transient_failures_are_retried_with_backoff(outbox, monkeypatch):
+    id = append(outbox, "a", "S1")
+    append(outbox, "b", "S1")
+    failure(outbox, outbox.claim()[0], 503)
+
+    entry = outbox.get_many([id])[id]
+    assert (entry["status"], entry["status_code"], entry["attempts"]) == (
+        "pending",
+        503,
+        1,
+    )
+    # not due yet, and the stay's next message still waits behind it
+    assert outbox.claim() == []
+
+    monkeypatch.setattr(time, "time", lambda: 10**10)
+    entries = outbox.claim()
+    assert [entry["digest"] for entry in entries] == ["a"]
+    failure(outbox, entries[0], None)
+    assert outbox.get_many([id])[id]["status"] == "pending"
+
+
+def test_retry_delay_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(Config, "HTTP_BACKOFF_BASE", 1)
+    monkeypatch.setattr(Config, "OUTBOX_BACKOFF_MAX", 60)
+
+    for attempts in range(10):
+        delay = min(60, 2**attempts)
+        assert delay / 2 <= retry_delay(attempts) <= delay
+
+
+def test_rejected_entries_fail_until_replayed(outbox):
+    id = append(outbox, "a", "S1")
+    failure(outbox, outbox.claim()[0], 400, "bad request")
+    entry = outbox.get_many([id])[id]
+    assert (entry["status"], entry["error"]) == ("failed", "bad request")
+    assert outbox.claim() == []
+
+    assert outbox.replay("other-job") == 0
+    assert outbox.replay("job1") == 1
+    assert [entry["id"] for entry in outbox.claim()] == [id]
+
+
+def test_compact_deletes_old_delivered_entries(outbox, monkeypatch):
+    delivered = append(outbox, "a", "S1")
+    success(outbox, outbox.claim()[0])
+    pending = append(outbox, "b", "S2")
+
+    assert outbox.compact() == 0
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + outbox.retention + 1)
+    assert outbox.compact() == 1
+    assert list(outbox.get_many([delivered, pending])) == [pending]
+    assert outbox.stats()["pending"]["count"] == 1
@@ -0,0 +1,57 @@
+import time
+import pytest
+from app.services.ratelimit import RateLimiter, SharedTokenBucket
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None) -> None:
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Session(object):
+    def __init__(self, *responses) -> None:
+        self.responses = list(responses)
+
+    def request(self, method, url, **kwargs):
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def limiter(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cache").mkdir()
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    return RateLimiter("test", rate=100, capacity=10, max_retries=2)
+
+
+def test_retried_responses_are_closed(limiter):
+    busy = Response(429, {"Retry-After": "0"})
+    unavailable = Response(503)
+    ok = Response(200)
+
+    response = limiter.send(
+        Session(busy, unavailable, ok), "GET", "https://epic/x", stream=True
+    )
+
+    assert response is ok and not ok.closed
+    assert busy.closed and unavailable.closed
+
+
+def test_the_last_response_is_returned_open(limiter):
+    responses = [Response(503) for _ in range(3)]
+
+    response = limiter.send(Session(*responses), "GET", "https://epic/x")
+
+    assert response is responses[-1] and not response.closed
+    assert all(response.closed for response in responses[:-1])
+
+
+@pytest.mark.parametrize("rate, capacity", [(0, 10), (-1, 10), (10, 0.5)])
+def test_a_bucket_that_cannot_refill_is_refused(tmp_path, rate, capacity):
+    with pytest.raises(ValueError):
+        SharedTokenBucket(str(tmp_path / "bucket.json"), rate, capacity)
@@ -0,0 +1,98 @@
+import os
+import time
+import fcntl
+import threading
+import pytest
+from app.utils.singleflight import SingleFlight
+
+
+@pytest.fixture
+def group(tmp_path):
+    group = SingleFlight("test", result_ttl=0, sweep_after=600)
+    group.directory = str(tmp_path)
+    return group
+
+
+def lock_files(group):
+    return [os.path.join(group.directory, name) for name in os.listdir(group.directory)]
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_concurrent_calls_are_coalesced(group):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"id": "L1"}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(group.do("L1", fn)))
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(group.do("L1", fn)))
+    follower.start()
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert results == [{"id": "L1"}, {"id": "L1"}]
+    assert len(calls) == 1
+
+
+def test_a_held_lock_file_is_not_swept(group):
+    started, release = threading.Event(), threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return "L1"
+
+    leader = threading.Thread(target=group.do, args=("L1", fn))
+    leader.start()
+    try:
+        assert started.wait(5)
+        (path,) = lock_files(group)
+        age(path, 3600)
+
+        group._sweep()
+        assert os.path.exists(path)
+    finally:
+        release.set()
+        leader.join()
+
+    age(path, 3600)
+    group._swept_at = 0
+    group._sweep()
+    assert not os.path.exists(path)
+
+
+def test_a_caller_waiting_on_a_swept_file_locks_a_new_one(group):
+    group.do("L1", lambda: "L1")
+    (path,) = lock_files(group)
+
+    # another worker holds the lock, the caller waits for it
+    fd = os.open(path, os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    results = []
+    caller = threading.Thread(
+        target=lambda: results.append(group.do("L1", lambda: "L1 again"))
+    )
+    caller.start()
+    time.sleep(0.1)
+
+    # swept by that worker before it releases it
+    os.remove(path)
+    os.close(fd)
+    caller.join(5)
+
+    assert results == ["L1 again"]
+    # the caller published into the file now at `path`, not into the removed one
+    with open(path) as file:
+        assert "L1 again" in file.read()
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+import pytest
+from config import Config
+from app.services import token
+from app.services.token import TokenManager, get_token_manager
+
+
+class Exchange(object):
+    def __init__(self, expires_in=300) -> None:
+        self.expires_in = expires_in
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("token endpoint unavailable")
+        return {"access_token": f"T{self.calls}", "expires_in": self.expires_in}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def exchange():
+    return Exchange()
+
+
+@pytest.fixture
+def manager(tmp_path, exchange):
+    return TokenManager(exchange, os.path.join(tmp_path, "token.json"), 60)
+
+
+def test_the_token_is_exchanged_once_and_kept(manager, exchange, clock):
+    assert manager.get_token() == "T1"
+    clock[0] += 200
+    assert manager.get_token() == "T1"
+    assert exchange.calls == 1
+
+
+def test_workers_share_the_token_through_the_slot(manager, exchange):
+    other = TokenManager(exchange, manager.slot_path, 60)
+
+    assert manager.get_token() == other.get_token() == "T1"
+    assert exchange.calls == 1
+
+
+def test_an_expiring_token_is_renewed_on_demand(manager, exchange, clock):
+    manager.get_token()
+    clock[0] += 250
+
+    assert manager.get_token() == "T2"
+    assert exchange.calls == 2
+
+
+def test_other_threads_keep_the_expiring_token_during_the_renewal(
+    manager, exchange, clock
+):
+    manager.get_token()
+    clock[0] += 250
+    exchange.release.clear()
+    exchange.started.clear()
+    renewing = threading.Thread(target=manager.get_token)
+    renewing.start()
+    try:
+        assert exchange.started.wait(5)
+        assert manager.get_token() == "T1"
+    finally:
+        exchange.release.set()
+        renewing.join()
+
+    assert manager.get_token() == "T2"
+
+
+def test_a_failed_renewal_keeps_the_valid_token(manager, exchange, clock):
+    manager.get_token()
+    clock[0] += 250
+    exchange.fail = True
+
+    assert manager.get_token() == "T1"
+    # past its expiry there is nothing left to fall back to
+    clock[0] += 100
+    with pytest.raises(RuntimeError):
+        manager.get_token()
+
+
+def test_the_slot_does_not_depend_on_the_working_directory(
+    tmp_path, monkeypatch, exchange
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(token, "_managers", {})
+
+    manager = get_token_manager("epic", exchange)
+
+    assert manager.slot_path == os.path.join(Config.TOKEN_SLOT_DIR, "token-epic.json")
+    assert os.path.isabs(manager.slot_path)